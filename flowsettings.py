@@ -48,6 +48,50 @@ KH_MARKDOWN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 KH_CHUNKS_OUTPUT_DIR = KH_APP_DATA_DIR / "chunks_cache_dir"
 KH_CHUNKS_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# content-addressed cache of chunk embeddings, so that re-indexing byte-identical
+# chunks does not call the embedding model again. Set to empty to disable.
+KH_EMBEDDING_CACHE_PATH = config(
+    "KH_EMBEDDING_CACHE_PATH", default=str(KH_APP_DATA_DIR / "embedding_cache.db")
+)
+KH_EMBEDDING_CACHE_MAX_ENTRIES = config(
+    "KH_EMBEDDING_CACHE_MAX_ENTRIES", default=1_000_000, cast=int
+)
+
+# cache of the documents parsed by the expensive loaders (Docling, Azure Document
+# Intelligence, Adobe, OCR), keyed by file content and loader settings, so that
+# re-indexing a file does not parse it again. Set to empty to disable.
+KH_PARSE_CACHE_PATH = config(
+    "KH_PARSE_CACHE_PATH", default=str(KH_APP_DATA_DIR / "parse_cache.db")
+)
+KH_PARSE_CACHE_MAX_ENTRIES = config(
+    "KH_PARSE_CACHE_MAX_ENTRIES", default=10_000, cast=int
+)
+# number of file selections whose chunk ids are cached for retrieval
+KH_CHUNK_SCOPE_CACHE_SIZE = config("KH_CHUNK_SCOPE_CACHE_SIZE", default=128, cast=int)
+# number of files indexed concurrently (the docstore and vectorstore must support
+# concurrent writes) and size of the process pool running the file loaders
+KH_INDEXING_MAX_WORKERS = config("KH_INDEXING_MAX_WORKERS", default=1, cast=int)
+KH_INDEXING_LOADER_PROCESSES = config(
+    "KH_INDEXING_LOADER_PROCESSES", default=0, cast=int
+)
+# store the images of the documents as files instead of base64 in their metadata
+KH_STORE_IMAGES_AS_BLOBS = config("KH_STORE_IMAGES_AS_BLOBS", default=True, cast=bool)
+# reuse the chunks of an indexed file with the same content on upload
+KH_INDEXING_DEDUP_FILES = config("KH_INDEXING_DEDUP_FILES", default=True, cast=bool)
+# on reindex, only embed the chunks of a file whose content changed
+KH_INDEXING_INCREMENTAL_REINDEX = config(
+    "KH_INDEXING_INCREMENTAL_REINDEX", default=True, cast=bool
+)
+# number of pages (or other documents) indexed at a time for the loaders that
+# can stream them, bounding the memory used by large files. 0 to disable. The
+# loaders running in the KH_INDEXING_LOADER_PROCESSES pool load whole files
+KH_INDEXING_STREAMING_BATCH_SIZE = config(
+    "KH_INDEXING_STREAMING_BATCH_SIZE", default=64, cast=int
+)
+# number of background workers indexing the uploaded files from a persistent job
+# queue, 0 to index the files within the upload request
+KH_INGESTION_WORKERS = config("KH_INGESTION_WORKERS", default=0, cast=int)
+
 # zip output directory
 KH_ZIP_OUTPUT_DIR = KH_APP_DATA_DIR / "zip_cache_dir"
 KH_ZIP_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -100,6 +144,7 @@ KH_VECTORSTORE = {
     "__type__": "kotaemon.storages.ChromaVectorStore",
     # "__type__": "kotaemon.storages.MilvusVectorStore",
     # "__type__": "kotaemon.storages.QdrantVectorStore",
+    # "__type__": "kotaemon.storages.NumpyVectorStore",
     "path": str(KH_USER_DATA_DIR / "vectorstore"),
 }
 KH_LLMS = {}
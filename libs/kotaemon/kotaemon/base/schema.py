@@ -34,11 +34,14 @@ class Document(BaseDocument):
             - info: show in information panel
             - index: show in index panel
             - debug: show in debug panel
+            - progress: machine-readable indexing progress, not shown
     """
 
     content: Any = None
     source: Optional[str] = None
-    channel: Optional[Literal["chat", "info", "index", "debug", "plot"]] = None
+    channel: Optional[
+        Literal["chat", "info", "index", "debug", "plot", "progress"]
+    ] = None
 
     def __init__(self, content: Optional[Any] = None, *args, **kwargs):
         if content is None:
@@ -1,4 +1,5 @@
 from .base import BaseEmbeddings
+from .cache import CachedEmbeddings, EmbeddingCache
 from .endpoint_based import EndpointEmbeddings
 from .fastembed import FastEmbedEmbeddings
 from .langchain_based import (
@@ -13,6 +14,8 @@ from .tei_endpoint_embed import TeiEndpointEmbeddings
 
 __all__ = [
     "BaseEmbeddings",
+    "CachedEmbeddings",
+    "EmbeddingCache",
     "EndpointEmbeddings",
     "TeiEndpointEmbeddings",
     "LCOpenAIEmbeddings",
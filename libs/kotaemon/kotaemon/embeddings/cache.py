@@ -0,0 +1,299 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Optional
+
+from kotaemon.base import Document, DocumentWithEmbedding, Param
+
+from .base import BaseEmbeddings
+
+# params that do not affect the produced vectors, hence should not be part of the
+# model identity (otherwise rotating a key would invalidate the whole cache)
+_VOLATILE_PARAMS = {"timeout", "max_retries", "request_timeout", "user_agent"}
+_SECRET_PARAM_MARKERS = ("key", "token", "credential", "secret", "password")
+
+
+def get_model_identity(embedding: BaseEmbeddings) -> str:
+    """Build a stable identity string for an embedding model
+
+    The identity is made of the embedding class and the params that influence the
+    output vectors (model name, deployment, dimensions...). Credentials and
+    transport-related params are excluded.
+
+    Args:
+        embedding: the embedding model
+
+    Returns:
+        the identity string
+    """
+    try:
+        spec = embedding.dump(strict=False)  # type: ignore[call-arg]
+    except Exception:
+        spec = {}
+
+    # kotaemon components nest params under "params", langchain wrappers don't
+    params = spec.get("params", spec)
+    identity_params = {
+        key: value
+        for key, value in params.items()
+        if not key.startswith("_")
+        and key not in _VOLATILE_PARAMS
+        and not any(marker in key.lower() for marker in _SECRET_PARAM_MARKERS)
+    }
+    cls = embedding.__class__
+    return (
+        f"{cls.__module__}.{cls.__qualname__}:"
+        f"{json.dumps(identity_params, sort_keys=True, default=str)}"
+    )
+
+
+class EmbeddingCache:
+    """Persistent, content-addressed store of embedding vectors
+
+    Each vector is keyed by sha256(model identity + text), so byte-identical text
+    embedded by the same model is only computed once. Entries are kept in a SQLite
+    database and evicted in least-recently-used order once the cache grows above
+    `max_entries`.
+
+    Args:
+        path: path to the SQLite database file. Use ":memory:" for a
+            non-persistent cache.
+        max_entries: maximum number of vectors to keep. 0 or None to disable
+            eviction.
+    """
+
+    def __init__(self, path: str | Path, max_entries: Optional[int] = 1_000_000):
+        self._path = str(path)
+        if self._path != ":memory:":
+            Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._last_access = 0.0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access "
+            "ON embeddings (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_identity: str, text: str) -> str:
+        """Compute the cache key of a text for a given model"""
+        hasher = hashlib.sha256(model_identity.encode("utf-8"))
+        hasher.update(b"\x00")
+        hasher.update(text.encode("utf-8"))
+        return hasher.hexdigest()
+
+    def _now(self) -> float:
+        """Strictly increasing timestamp, so that the LRU order is never ambiguous"""
+        self._last_access = max(time.time(), self._last_access + 1e-6)
+        return self._last_access
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Get the cached vectors of the given keys, missing keys are omitted"""
+        found: dict[str, list[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # stay below SQLite's default limit of host parameters
+            for start in range(0, len(unique_keys), 900):
+                batch = unique_keys[start : start + 900]
+                placeholders = ", ".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch,
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array("d")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+
+            if found:
+                now = self._now()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+
+            n_hits = sum(1 for key in keys if key in found)
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+
+        return found
+
+    def put_many(self, items: dict[str, list[float]]):
+        """Store the vectors, evicting the least recently used ones if needed"""
+        if not items:
+            return
+
+        with self._lock:
+            now = self._now()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) "
+                "VALUES (?, ?, ?)",
+                [
+                    (key, array("d", vector).tobytes(), now)
+                    for key, vector in items.items()
+                ],
+            )
+            if self.max_entries:
+                (count,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        "DELETE FROM embeddings WHERE key IN ("
+                        "SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self._conn.commit()
+
+    def count(self) -> int:
+        """Number of cached vectors"""
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return count
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this cache instance"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.count(),
+        }
+
+    def clear(self):
+        """Remove all cached vectors and reset the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+
+_caches: dict[tuple[str, Optional[int]], EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(
+    path: str | Path, max_entries: Optional[int] = 1_000_000
+) -> EmbeddingCache:
+    """Get the embedding cache at `path`, shared across the whole process
+
+    Sharing the instance keeps a single database connection and a single set of
+    hit/miss counters per cache file. In-memory caches are never shared.
+    """
+    if str(path) == ":memory:":
+        return EmbeddingCache(path, max_entries=max_entries)
+
+    key = (str(Path(path).resolve()), max_entries)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = EmbeddingCache(path, max_entries=max_entries)
+        return _caches[key]
+
+
+class CachedEmbeddings(BaseEmbeddings):
+    """Wrap an embedding model with a persistent content-addressed cache
+
+    Only the texts that are not found in the cache are sent to the wrapped model.
+    The output keeps the order of the input.
+
+    Example:
+        embedding = CachedEmbeddings(
+            embedding=OpenAIEmbeddings(model="text-embedding-3-small", api_key=...),
+            cache_path="ktem_app_data/embedding_cache.db",
+        )
+    """
+
+    embedding: BaseEmbeddings
+    cache_path: str = Param(
+        ":memory:", help="Path to the cache database, ':memory:' to not persist"
+    )
+    max_entries: Optional[int] = Param(
+        1_000_000, help="Maximum number of cached vectors. 0 to disable eviction"
+    )
+
+    @Param.auto(depends_on=["cache_path", "max_entries"])
+    def cache_(self) -> EmbeddingCache:
+        return get_embedding_cache(self.cache_path, max_entries=self.max_entries)
+
+    def _lookup(
+        self, text: str | list[str] | Document | list[Document]
+    ) -> tuple[list[Document], list[str], dict[str, list[float]], dict[str, Document]]:
+        # computed on every call, as the wrapped model's params can be changed. Use
+        # `get_from_path` since `self.embedding` is a tracking wrapper during run
+        model_identity = get_model_identity(self.get_from_path("embedding"))
+        input_docs = self.prepare_input(text)
+        keys = [
+            EmbeddingCache.make_key(model_identity, doc.text or "")
+            for doc in input_docs
+        ]
+        cached = self.cache_.get_many(keys)
+
+        # only embed each missing text once, even if it appears multiple times
+        to_embed: dict[str, Document] = {}
+        for key, doc in zip(keys, input_docs):
+            if key not in cached and key not in to_embed:
+                to_embed[key] = doc
+
+        return input_docs, keys, cached, to_embed
+
+    def _merge(
+        self,
+        input_docs: list[Document],
+        keys: list[str],
+        cached: dict[str, list[float]],
+        new_keys: list[str],
+        new_embeddings: list[DocumentWithEmbedding],
+    ) -> list[DocumentWithEmbedding]:
+        computed = {
+            key: list(emb.embedding) for key, emb in zip(new_keys, new_embeddings)
+        }
+        self.cache_.put_many(computed)
+        cached.update(computed)
+
+        return [
+            DocumentWithEmbedding(embedding=cached[key], content=doc)
+            for key, doc in zip(keys, input_docs)
+        ]
+
+    def invoke(
+        self, text: str | list[str] | Document | list[Document], *args, **kwargs
+    ) -> list[DocumentWithEmbedding]:
+        input_docs, keys, cached, to_embed = self._lookup(text)
+        new_embeddings = (
+            self.embedding(list(to_embed.values()), *args, **kwargs) if to_embed else []
+        )
+        return self._merge(input_docs, keys, cached, list(to_embed), new_embeddings)
+
+    async def ainvoke(
+        self, text: str | list[str] | Document | list[Document], *args, **kwargs
+    ) -> list[DocumentWithEmbedding]:
+        input_docs, keys, cached, to_embed = self._lookup(text)
+        new_embeddings = (
+            await self.get_from_path("embedding").ainvoke(
+                list(to_embed.values()), *args, **kwargs
+            )
+            if to_embed
+            else []
+        )
+        return self._merge(input_docs, keys, cached, list(to_embed), new_embeddings)
+
+    def stats(self) -> dict:
+        """Hit/miss counters of the underlying cache"""
+        return self.cache_.stats()
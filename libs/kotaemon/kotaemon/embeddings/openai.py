@@ -1,3 +1,6 @@
+import asyncio
+import re
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
 from typing import Optional
 
@@ -5,11 +8,14 @@ import numpy as np
 import openai
 import tiktoken
 from tenacity import (
+    AsyncRetrying,
+    RetryCallState,
     retry,
     retry_if_not_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
+from tenacity.wait import wait_base
 from theflow.utils.modules import import_dotted_string
 
 from kotaemon.base import Param
@@ -35,6 +41,58 @@ def split_text_by_chunk_size(text: str, chunk_size: int) -> list[list[int]]:
     return result
 
 
+def parse_reset_duration(value: str) -> Optional[float]:
+    """Parse the OpenAI rate-limit reset duration (e.g. "1s", "6m0s", "20ms")
+
+    Returns:
+        the duration in seconds, or None if it cannot be parsed
+    """
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    factors = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * factors[unit] for number, unit in parts)
+
+
+def get_retry_after(exception: Optional[BaseException]) -> Optional[float]:
+    """Get the delay (in seconds) requested by the rate-limit headers of the API"""
+    response = getattr(exception, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+
+    delays = [
+        parse_reset_duration(headers[name])
+        for name in ("x-ratelimit-reset-tokens", "x-ratelimit-reset-requests")
+        if name in headers
+    ]
+    delays = [delay for delay in delays if delay is not None]
+    return max(delays) if delays else None
+
+
+class wait_for_rate_limit(wait_base):
+    """Wait as long as the API rate-limit headers ask, else back off exponentially"""
+
+    def __init__(self, max_wait: float = 60, fallback: Optional[wait_base] = None):
+        self.max_wait = max_wait
+        self.fallback = fallback or wait_random_exponential(min=1, max=40)
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        delay = get_retry_after(exception)
+        if delay is None:
+            return self.fallback(retry_state)
+        return min(delay, self.max_wait)
+
+
 class BaseOpenAIEmbeddings(BaseEmbeddings):
     """Base interface for OpenAI embedding model, using the openai library.
 
@@ -63,6 +121,20 @@ class BaseOpenAIEmbeddings(BaseEmbeddings):
     context_length: Optional[int] = Param(
         None, help="The maximum context length of the embedding model"
     )
+    max_batch_size: int = Param(
+        64, help="Maximum number of texts sent in a single embedding request"
+    )
+    max_batch_tokens: int = Param(
+        100_000,
+        help=(
+            "Maximum number of tokens sent in a single embedding request. Token "
+            "counts are estimated (4 characters per token) if `context_length` is "
+            "not set"
+        ),
+    )
+    max_concurrency: int = Param(
+        4, help="Maximum number of embedding requests in flight at the same time"
+    )
 
     @Param.auto(depends_on=["max_retries"])
     def max_retries_(self):
@@ -84,12 +156,18 @@ class BaseOpenAIEmbeddings(BaseEmbeddings):
         """Get the openai response"""
         raise NotImplementedError
 
-    def invoke(
-        self, text: str | list[str] | Document | list[Document], *args, **kwargs
-    ) -> list[DocumentWithEmbedding]:
-        input_doc = self.prepare_input(text)
-        client = self.prepare_client(async_version=False)
+    def prepare_request_input(
+        self, input_doc: list[Document]
+    ) -> tuple[list[str | list[int]], dict[int, tuple[int, int]]]:
+        """Convert the documents into the request input
 
+        Texts longer than `context_length` are split into multiple token chunks.
+
+        Returns:
+            - the request input, either texts or token chunks
+            - the mapping from the document index to its [start, end) range in the
+                request input
+        """
         input_: list[str | list[int]] = []
         splitted_indices = {}
         for idx, text in enumerate(input_doc):
@@ -99,44 +177,115 @@ class BaseOpenAIEmbeddings(BaseEmbeddings):
                 input_.extend(chunks)
             else:
                 splitted_indices[idx] = (len(input_), len(input_) + 1)
-                input_.append(text.text)
+                input_.append(text.text or " ")
 
-        resp = self.openai_response(client, input=input_, **kwargs).dict()
-        output_ = list(sorted(resp["data"], key=lambda x: x["index"]))
+        return input_, splitted_indices
 
+    def split_batches(self, input_: list[str | list[int]]) -> list[tuple[int, int]]:
+        """Split the request input into [start, end) batches, each of them within
+        `max_batch_size` texts and `max_batch_tokens` tokens
+        """
+        batches = []
+        start, n_tokens = 0, 0
+        for idx, item in enumerate(input_):
+            item_tokens = len(item) if isinstance(item, list) else len(item) // 4 + 1
+            if idx > start and (
+                idx - start >= self.max_batch_size
+                or n_tokens + item_tokens > self.max_batch_tokens
+            ):
+                batches.append((start, idx))
+                start, n_tokens = idx, 0
+            n_tokens += item_tokens
+
+        if start < len(input_):
+            batches.append((start, len(input_)))
+
+        return batches
+
+    def prepare_output(
+        self,
+        input_doc: list[Document],
+        input_: list[str | list[int]],
+        splitted_indices: dict[int, tuple[int, int]],
+        embeddings: list[list[float]],
+    ) -> list[DocumentWithEmbedding]:
+        """Reassemble the embeddings of the request input into one embedding per
+        document, averaging the embeddings of the chunks of split documents
+        """
         output = []
         for idx, doc in enumerate(input_doc):
-            embs = output_[splitted_indices[idx][0] : splitted_indices[idx][1]]
+            embs = embeddings[splitted_indices[idx][0] : splitted_indices[idx][1]]
             if len(embs) == 1:
-                output.append(
-                    DocumentWithEmbedding(embedding=embs[0]["embedding"], content=doc)
-                )
+                output.append(DocumentWithEmbedding(embedding=embs[0], content=doc))
                 continue
 
             chunk_lens = [
                 len(_)
                 for _ in input_[splitted_indices[idx][0] : splitted_indices[idx][1]]
             ]
-            vs: list[list[float]] = [_["embedding"] for _ in embs]
-            emb = np.average(vs, axis=0, weights=chunk_lens)
+            emb = np.average(embs, axis=0, weights=chunk_lens)
             emb = emb / np.linalg.norm(emb)
             output.append(DocumentWithEmbedding(embedding=emb.tolist(), content=doc))
 
         return output
 
+    def invoke(
+        self, text: str | list[str] | Document | list[Document], *args, **kwargs
+    ) -> list[DocumentWithEmbedding]:
+        input_doc = self.prepare_input(text)
+        client = self.prepare_client(async_version=False)
+        input_, splitted_indices = self.prepare_request_input(input_doc)
+        batches = self.split_batches(input_)
+
+        def embed_batch(batch: tuple[int, int]) -> list[list[float]]:
+            resp = self.openai_response(
+                client, input=input_[batch[0] : batch[1]], **kwargs
+            ).dict()
+            return [
+                _["embedding"] for _ in sorted(resp["data"], key=lambda x: x["index"])
+            ]
+
+        if len(batches) > 1 and self.max_concurrency > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(batches))
+            ) as executor:
+                outputs = list(executor.map(embed_batch, batches))
+        else:
+            outputs = [embed_batch(batch) for batch in batches]
+
+        embeddings = [emb for output in outputs for emb in output]
+        return self.prepare_output(input_doc, input_, splitted_indices, embeddings)
+
     async def ainvoke(
         self, text: str | list[str] | Document | list[Document], *args, **kwargs
     ) -> list[DocumentWithEmbedding]:
-        input_ = self.prepare_input(text)
+        input_doc = self.prepare_input(text)
         client = self.prepare_client(async_version=True)
-        resp = await self.openai_response(
-            client, input=[_.text if _.text else " " for _ in input_], **kwargs
-        ).dict()
-        output_ = sorted(resp["data"], key=lambda x: x["index"])
-        return [
-            DocumentWithEmbedding(embedding=o["embedding"], content=i)
-            for i, o in zip(input_, output_)
-        ]
+        input_, splitted_indices = self.prepare_request_input(input_doc)
+        semaphore = asyncio.Semaphore(max(self.max_concurrency, 1))
+
+        async def embed_batch(batch: tuple[int, int]) -> list[list[float]]:
+            async with semaphore:
+                async for attempt in AsyncRetrying(
+                    retry=retry_if_not_exception_type(
+                        (openai.NotFoundError, openai.BadRequestError)
+                    ),
+                    wait=wait_for_rate_limit(),
+                    stop=stop_after_attempt(6),
+                    reraise=True,
+                ):
+                    with attempt:
+                        resp = await self.openai_response(
+                            client, input=input_[batch[0] : batch[1]], **kwargs
+                        )
+            data = sorted(resp.dict()["data"], key=lambda x: x["index"])
+            return [_["embedding"] for _ in data]
+
+        outputs = await asyncio.gather(
+            *[embed_batch(batch) for batch in self.split_batches(input_)]
+        )
+        embeddings = [emb for output in outputs for emb in output]
+        return self.prepare_output(input_doc, input_, splitted_indices, embeddings)
 
 
 class OpenAIEmbeddings(BaseOpenAIEmbeddings):
@@ -179,7 +328,7 @@ class OpenAIEmbeddings(BaseOpenAIEmbeddings):
         retry=retry_if_not_exception_type(
             (openai.NotFoundError, openai.BadRequestError)
         ),
-        wait=wait_random_exponential(min=1, max=40),
+        wait=wait_for_rate_limit(),
         stop=stop_after_attempt(6),
     )
     def openai_response(self, client, **kwargs):
@@ -242,7 +391,7 @@ class AzureOpenAIEmbeddings(BaseOpenAIEmbeddings):
         retry=retry_if_not_exception_type(
             (openai.NotFoundError, openai.BadRequestError)
         ),
-        wait=wait_random_exponential(min=1, max=40),
+        wait=wait_for_rate_limit(),
         stop=stop_after_attempt(6),
     )
     def openai_response(self, client, **kwargs):
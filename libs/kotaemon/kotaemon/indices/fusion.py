@@ -0,0 +1,73 @@
+"""Merge the ranked results of several retrievers into a single ranking"""
+from typing import Optional, Sequence
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[str]],
+    weights: Optional[Sequence[float]] = None,
+    k: int = 60,
+) -> dict[str, float]:
+    """Fuse rankings with (weighted) Reciprocal Rank Fusion
+
+    Each ranking contributes `weight / (k + rank)` to the score of its ids, with
+    rank starting at 1. Only the ranks are used, so the retrievers' scores don't
+    need to be comparable.
+
+    Args:
+        rankings: the ids of each retriever, best first. Duplicated ids within a
+            ranking only count once, at their best rank
+        weights: the weight of each ranking, default to 1 for all
+        k: smoothing constant, the higher the less the top ranks dominate
+
+    Returns:
+        the fused score of every id
+    """
+    weights = weights if weights is not None else [1.0] * len(rankings)
+    scores: dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        seen = set()
+        for rank, id_ in enumerate(ranking, start=1):
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            scores[id_] = scores.get(id_, 0.0) + weight / (k + rank)
+    return scores
+
+
+def weighted_score_fusion(
+    scored_rankings: Sequence[Sequence[tuple[str, Optional[float]]]],
+    weights: Optional[Sequence[float]] = None,
+) -> dict[str, float]:
+    """Fuse rankings with the weighted sum of their min-max normalized scores
+
+    Rankings without scores (e.g. full-text search of docstores that don't expose
+    them) are given linearly decreasing scores from their ranks. An id missing
+    from a ranking gets 0 from it.
+
+    Args:
+        scored_rankings: the `(id, score)` of each retriever, best first. Set the
+            scores to None to use the ranks instead
+        weights: the weight of each ranking, default to 1 for all
+
+    Returns:
+        the fused score of every id
+    """
+    weights = weights if weights is not None else [1.0] * len(scored_rankings)
+    scores: dict[str, float] = {}
+    for ranking, weight in zip(scored_rankings, weights):
+        if not ranking:
+            continue
+        if any(score is None for _, score in ranking):
+            raw = [float(len(ranking) - rank) for rank in range(len(ranking))]
+        else:
+            raw = [float(score) for _, score in ranking]  # type: ignore[arg-type]
+
+        low, high = min(raw), max(raw)
+        normalized: dict[str, float] = {}
+        for (id_, _), value in zip(ranking, raw):
+            value = (value - low) / (high - low) if high > low else 1.0
+            normalized[id_] = max(normalized.get(id_, 0.0), value)
+
+        for id_, value in normalized.items():
+            scores[id_] = scores.get(id_, 0.0) + weight * value
+    return scores
@@ -5,6 +5,7 @@ import tiktoken
 
 from kotaemon.base import BaseComponent, Document, RetrievedDocument
 from kotaemon.indices.splitters import TokenSplitter
+from kotaemon.storages import resolve_blob_uri
 
 EVIDENCE_MODE_TEXT = 0
 EVIDENCE_MODE_TABLE = 1
@@ -83,7 +84,7 @@ class PrepareEvidencePipeline(BaseComponent):
                     + f"alt='{retrieved_caption}'/>"
                     + "\n<br>"
                 )
-                images.append(retrieved_content)
+                images.append(resolve_blob_uri(retrieved_content))
             else:
                 if "window" in retrieved_item.metadata:
                     retrieved_content = retrieved_item.metadata["window"]
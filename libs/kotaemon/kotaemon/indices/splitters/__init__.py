@@ -1,5 +1,17 @@
+from bisect import bisect_left
+from concurrent.futures import Executor
+from functools import lru_cache
+from typing import Optional
+
+from llama_index.core.schema import MetadataMode, NodeRelationship
+
+from kotaemon.base import Document, Param
+
 from ..base import DocTransformer, LlamaIndexDocTransformerMixin
 
+# tokens reserved for the formatting of the metadata, as in llama-index
+METADATA_FORMAT_LEN = 2
+
 
 class BaseSplitter(DocTransformer):
     """Represent base splitter class"""
@@ -47,3 +59,192 @@ class SentenceWindowSplitter(LlamaIndexDocTransformerMixin, BaseSplitter):
         from llama_index.core.node_parser import SentenceWindowNodeParser
 
         return SentenceWindowNodeParser
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(encoding_name: str):
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding_name)
+
+
+def _split_documents(config: dict, documents: list[Document]) -> list[Document]:
+    """Split documents in a worker process"""
+    return TiktokenSplitter(**config).split_documents(documents)
+
+
+class TiktokenSplitter(BaseSplitter):
+    """Split documents into chunks of at most `chunk_size` tiktoken tokens
+
+    Unlike `TokenSplitter`, each document is encoded once and the chunks are sliced
+    from its tokens, so the chunks are never re-tokenized. A chunk ends at the last
+    separator of its token window, trying `separator` then `backup_separators`,
+    as long as the chunk keeps at least half of the window. The number of tokens
+    of each chunk is stored in its metadata under `token_count_key`.
+
+    As with llama-index splitters, the chunks inherit the metadata of their
+    document, the tokens of which are reserved from the chunk size, and are linked
+    to their document and to each other.
+
+    Example:
+        splitter = TiktokenSplitter(chunk_size=512, chunk_overlap=64)
+        chunks = splitter(documents)
+        n_tokens = sum(chunk.metadata["token_count"] for chunk in chunks)
+    """
+
+    chunk_size: int = Param(1024, help="Maximum number of tokens of a chunk")
+    chunk_overlap: int = Param(20, help="Number of tokens shared by adjacent chunks")
+    separator: str = Param(" ", help="Preferred separator to end the chunks at")
+    backup_separators: list[str] = Param(
+        ["\n"], help="Separators to end the chunks at, if `separator` is not found"
+    )
+    encoding_name: str = Param("cl100k_base", help="Name of the tiktoken encoding")
+    token_count_key: str = Param(
+        "token_count", help="Metadata key of the number of tokens of the chunks"
+    )
+    executor: Optional[Executor] = Param(
+        None,
+        help="Executor (e.g. a process pool) to split large batches of documents "
+        "in. The documents are split in the current process if None",
+    )
+    min_chars_per_task: int = Param(
+        200_000, help="Minimum number of characters sent to each executor task"
+    )
+
+    def run(self, documents: list[Document], **kwargs) -> list[Document]:
+        tasks: list[list[Document]] = [[]]
+        n_chars = 0
+        for doc in documents:
+            if n_chars >= self.min_chars_per_task:
+                tasks.append([])
+                n_chars = 0
+            tasks[-1].append(doc)
+            n_chars += len(doc.text)
+
+        if self.executor is None or len(tasks) < 2:
+            return self.split_documents(documents)
+
+        config = {
+            name: getattr(self, name)
+            for name in (
+                "chunk_size",
+                "chunk_overlap",
+                "separator",
+                "backup_separators",
+                "encoding_name",
+                "token_count_key",
+            )
+        }
+        return [
+            chunk
+            for chunks in self.executor.map(
+                _split_documents, [config] * len(tasks), tasks
+            )
+            for chunk in chunks
+        ]
+
+    def split_documents(self, documents: list[Document]) -> list[Document]:
+        """Split the documents in the current process"""
+        encoding = _get_encoding(self.encoding_name)
+        all_tokens = encoding.encode_ordinary_batch([doc.text for doc in documents])
+
+        chunks = []
+        for doc, tokens in zip(documents, all_tokens):
+            chunks.extend(self._split_document(doc, tokens))
+        return chunks
+
+    def _split_document(self, doc: Document, tokens: list[int]) -> list[Document]:
+        if not tokens:
+            return []
+
+        encoding = _get_encoding(self.encoding_name)
+        metadata_str = max(
+            doc.get_metadata_str(mode=MetadataMode.EMBED),
+            doc.get_metadata_str(mode=MetadataMode.LLM),
+            key=len,
+        )
+        metadata_len = len(encoding.encode_ordinary(metadata_str)) + (
+            METADATA_FORMAT_LEN
+        )
+        chunk_size = self.chunk_size - metadata_len
+        if chunk_size <= 0:
+            raise ValueError(
+                f"Metadata length ({metadata_len}) is longer than chunk size "
+                f"({self.chunk_size}). Consider increasing the chunk size or "
+                "decreasing the size of your metadata to avoid this."
+            )
+
+        text = doc.text
+        # character offset of each token in the text, and of the end of the text
+        offsets = encoding.decode_with_offsets(tokens)[1] + [len(text)]
+
+        spans = []
+        start = 0
+        while start < len(tokens):
+            end = min(start + chunk_size, len(tokens))
+            if end < len(tokens):
+                end = self._find_chunk_end(text, offsets, start, end)
+            spans.append((start, end))
+            if end == len(tokens):
+                break
+            start = self._find_chunk_start(text, offsets, start, end)
+
+        source = {NodeRelationship.SOURCE: doc.as_related_node_info()}
+        chunks = []
+        for start, end in spans:
+            chunk_text = text[offsets[start] : offsets[end]].strip()
+            if not chunk_text:
+                continue
+            chunks.append(
+                Document(
+                    text=chunk_text,
+                    metadata={**doc.metadata, self.token_count_key: end - start},
+                    excluded_embed_metadata_keys=doc.excluded_embed_metadata_keys
+                    + [self.token_count_key],
+                    excluded_llm_metadata_keys=doc.excluded_llm_metadata_keys
+                    + [self.token_count_key],
+                    metadata_seperator=doc.metadata_seperator,
+                    metadata_template=doc.metadata_template,
+                    text_template=doc.text_template,
+                    relationships=dict(source),
+                )
+            )
+
+        for prev_chunk, next_chunk in zip(chunks, chunks[1:]):
+            prev_chunk.relationships[
+                NodeRelationship.NEXT
+            ] = next_chunk.as_related_node_info()
+            next_chunk.relationships[
+                NodeRelationship.PREVIOUS
+            ] = prev_chunk.as_related_node_info()
+
+        return chunks
+
+    def _find_chunk_end(
+        self, text: str, offsets: list[int], start: int, end: int
+    ) -> int:
+        """Move the end of the chunk back to the last separator of its window"""
+        min_end = start + max(1, (end - start) // 2)
+        for separator in [self.separator, *self.backup_separators]:
+            if not separator:
+                continue
+            position = text.rfind(separator, offsets[min_end], offsets[end])
+            if position < 0:
+                continue
+            # the first token after the separator
+            cut = bisect_left(offsets, position + len(separator), min_end, end)
+            if cut > start:
+                return cut
+        return end
+
+    def _find_chunk_start(
+        self, text: str, offsets: list[int], start: int, end: int
+    ) -> int:
+        """Start the next chunk `chunk_overlap` tokens before the end of the chunk,
+        at the beginning of a word"""
+        next_start = max(end - self.chunk_overlap, start + 1)
+        for token in range(next_start, end):
+            offset = offsets[token]
+            if text[offset].isspace() or text[offset - 1].isspace():
+                return token
+        return next_start
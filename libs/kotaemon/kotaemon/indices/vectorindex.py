@@ -9,9 +9,14 @@ from theflow.settings import settings as flowsettings
 
 from kotaemon.base import BaseComponent, Document, RetrievedDocument
 from kotaemon.embeddings import BaseEmbeddings
-from kotaemon.storages import BaseDocumentStore, BaseVectorStore
+from kotaemon.storages import (
+    BaseDocumentStore,
+    BaseVectorStore,
+    resolve_blob_uri,
+)
 
 from .base import BaseIndexing, BaseRetrieval
+from .fusion import reciprocal_rank_fusion, weighted_score_fusion
 from .rankings import BaseReranking, LLMReranking
 
 VECTOR_STORE_FNAME = "vectorstore"
@@ -63,7 +68,9 @@ class VectorIndexing(BaseIndexing):
                     markdown_content += f"\nSection: {section}"
                 if "type" in docs[i].metadata:
                     if docs[i].metadata["type"] == "image":
-                        image_origin = docs[i].metadata["image_origin"]
+                        image_origin = resolve_blob_uri(
+                            docs[i].metadata["image_origin"]
+                        )
                         image_origin = f'<p><img src="{image_origin}"></p>'
                         markdown_content += f"\nImage origin: {image_origin}"
                 if docs[i].text:
@@ -114,7 +121,14 @@ class VectorIndexing(BaseIndexing):
 
 
 class VectorRetrieval(BaseRetrieval):
-    """Retrieve list of documents from vector store"""
+    """Retrieve list of documents from vector store
+
+    In hybrid mode, the vector search and full-text search results are merged by
+    document id, and ranked with either Reciprocal Rank Fusion ("rrf") or the
+    weighted sum of the min-max normalized scores ("weighted"). The fused score is
+    stored in the `fusion_score` metadata, while `score` keeps the vector
+    similarity (-1.0 for documents only found by full-text search).
+    """
 
     vector_store: BaseVectorStore
     doc_store: Optional[BaseDocumentStore] = None
@@ -123,6 +137,114 @@ class VectorRetrieval(BaseRetrieval):
     top_k: int = 5
     first_round_top_k_mult: int = 10
     retrieval_mode: str = "hybrid"  # vector, text, hybrid
+    fusion_method: str = "rrf"  # rrf, weighted
+    rrf_k: int = 60
+    vector_weight: float = 0.5  # the full-text search weight is 1 - vector_weight
+    # maximum number of fused documents sent to the rerankers, None for no limit
+    max_rerank_candidates: Optional[int] = None
+
+    def _fuse(
+        self,
+        vs_ids: Sequence[str],
+        vs_scores: Sequence[float],
+        vs_docs: Sequence[Document],
+        ds_docs: Sequence[Document],
+    ) -> list[RetrievedDocument]:
+        """Merge the vector and full-text search results, best first"""
+        weights = [self.vector_weight, 1 - self.vector_weight]
+        # docstores don't necessarily return the documents in the requested order
+        vs_doc_by_id = {doc.doc_id: doc for doc in vs_docs}
+        vs_ranked = [
+            (vs_doc_by_id[id_], score)
+            for id_, score in zip(vs_ids, vs_scores)
+            if id_ in vs_doc_by_id
+        ]
+        vs_ranking = [doc.doc_id for doc, _ in vs_ranked]
+        vs_scores = [score for _, score in vs_ranked]
+        ds_ranking = [doc.doc_id for doc in ds_docs]
+        if self.fusion_method == "rrf":
+            fused = reciprocal_rank_fusion(
+                [vs_ranking, ds_ranking], weights=weights, k=self.rrf_k
+            )
+        elif self.fusion_method == "weighted":
+            fused = weighted_score_fusion(
+                [
+                    list(zip(vs_ranking, vs_scores)),
+                    [(id_, None) for id_ in ds_ranking],
+                ],
+                weights=weights,
+            )
+        else:
+            raise ValueError(f"Unknown fusion method: {self.fusion_method}")
+
+        # vector search results come first so that they keep their similarity
+        candidates: dict[str, RetrievedDocument] = {}
+        for doc, score in vs_ranked:
+            candidates.setdefault(
+                doc.doc_id, RetrievedDocument(**doc.to_dict(), score=score)
+            )
+        for doc in ds_docs:
+            candidates.setdefault(
+                doc.doc_id, RetrievedDocument(**doc.to_dict(), score=-1.0)
+            )
+
+        for id_, doc in candidates.items():
+            doc.metadata["fusion_score"] = fused[id_]
+        return sorted(
+            candidates.values(),
+            key=lambda doc: doc.metadata["fusion_score"],
+            reverse=True,
+        )
+
+    def _query_vectorstore(
+        self,
+        embedding: list[float],
+        top_k: int,
+        scope: Optional[list[str]] = None,
+        scope_file_ids: Optional[list[str]] = None,
+        **kwargs,
+    ) -> tuple[list[float], list[str]]:
+        """Similarity search, restricted to the `scope` documents
+
+        Unless `scope_file_ids` is given, in which case the filters of the vector
+        store match the scope exactly, the filters may match more documents than
+        the scope (e.g. those of the file that a duplicate file shares its chunks
+        with). These are dropped from the results, and the search is widened
+        until it finds `top_k` documents of the scope or exhausts the store.
+        """
+        if not scope or scope_file_ids:
+            _, scores, ids = self.vector_store.query(
+                embedding=embedding, top_k=top_k, **kwargs
+            )
+            return scores, ids
+
+        in_scope = set(scope)
+        fetch_k = top_k * 2
+        while True:
+            _, scores, ids = self.vector_store.query(
+                embedding=embedding, top_k=fetch_k, **kwargs
+            )
+            kept = [
+                (score, id_) for score, id_ in zip(scores, ids) if id_ in in_scope
+            ][:top_k]
+            if len(kept) >= top_k or len(ids) < fetch_k:
+                break
+            fetch_k *= 2
+        return [score for score, _ in kept], [id_ for _, id_ in kept]
+
+    def _query_docstore(
+        self,
+        query: str,
+        top_k: int,
+        scope: list[str],
+        scope_file_ids: Optional[list[str]] = None,
+    ) -> list[Document]:
+        """Full-text search among the `scope` documents, or the chunks of the
+        `scope_file_ids` files when given"""
+        assert self.doc_store is not None
+        if scope_file_ids:
+            return self.doc_store.query(query, top_k=top_k, file_ids=scope_file_ids)
+        return self.doc_store.query(query, top_k=top_k, doc_ids=scope)
 
     def _filter_docs(
         self, documents: list[RetrievedDocument], top_k: int | None = None
@@ -163,12 +285,13 @@ class VectorRetrieval(BaseRetrieval):
         result: list[RetrievedDocument] = []
         # TODO: should declare scope directly in the run params
         scope = kwargs.pop("scope", None)
+        scope_file_ids = kwargs.pop("scope_file_ids", None)
         emb: list[float]
 
         if self.retrieval_mode == "vector":
             emb = self.embedding(text)[0].embedding
-            _, scores, ids = self.vector_store.query(
-                embedding=emb, top_k=top_k_first_round, **kwargs
+            scores, ids = self._query_vectorstore(
+                emb, top_k_first_round, scope, scope_file_ids, **kwargs
             )
             docs = self.doc_store.get(ids)
             result = [
@@ -179,8 +302,8 @@ class VectorRetrieval(BaseRetrieval):
             query = text.text if isinstance(text, Document) else text
             docs = []
             if scope:
-                docs = self.doc_store.query(
-                    query, top_k=top_k_first_round, doc_ids=scope
+                docs = self._query_docstore(
+                    query, top_k_first_round, scope, scope_file_ids
                 )
             result = [RetrievedDocument(**doc.to_dict(), score=-1.0) for doc in docs]
         elif self.retrieval_mode == "hybrid":
@@ -196,8 +319,8 @@ class VectorRetrieval(BaseRetrieval):
                 nonlocal vs_ids
 
                 assert self.doc_store is not None
-                _, vs_scores, vs_ids = self.vector_store.query(
-                    embedding=emb, top_k=top_k_first_round, **kwargs
+                vs_scores, vs_ids = self._query_vectorstore(
+                    emb, top_k_first_round, scope, scope_file_ids, **kwargs
                 )
                 if vs_ids:
                     vs_docs = self.doc_store.get(vs_ids)
@@ -211,8 +334,8 @@ class VectorRetrieval(BaseRetrieval):
                 assert self.doc_store is not None
                 query = text.text if isinstance(text, Document) else text
                 if scope:
-                    ds_docs = self.doc_store.query(
-                        query, top_k=top_k_first_round, doc_ids=scope
+                    ds_docs = self._query_docstore(
+                        query, top_k_first_round, scope, scope_file_ids
                     )
 
             vs_query_thread = threading.Thread(target=query_vectorstore)
@@ -224,17 +347,13 @@ class VectorRetrieval(BaseRetrieval):
             vs_query_thread.join()
             ds_query_thread.join()
 
-            result = [
-                RetrievedDocument(**doc.to_dict(), score=-1.0)
-                for doc in ds_docs
-                if doc not in vs_ids
-            ]
-            result += [
-                RetrievedDocument(**doc.to_dict(), score=score)
-                for doc, score in zip(vs_docs, vs_scores)
-            ]
+            result = self._fuse(vs_ids, vs_scores, vs_docs, ds_docs)
             print(f"Got {len(vs_docs)} from vectorstore")
             print(f"Got {len(ds_docs)} from docstore")
+            print(f"Got {len(result)} after fusion")
+
+        if self.rerankers and text and self.max_rerank_candidates:
+            result = self._filter_docs(result, top_k=self.max_rerank_candidates)
 
         # use additional reranker to re-order the document list
         if self.rerankers and text:
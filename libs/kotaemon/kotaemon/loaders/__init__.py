@@ -1,6 +1,7 @@
 from .adobe_loader import AdobeReader
 from .azureai_document_intelligence_loader import AzureAIDocumentIntelligenceLoader
 from .base import AutoReader, BaseReader
+from .cache import CachedReader
 from .composite_loader import DirectoryReader
 from .docling_loader import DoclingReader
 from .docx_loader import DocxReader
@@ -17,6 +18,7 @@ __all__ = [
     "AutoReader",
     "AzureAIDocumentIntelligenceLoader",
     "BaseReader",
+    "CachedReader",
     "PandasExcelReader",
     "ExcelReader",
     "MathpixPDFReader",
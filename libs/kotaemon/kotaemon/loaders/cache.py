@@ -0,0 +1,306 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from kotaemon.base import Document, Param
+
+from .base import BaseReader
+
+# params that do not affect the parsed documents
+_VOLATILE_PARAMS = {
+    "timeout",
+    "max_retries",
+    "request_timeout",
+    "cache_dir",
+    "n_workers",
+    "max_workers",
+}
+_SECRET_PARAM_MARKERS = ("key", "token", "credential", "secret", "password")
+
+
+def get_loader_identity(loader: Any) -> str:
+    """Build a stable identity string for a loader
+
+    The identity is made of the loader class and the params that influence the
+    parsed documents. Credentials, transport-related params and derived objects
+    (e.g. API clients, whose names end with "_") are excluded.
+
+    Args:
+        loader: the loader, a kotaemon or a llama-index reader
+
+    Returns:
+        the identity string
+    """
+    params: dict = {}
+    if hasattr(loader, "dump"):
+        try:
+            params = loader.dump(strict=False).get("params", {})
+        except Exception:
+            params = {}
+    else:
+        params = dict(vars(loader))
+
+    identity_params = {}
+    for key, value in params.items():
+        if (
+            key.startswith("_")
+            or key.endswith("_")
+            or key in _VOLATILE_PARAMS
+            or any(marker in key.lower() for marker in _SECRET_PARAM_MARKERS)
+        ):
+            continue
+        encoded = json.dumps(value, sort_keys=True, default=str)
+        # the default repr of objects changes across processes
+        if " object at 0x" in encoded:
+            continue
+        identity_params[key] = json.loads(encoded)
+
+    cls = loader.__class__
+    return (
+        f"{cls.__module__}.{cls.__qualname__}:"
+        f"{json.dumps(identity_params, sort_keys=True)}"
+    )
+
+
+def get_file_hash(file_path: str | Path) -> str:
+    """Compute the sha256 of the content of a file"""
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class ParseCache:
+    """Persistent store of the documents parsed from files
+
+    Each parse result is keyed by sha256(loader identity + file sha256), so a file
+    parsed again by the same loader with the same params is only parsed once. The
+    documents are stored as zlib-compressed JSON in a SQLite database, and evicted
+    in least-recently-used order once the cache grows above `max_entries`.
+
+    Args:
+        path: path to the SQLite database file. Use ":memory:" for a
+            non-persistent cache.
+        max_entries: maximum number of parsed files to keep. 0 or None to disable
+            eviction.
+    """
+
+    def __init__(self, path: str | Path, max_entries: Optional[int] = 10_000):
+        self._path = str(path)
+        if self._path != ":memory:":
+            Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._last_access = 0.0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self._path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parses ("
+            "key TEXT PRIMARY KEY, docs BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS parses_last_access ON parses (last_access)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(loader_identity: str, file_hash: str) -> str:
+        """Compute the cache key of a file for a given loader"""
+        hasher = hashlib.sha256(loader_identity.encode("utf-8"))
+        hasher.update(b"\x00")
+        hasher.update(file_hash.encode("utf-8"))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def dumps(docs: list[Document], exclude_metadata: Iterable[str] = ()) -> bytes:
+        exclude_metadata = set(exclude_metadata)
+        items = []
+        for doc in docs:
+            metadata = {
+                key: value
+                for key, value in doc.metadata.items()
+                if key not in exclude_metadata
+            }
+            item: dict = {"text": doc.text, "metadata": metadata}
+            if doc.excluded_embed_metadata_keys:
+                item["excluded_embed"] = doc.excluded_embed_metadata_keys
+            if doc.excluded_llm_metadata_keys:
+                item["excluded_llm"] = doc.excluded_llm_metadata_keys
+            items.append(item)
+        return zlib.compress(json.dumps(items, default=str).encode("utf-8"))
+
+    @staticmethod
+    def loads(data: bytes) -> list[Document]:
+        return [
+            Document(
+                text=item["text"],
+                metadata=item["metadata"],
+                excluded_embed_metadata_keys=item.get("excluded_embed", []),
+                excluded_llm_metadata_keys=item.get("excluded_llm", []),
+            )
+            for item in json.loads(zlib.decompress(data).decode("utf-8"))
+        ]
+
+    def _now(self) -> float:
+        """Strictly increasing timestamp, so that the LRU order is never ambiguous"""
+        self._last_access = max(time.time(), self._last_access + 1e-6)
+        return self._last_access
+
+    def get(self, key: str) -> Optional[list[Document]]:
+        """Get the cached documents, None if they are not cached"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT docs FROM parses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE parses SET last_access = ? WHERE key = ?", (self._now(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+
+        return self.loads(row[0])
+
+    def put(self, key: str, docs: list[Document], exclude_metadata: Iterable[str] = ()):
+        """Store the documents, evicting the least recently used ones if needed
+
+        Args:
+            key: the cache key
+            docs: the parsed documents
+            exclude_metadata: the metadata keys that are not stored
+        """
+        data = self.dumps(docs, exclude_metadata)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parses (key, docs, last_access) "
+                "VALUES (?, ?, ?)",
+                (key, data, self._now()),
+            )
+            if self.max_entries:
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM parses").fetchone()
+                if count > self.max_entries:
+                    self._conn.execute(
+                        "DELETE FROM parses WHERE key IN ("
+                        "SELECT key FROM parses ORDER BY last_access ASC LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+            self._conn.commit()
+
+    def count(self) -> int:
+        """Number of cached parse results"""
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM parses").fetchone()
+        return count
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this cache instance"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.count(),
+        }
+
+    def clear(self):
+        """Remove all cached parse results and reset the counters"""
+        with self._lock:
+            self._conn.execute("DELETE FROM parses")
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+
+_caches: dict[tuple[str, Optional[int]], ParseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_parse_cache(
+    path: str | Path, max_entries: Optional[int] = 10_000
+) -> ParseCache:
+    """Get the parse cache at `path`, shared across the whole process
+
+    In-memory caches are never shared.
+    """
+    if str(path) == ":memory:":
+        return ParseCache(path, max_entries=max_entries)
+
+    key = (str(Path(path).resolve()), max_entries)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ParseCache(path, max_entries=max_entries)
+        return _caches[key]
+
+
+class CachedReader(BaseReader):
+    """Wrap a loader with a persistent cache of the parsed documents
+
+    On a hit, the wrapped loader is not called. The metadata given with
+    `extra_info` (e.g. file path, file id) is not cached, but set again from the
+    current call. Only local files are cached, URLs are always loaded.
+
+    Example:
+        reader = CachedReader(
+            loader=DoclingReader(),
+            cache_path="ktem_app_data/parse_cache.db",
+        )
+    """
+
+    loader: Any = Param(help="The wrapped loader")
+    cache_path: str = Param(
+        ":memory:", help="Path to the cache database, ':memory:' to not persist"
+    )
+    max_entries: Optional[int] = Param(
+        10_000, help="Maximum number of cached files. 0 to disable eviction"
+    )
+
+    @Param.auto(depends_on=["cache_path", "max_entries"])
+    def cache_(self) -> ParseCache:
+        return get_parse_cache(self.cache_path, max_entries=self.max_entries)
+
+    def load_data(
+        self, file_path: str | Path, extra_info: Optional[dict] = None, **kwargs
+    ) -> list[Document]:
+        # `get_from_path` since `self.loader` is a tracking wrapper during run
+        loader = self.get_from_path("loader")
+        if not Path(file_path).is_file():
+            return loader.load_data(file_path, extra_info=extra_info, **kwargs)
+
+        loader_identity = get_loader_identity(loader)
+        if kwargs:
+            loader_identity += json.dumps(kwargs, sort_keys=True, default=str)
+        key = ParseCache.make_key(loader_identity, get_file_hash(file_path))
+        extra_info = extra_info or {}
+
+        docs = self.cache_.get(key)
+        if docs is None:
+            docs = loader.load_data(file_path, extra_info=extra_info, **kwargs)
+            # empty results may come from transient failures, they are not cached
+            if docs:
+                self.cache_.put(key, docs, exclude_metadata=extra_info)
+            return docs
+
+        for doc in docs:
+            doc.metadata.update(extra_info)
+        return docs
+
+    def run(
+        self, file_path: str | Path, extra_info: Optional[dict] = None, **kwargs
+    ) -> list[Document]:
+        return self.load_data(file_path, extra_info=extra_info, **kwargs)
+
+    def stats(self) -> dict:
+        """Hit/miss counters of the underlying cache"""
+        return self.cache_.stats()
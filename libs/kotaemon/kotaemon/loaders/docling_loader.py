@@ -8,7 +8,7 @@ from kotaemon.base import Document, Param
 
 from .azureai_document_intelligence_loader import crop_image
 from .base import BaseReader
-from .utils.adobe import generate_single_figure_caption, make_markdown_table
+from .utils.adobe import generate_figure_captions, make_markdown_table
 
 
 class DoclingReader(BaseReader):
@@ -69,8 +69,9 @@ class DoclingReader(BaseReader):
         file_name = file_path.name
 
         # extract the figures
-        figures = []
-        gen_caption_count = 0
+        figure_metadatas = []
+        figure_images = []
+        figure_extractive_captions = []
         for figure_obj in result_dict.get("pictures", []):
             if not self.vlm_endpoint:
                 continue
@@ -118,18 +119,6 @@ class DoclingReader(BaseReader):
             img_base64 = base64.b64encode(img_bytes.getvalue()).decode("utf-8")
             img_base64 = f"data:image/png;base64,{img_base64}"
 
-            # generate the generative caption
-            if gen_caption_count >= self.max_figure_to_caption:
-                gen_caption = ""
-            else:
-                gen_caption_count += 1
-                gen_caption = generate_single_figure_caption(
-                    img_base64, self.vlm_endpoint
-                )
-
-            # join the extractive and generative captions
-            caption = "\n".join(extractive_captions + [gen_caption])
-
             # store the image into document
             figure_metadata = {
                 "image_origin": img_base64,
@@ -140,12 +129,24 @@ class DoclingReader(BaseReader):
             }
             figure_metadata.update(metadata)
 
-            figures.append(
-                Document(
-                    text=caption,
-                    metadata=figure_metadata,
-                )
+            figure_metadatas.append(figure_metadata)
+            figure_images.append(img_base64)
+            figure_extractive_captions.append(extractive_captions)
+
+        # generate the generative captions, concurrently
+        gen_captions = generate_figure_captions(
+            self.vlm_endpoint, figure_images, self.max_figure_to_caption
+        )
+        figures = [
+            Document(
+                # join the extractive and generative captions
+                text="\n".join(extractive_captions + [gen_caption]),
+                metadata=figure_metadata,
             )
+            for figure_metadata, extractive_captions, gen_caption in zip(
+                figure_metadatas, figure_extractive_captions, gen_captions
+            )
+        ]
 
         # extract the tables
         tables = []
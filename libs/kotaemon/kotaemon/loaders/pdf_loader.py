@@ -1,69 +1,208 @@
 import base64
+import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
 from io import BytesIO
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 
 from decouple import config
 from fsspec import AbstractFileSystem
+from llama_index.core.readers.file.base import get_default_fs
 from llama_index.readers.file import PDFReader
 from PIL import Image
+from theflow.settings import settings as flowsettings
 
 from kotaemon.base import Document
+from kotaemon.storages.blobstore import register_uri_resolver
+
+logger = logging.getLogger(__name__)
 
 PDF_LOADER_DPI = config("PDF_LOADER_DPI", default=40, cast=int)
+# png, jpeg or webp
+PDF_THUMBNAIL_FORMAT = config("PDF_THUMBNAIL_FORMAT", default="png")
+PDF_THUMBNAIL_QUALITY = config("PDF_THUMBNAIL_QUALITY", default=80, cast=int)
+# maximum width or height in pixels, 0 for no limit
+PDF_THUMBNAIL_MAX_SIZE = config("PDF_THUMBNAIL_MAX_SIZE", default=0, cast=int)
+PDF_THUMBNAIL_WORKERS = config(
+    "PDF_THUMBNAIL_WORKERS", default=min(4, os.cpu_count() or 1), cast=int
+)
+PDF_THUMBNAIL_PAGES_PER_TASK = 32
+
+# reference to a page thumbnail rendered when first viewed
+PDF_PAGE_URI_PREFIX = "kh-pdf-page://"
+_PDF_PAGE_URI_PATTERN = re.compile(
+    re.escape(PDF_PAGE_URI_PREFIX) + r"([0-9a-f]{64})/(\d+)"
+)
 
 
 def get_page_thumbnails(
-    file_path: Path, pages: list[int], dpi: int = PDF_LOADER_DPI
-) -> List[Image.Image]:
+    file_path: Path,
+    pages: list[int],
+    dpi: int = PDF_LOADER_DPI,
+    image_format: str = PDF_THUMBNAIL_FORMAT,
+    quality: int = PDF_THUMBNAIL_QUALITY,
+    max_size: int = PDF_THUMBNAIL_MAX_SIZE,
+    n_workers: int = PDF_THUMBNAIL_WORKERS,
+) -> List[str]:
     """Get image thumbnails of the pages in the PDF file.
 
+    Large documents are rendered by ranges of pages in a process pool.
+
     Args:
         file_path (Path): path to the image file
-        page_number (list[int]): list of page numbers to extract
+        pages (list[int]): list of page numbers to extract
+        dpi (int): resolution of the thumbnails
+        image_format (str): png, jpeg or webp
+        quality (int): quality of the jpeg and webp thumbnails, from 1 to 100
+        max_size (int): maximum width or height in pixels, 0 for no limit
+        n_workers (int): number of rendering processes
 
     Returns:
-        list[Image.Image]: list of page thumbnails
+        list[str]: list of page thumbnails, as base64 data URIs
     """
-
-    img: Image.Image
     suffix = file_path.suffix.lower()
     assert suffix == ".pdf", "This function only supports PDF files."
+
+    page_ranges = [
+        pages[idx : idx + PDF_THUMBNAIL_PAGES_PER_TASK]
+        for idx in range(0, len(pages), PDF_THUMBNAIL_PAGES_PER_TASK)
+    ]
+    if n_workers > 1 and len(page_ranges) > 1:
+        try:
+            with ProcessPoolExecutor(
+                max_workers=min(n_workers, len(page_ranges))
+            ) as executor:
+                results = executor.map(
+                    render_page_thumbnails,
+                    repeat(file_path),
+                    page_ranges,
+                    repeat(dpi),
+                    repeat(image_format),
+                    repeat(quality),
+                    repeat(max_size),
+                )
+                return [thumbnail for result in results for thumbnail in result]
+        except Exception as e:
+            logger.warning(f"Cannot render the thumbnails in parallel: {e}")
+
+    return render_page_thumbnails(
+        file_path, pages, dpi, image_format, quality, max_size
+    )
+
+
+def render_page_thumbnails(
+    file_path: Path,
+    pages: list[int],
+    dpi: int = PDF_LOADER_DPI,
+    image_format: str = PDF_THUMBNAIL_FORMAT,
+    quality: int = PDF_THUMBNAIL_QUALITY,
+    max_size: int = PDF_THUMBNAIL_MAX_SIZE,
+) -> List[str]:
+    """Render the pages in the current process, see `get_page_thumbnails`"""
     try:
         import fitz
     except ImportError:
         raise ImportError("Please install PyMuPDF: 'pip install PyMuPDF'")
 
-    doc = fitz.open(file_path)
-
     output_imgs = []
-    for page_number in pages:
-        page = doc.load_page(page_number)
-        pm = page.get_pixmap(dpi=dpi)
-        img = Image.frombytes("RGB", [pm.width, pm.height], pm.samples)
-        output_imgs.append(convert_image_to_base64(img))
+    with fitz.open(file_path) as doc:
+        for page_number in pages:
+            page = doc.load_page(page_number)
+            zoom = dpi / 72
+            if max_size:
+                zoom = min(zoom, max_size / max(page.rect.width, page.rect.height))
+            pm = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            img = Image.frombytes("RGB", (pm.width, pm.height), pm.samples)
+            output_imgs.append(convert_image_to_base64(img, image_format, quality))
 
     return output_imgs
 
 
-def convert_image_to_base64(img: Image.Image) -> str:
+def convert_image_to_base64(
+    img: Image.Image, image_format: str = "png", quality: int = PDF_THUMBNAIL_QUALITY
+) -> str:
     # convert the image into base64
+    image_format = image_format.lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+
     img_bytes = BytesIO()
-    img.save(img_bytes, format="PNG")
+    if image_format in ("jpeg", "webp"):
+        img.save(img_bytes, format=image_format.upper(), quality=quality)
+    else:
+        img.save(img_bytes, format=image_format.upper())
     img_base64 = base64.b64encode(img_bytes.getvalue()).decode("utf-8")
-    img_base64 = f"data:image/png;base64,{img_base64}"
+    img_base64 = f"data:image/{image_format};base64,{img_base64}"
 
     return img_base64
 
 
+def _find_stored_pdf(file_hash: str) -> Optional[Path]:
+    """Find the PDF stored under its sha256 in the file storage"""
+    root = getattr(flowsettings, "KH_FILESTORAGE_PATH", None)
+    if not root:
+        return None
+    # the files of each index are stored in their own folder
+    for file_path in (Path(root) / file_hash, *Path(root).glob(f"*/{file_hash}")):
+        if file_path.is_file():
+            return file_path
+    return None
+
+
+@lru_cache(maxsize=256)
+def render_page_uri(uri: str) -> str:
+    """Render the page thumbnail referenced by a deferred thumbnail URI"""
+    match = _PDF_PAGE_URI_PATTERN.fullmatch(uri)
+    if not match:
+        raise ValueError(f"Invalid page URI: {uri}")
+    file_hash, page_number = match.groups()
+    file_path = _find_stored_pdf(file_hash)
+    if file_path is None:
+        raise FileNotFoundError(f"No stored PDF with hash {file_hash}")
+
+    # the stored files have no extension, render_page_thumbnails doesn't check it
+    return render_page_thumbnails(file_path, [int(page_number)])[0]
+
+
+register_uri_resolver(PDF_PAGE_URI_PREFIX, render_page_uri)
+
+
 class PDFThumbnailReader(PDFReader):
     """PDF parser with thumbnail for each page."""
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        thumbnail_mode: str = "eager",
+        image_format: str = PDF_THUMBNAIL_FORMAT,
+        quality: int = PDF_THUMBNAIL_QUALITY,
+        max_size: int = PDF_THUMBNAIL_MAX_SIZE,
+        n_workers: int = PDF_THUMBNAIL_WORKERS,
+    ) -> None:
         """
         Initialize PDFReader.
+
+        Args:
+            thumbnail_mode: "eager" to render the thumbnails when loading, "deferred"
+                to render them when first viewed, "none" to skip them
+            image_format: png, jpeg or webp
+            quality: quality of the jpeg and webp thumbnails, from 1 to 100
+            max_size: maximum width or height of the thumbnails, 0 for no limit
+            n_workers: number of rendering processes
         """
         super().__init__(return_full_document=False)
+        if thumbnail_mode not in ("eager", "deferred", "none"):
+            raise ValueError(f"Invalid thumbnail mode: {thumbnail_mode}")
+        self.thumbnail_mode = thumbnail_mode
+        self.image_format = image_format
+        self.quality = quality
+        self.max_size = max_size
+        self.n_workers = n_workers
 
     def load_data(
         self,
@@ -94,7 +233,24 @@ class PDFThumbnailReader(PDFReader):
         page_numbers = list(range(len(page_numbers_str)))
 
         print("Page numbers:", len(page_numbers))
-        page_thumbnails = get_page_thumbnails(file, page_numbers)
+        if self.thumbnail_mode == "none":
+            return documents
+        elif self.thumbnail_mode == "deferred":
+            # the file storage keeps the files under their sha256
+            file_hash = sha256(Path(file).read_bytes()).hexdigest()
+            page_thumbnails = [
+                f"{PDF_PAGE_URI_PREFIX}{file_hash}/{page_number}"
+                for page_number in page_numbers
+            ]
+        else:
+            page_thumbnails = get_page_thumbnails(
+                Path(file),
+                page_numbers,
+                image_format=self.image_format,
+                quality=self.quality,
+                max_size=self.max_size,
+                n_workers=self.n_workers,
+            )
 
         documents.extend(
             [
@@ -115,3 +271,103 @@ class PDFThumbnailReader(PDFReader):
         )
 
         return documents
+
+    def lazy_load_data(
+        self,
+        file: Path,
+        extra_info: Optional[Dict] = None,
+        fs: Optional[AbstractFileSystem] = None,
+    ) -> Iterator[Document]:
+        """Parse the file page by page, yielding the thumbnail of each page before
+        its text. Only a few ranges of pages are rendered ahead, so the memory does
+        not grow with the number of pages.
+        """
+        try:
+            import pypdf
+        except ImportError:
+            raise ImportError(
+                "pypdf is required to read PDF files: `pip install pypdf`"
+            )
+
+        file = Path(file)
+        extra_info = extra_info or {}
+        fs = fs or get_default_fs()
+        with fs.open(str(file), "rb") as fp:
+            pdf = pypdf.PdfReader(fp)
+            n_pages = len(pdf.pages)
+            page_ranges = [
+                list(range(idx, min(idx + PDF_THUMBNAIL_PAGES_PER_TASK, n_pages)))
+                for idx in range(0, n_pages, PDF_THUMBNAIL_PAGES_PER_TASK)
+            ]
+            thumbnails = self._iter_thumbnails(file, page_ranges)
+            for pages, page_thumbnails in zip(page_ranges, thumbnails):
+                for page_number, page_thumbnail in zip(pages, page_thumbnails):
+                    page_label = pdf.page_labels[page_number]
+                    try:
+                        int(page_label)
+                    except ValueError:
+                        continue
+
+                    if page_thumbnail is not None:
+                        yield Document(
+                            text="Page thumbnail",
+                            metadata={
+                                "image_origin": page_thumbnail,
+                                "type": "thumbnail",
+                                "page_label": page_label,
+                                **extra_info,
+                            },
+                        )
+                    yield Document(
+                        text=pdf.pages[page_number].extract_text(),
+                        metadata={
+                            "page_label": page_label,
+                            "file_name": file.name,
+                            **extra_info,
+                        },
+                    )
+
+    def _iter_thumbnails(
+        self, file: Path, page_ranges: list[list[int]]
+    ) -> Iterator[list[Optional[str]]]:
+        """Yield the thumbnails of each range of pages, rendering at most
+        `n_workers` ranges ahead
+        """
+        if self.thumbnail_mode == "none":
+            for pages in page_ranges:
+                yield [None] * len(pages)
+            return
+
+        if self.thumbnail_mode == "deferred":
+            file_hash = sha256(file.read_bytes()).hexdigest()
+            for pages in page_ranges:
+                yield [f"{PDF_PAGE_URI_PREFIX}{file_hash}/{page}" for page in pages]
+            return
+
+        render_args = (PDF_LOADER_DPI, self.image_format, self.quality, self.max_size)
+        n_rendered = 0
+        if self.n_workers > 1 and len(page_ranges) > 1:
+            try:
+                with ProcessPoolExecutor(
+                    max_workers=min(self.n_workers, len(page_ranges))
+                ) as executor:
+                    futures: deque = deque()
+                    for pages in page_ranges:
+                        futures.append(
+                            executor.submit(
+                                render_page_thumbnails, file, pages, *render_args
+                            )
+                        )
+                        if len(futures) == self.n_workers:
+                            thumbnails = futures.popleft().result()
+                            n_rendered += 1
+                            yield thumbnails
+                    while futures:
+                        thumbnails = futures.popleft().result()
+                        n_rendered += 1
+                        yield thumbnails
+            except Exception as e:
+                logger.warning(f"Cannot render the thumbnails in parallel: {e}")
+
+        for pages in page_ranges[n_rendered:]:
+            yield render_page_thumbnails(file, pages, *render_args)
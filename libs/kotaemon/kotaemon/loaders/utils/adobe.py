@@ -1,19 +1,23 @@
 # need pip install pdfservices-sdk==2.3.0
 
 import base64
+import hashlib
 import json
 import logging
 import os
 import tempfile
+import threading
 import zipfile
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import List, Union
 
 import pandas as pd
 from decouple import config
 
-from kotaemon.loaders.utils.gpt4v import generate_gpt4v
+from kotaemon.loaders.utils.gpt4v import VLM_MAX_CONCURRENCY, generate_gpt4v
 
 
 def request_adobe_service(file_path: str, output_path: str = "") -> str:
@@ -202,34 +206,67 @@ def parse_figure_paths(file_paths: List[Path]) -> Union[bytes, str]:
     return content
 
 
-def generate_single_figure_caption(vlm_endpoint: str, figure: str) -> str:
+FIGURE_CAPTION_PROMPT = "Provide a short 2 sentence summary of this image?"
+# number of figure captions kept in memory, so that repeated figures (e.g. logos)
+# are captioned once
+VLM_CAPTION_CACHE_SIZE = config("VLM_CAPTION_CACHE_SIZE", default=1024, cast=int)
+
+_caption_cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+_caption_cache_lock = threading.Lock()
+
+
+def _caption_cache_key(vlm_endpoint: str, figure: str, prompt: str):
+    return vlm_endpoint, hashlib.sha256(figure.encode()).hexdigest(), prompt
+
+
+def generate_single_figure_caption(
+    vlm_endpoint: str, figure: str, prompt: str = FIGURE_CAPTION_PROMPT
+) -> str:
+    """Summarize a single figure using GPT-4V, reusing the cached captions"""
     output = ""
+    if not figure:
+        return output
 
-    """Summarize a single figure using GPT-4V"""
-    if figure:
-        try:
-            output = generate_gpt4v(
-                endpoint=vlm_endpoint,
-                prompt="Provide a short 2 sentence summary of this image?",
-                images=figure,
-            )
-            if "sorry" in output.lower():
-                output = ""
-        except Exception as e:
-            print(f"Error generating caption: {e}")
+    key = _caption_cache_key(vlm_endpoint, figure, prompt)
+    with _caption_cache_lock:
+        if key in _caption_cache:
+            _caption_cache.move_to_end(key)
+            return _caption_cache[key]
+
+    try:
+        output = generate_gpt4v(endpoint=vlm_endpoint, prompt=prompt, images=figure)
+        if "sorry" in output.lower():
+            output = ""
+    except Exception as e:
+        print(f"Error generating caption: {e}")
+        return output
+
+    # failed requests return an empty caption, they are not cached
+    if output and VLM_CAPTION_CACHE_SIZE > 0:
+        with _caption_cache_lock:
+            _caption_cache[key] = output
+            while len(_caption_cache) > VLM_CAPTION_CACHE_SIZE:
+                _caption_cache.popitem(last=False)
 
     return output
 
 
 def generate_figure_captions(
-    vlm_endpoint: str, figures: List, max_figures_to_process: int
+    vlm_endpoint: str,
+    figures: List,
+    max_figures_to_process: int,
+    max_workers: int = VLM_MAX_CONCURRENCY,
 ) -> List:
     """Summarize several figures using GPT-4V.
+
+    The figures are captioned concurrently, identical figures only once.
+
     Args:
         vlm_endpoint (str): endpoint to the vision language model service
         figures (List): list of base64 images
         max_figures_to_process (int): the maximum number of figures will be summarized,
         the rest are ignored.
+        max_workers (int): the maximum number of concurrent requests
 
     Returns:
         results (List[str]): list of all figure captions and empty strings for
@@ -238,13 +275,17 @@ def generate_figure_captions(
     to_gen_figures = figures[:max_figures_to_process]
     other_figures = figures[max_figures_to_process:]
 
-    with ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(
-                lambda: generate_single_figure_caption(vlm_endpoint, figure)
+    unique_figures = list(dict.fromkeys(figure for figure in to_gen_figures))
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        captions = dict(
+            zip(
+                unique_figures,
+                executor.map(
+                    partial(generate_single_figure_caption, vlm_endpoint),
+                    unique_figures,
+                ),
             )
-            for figure in to_gen_figures
-        ]
+        )
 
-    results = [future.result() for future in futures]
+    results = [captions[figure] for figure in to_gen_figures]
     return results + [""] * len(other_figures)
@@ -1,4 +1,7 @@
-from typing import List, Tuple
+from collections import defaultdict
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
 
 
 def bbox_to_points(box: List[int]):
@@ -103,6 +106,129 @@ def get_rect_iou(gt_box: List[tuple], pd_box: List[tuple], iou_type=0) -> int:
     return iou
 
 
+def get_rect_iou_many(
+    box: List[tuple], boxes: np.ndarray, iou_type: int = 0
+) -> np.ndarray:
+    """Vectorized `get_rect_iou` of a box against many boxes
+
+    Args:
+        box: the box as a list of points [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+        boxes: array of shape (n, 4) of the other boxes as (x1, y1, x2, y2)
+        iou_type: 0 for intersection / union, 1 for intersection / min(areas)
+
+    Returns:
+        array of the n IOU values
+    """
+    assert iou_type in [0, 1], "Only support 0: origin iou, 1: intersection / min(area)"
+
+    (x1, y1), (x2, y2) = box[0], box[2]
+    x_left = np.maximum(x1, boxes[:, 0])
+    y_top = np.maximum(y1, boxes[:, 1])
+    x_right = np.minimum(x2, boxes[:, 2])
+    y_bottom = np.minimum(y2, boxes[:, 3])
+    inter_area = np.maximum(0, x_right - x_left) * np.maximum(0, y_bottom - y_top)
+
+    box_area = (x2 - x1) * (y2 - y1)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    if iou_type == 0:
+        return inter_area / (box_area + areas - inter_area).astype(float)
+    return inter_area / np.maximum(np.minimum(box_area, areas), 1).astype(float)
+
+
+class BoxIndex:
+    """Uniform grid index of boxes, to find the boxes overlapping a region
+
+    Each box is bucketed in the grid cells it covers, so a query only compares the
+    boxes sharing a cell with it instead of all of them.
+
+    Args:
+        locations: the boxes as lists of points [(x1, y1), (x2, y1), (x2, y2),
+            (x1, y2)]
+        cell_size: the size of the grid cells. Default to twice the median box
+            size, so that most boxes fall into a few cells
+    """
+
+    max_cells_per_box = 64
+
+    def __init__(
+        self, locations: Sequence[List[tuple]], cell_size: Optional[float] = None
+    ):
+        self.boxes = np.array(
+            [(loc[0][0], loc[0][1], loc[2][0], loc[2][1]) for loc in locations],
+            dtype=float,
+        ).reshape(-1, 4)
+        # boxes with inverted corners never overlap, but are still indexed
+        self._extents = np.concatenate(
+            [
+                np.minimum(self.boxes[:, :2], self.boxes[:, 2:]),
+                np.maximum(self.boxes[:, :2], self.boxes[:, 2:]),
+            ],
+            axis=1,
+        )
+        if cell_size is None and len(self.boxes):
+            sizes = self._extents[:, 2:] - self._extents[:, :2]
+            cell_size = 2 * float(np.median(sizes))
+        self.cell_size = max(cell_size or 1.0, 1.0)
+
+        self._cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+        # boxes much larger than the others (e.g. page-wide regions) are compared
+        # with every query rather than bucketed in many cells
+        self._large: list[int] = []
+        for idx, cell_range in enumerate(self._cell_ranges(self._extents)):
+            if self._n_cells(cell_range) > self.max_cells_per_box:
+                self._large.append(idx)
+                continue
+            for cell in self._iter_cells(cell_range):
+                self._cells[cell].append(idx)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def _cell_ranges(self, extents: np.ndarray) -> np.ndarray:
+        return np.floor(extents / self.cell_size).astype(int)
+
+    @staticmethod
+    def _n_cells(cell_range) -> int:
+        col1, row1, col2, row2 = cell_range
+        return (col2 - col1 + 1) * (row2 - row1 + 1)
+
+    @staticmethod
+    def _iter_cells(cell_range):
+        col1, row1, col2, row2 = cell_range
+        for col in range(col1, col2 + 1):
+            for row in range(row1, row2 + 1):
+                yield col, row
+
+    def candidates(self, box: List[tuple]) -> np.ndarray:
+        """Get the sorted indices of the boxes that may overlap the box"""
+        (x1, y1), (x2, y2) = box[0], box[2]
+        extent = np.array([[min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)]])
+        cell_range = self._cell_ranges(extent)[0]
+        indices = list(self._large)
+        if self._n_cells(cell_range) > len(self._cells):
+            # the box covers more cells than there are non-empty ones
+            indices.extend(idx for cell in self._cells.values() for idx in cell)
+        else:
+            indices.extend(
+                idx
+                for cell in self._iter_cells(cell_range)
+                for idx in self._cells.get(cell, ())
+            )
+        return np.unique(np.array(indices, dtype=int))
+
+    def query(
+        self, box: List[tuple], iou_threshold: float, iou_type: int = 0
+    ) -> np.ndarray:
+        """Get the sorted indices of the boxes whose IOU with the box is above the
+        threshold, same as comparing the box with all of them using `get_rect_iou`
+        """
+        indices = self.candidates(box)
+        if not len(indices):
+            return indices
+        ious = get_rect_iou_many(box, self.boxes[indices], iou_type=iou_type)
+        return indices[ious > iou_threshold]
+
+
 def sort_funsd_reading_order(lines: List[dict], box_key_name: str = "box"):
     """Sort cell list to create the right reading order using their locations
 
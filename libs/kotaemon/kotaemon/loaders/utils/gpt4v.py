@@ -1,12 +1,60 @@
 import json
 import logging
-from typing import Any, List
+import threading
+from contextlib import contextmanager
+from typing import Any, List, Optional
 
 import requests
 from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 logger = logging.getLogger(__name__)
 
+# maximum number of concurrent requests to a same VLM endpoint
+VLM_MAX_CONCURRENCY = config("VLM_MAX_CONCURRENCY", default=4, cast=int)
+VLM_MAX_RETRIES = config("VLM_MAX_RETRIES", default=3, cast=int)
+VLM_REQUEST_TIMEOUT = config("VLM_REQUEST_TIMEOUT", default=120, cast=float)
+
+_session: Optional[requests.Session] = None
+_endpoint_semaphores: dict[str, threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """Get the HTTP session shared by the VLM requests, reusing the connections
+
+    Rate-limited (429) and failed (5xx) requests are retried with an exponential
+    backoff, honoring the Retry-After header.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                total=VLM_MAX_RETRIES,
+                backoff_factor=1.0,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(max_retries=retry, pool_maxsize=VLM_MAX_CONCURRENCY)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+@contextmanager
+def endpoint_slot(endpoint: str):
+    """Wait until fewer than VLM_MAX_CONCURRENCY requests run on the endpoint"""
+    with _lock:
+        semaphore = _endpoint_semaphores.get(endpoint)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(max(1, VLM_MAX_CONCURRENCY))
+            _endpoint_semaphores[endpoint] = semaphore
+    with semaphore:
+        yield
+
 
 def generate_gpt4v(
     endpoint: str,
@@ -45,7 +93,10 @@ def generate_gpt4v(
     if len(images) > max_images:
         print(f"Truncated to {max_images} images (original {len(images)} images")
 
-    response = requests.post(endpoint, headers=headers, json=payload)
+    with endpoint_slot(endpoint):
+        response = get_session().post(
+            endpoint, headers=headers, json=payload, timeout=VLM_REQUEST_TIMEOUT
+        )
 
     try:
         response.raise_for_status()
@@ -96,7 +147,13 @@ def stream_gpt4v(
     if len(images) > max_images:
         print(f"Truncated to {max_images} images (original {len(images)} images")
     try:
-        response = requests.post(endpoint, headers=headers, json=payload, stream=True)
+        response = get_session().post(
+            endpoint,
+            headers=headers,
+            json=payload,
+            stream=True,
+            timeout=VLM_REQUEST_TIMEOUT,
+        )
         assert response.status_code == 200, str(response.content)
         output = ""
         logprobs = []
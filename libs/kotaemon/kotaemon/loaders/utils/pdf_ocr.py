@@ -3,11 +3,11 @@ from pathlib import Path
 from typing import Dict, List, Optional, Union
 
 from .box import (
+    BoxIndex,
     bbox_to_points,
     box_area,
     box_h,
     box_w,
-    get_rect_iou,
     points_to_bbox,
     scale_box,
     scale_points,
@@ -74,15 +74,11 @@ def merge_ocr_and_pdf_texts(
     if debug_info is not None:
         cv2, debug_im = debug_info
 
+    # only compare the OCR items with the PDF items near them
+    pdf_index = BoxIndex([item["location"] for item in pdf_text_list])
+
     for ocr_item in ocr_list:
-        matched = False
-        for pdf_item in pdf_text_list:
-            if (
-                get_rect_iou(ocr_item["location"], pdf_item["location"], iou_type=1)
-                > IOU_THRES
-            ):
-                matched = True
-                break
+        matched = len(pdf_index.query(ocr_item["location"], IOU_THRES, iou_type=1)) > 0
 
         color = (255, 0, 0)
         if not matched:
@@ -138,8 +134,14 @@ def merge_table_cell_and_ocr(
     table_list = sorted(table_list, key=lambda item: box_area(item["bbox"]))
 
     all_tables = []
-    matched_pdf_ids = []
-    matched_cell_ids = []
+    matched_pdf_ids = set()
+    matched_cell_ids = set()
+
+    cell_index = BoxIndex([item["location"] for item in cell_list])
+    item_indices = {
+        "pdf": BoxIndex([item["location"] for item in pdf_list]),
+        "ocr": BoxIndex([item["location"] for item in ocr_list]),
+    }
 
     for table in table_list:
         if debug_info is not None:
@@ -152,27 +154,25 @@ def merge_table_cell_and_ocr(
             )
 
         cur_table_cells = []
-        for cell_id, cell in enumerate(cell_list):
+        # the candidates are sorted, so the cells keep their original order
+        for cell_id in cell_index.query(table["location"], IOU_THRES, iou_type=1):
+            cell = cell_list[cell_id]
             if cell_id in matched_cell_ids:
                 continue
 
-            if get_rect_iou(
-                table["location"], cell["location"], iou_type=1
-            ) > IOU_THRES and box_area(table["bbox"]) > box_area(cell["bbox"]):
+            if box_area(table["bbox"]) > box_area(cell["bbox"]):
                 color = [128, 0, 128]
                 # cell matched to table
                 for item_list, item_type in [(pdf_list, "pdf"), (ocr_list, "ocr")]:
                     cell["ocr"] = []
-                    for item_id, item in enumerate(item_list):
+                    for item_id in item_indices[item_type].query(
+                        cell["location"], IOU_THRES, iou_type=1
+                    ):
                         if item_type == "pdf" and item_id in matched_pdf_ids:
                             continue
-                        if (
-                            get_rect_iou(item["location"], cell["location"], iou_type=1)
-                            > IOU_THRES
-                        ):
-                            cell["ocr"].append(item)
-                            if item_type == "pdf":
-                                matched_pdf_ids.append(item_id)
+                        cell["ocr"].append(item_list[item_id])
+                        if item_type == "pdf":
+                            matched_pdf_ids.add(item_id)
 
                     if len(cell["ocr"]) > 0:
                         # check if union of matched ocr does
@@ -203,7 +203,7 @@ def merge_table_cell_and_ocr(
                         thickness=3,
                     )
 
-                matched_cell_ids.append(cell_id)
+                matched_cell_ids.add(cell_id)
                 cur_table_cells.append(cell)
 
         all_tables.append(cur_table_cells)
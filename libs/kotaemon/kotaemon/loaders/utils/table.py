@@ -2,7 +2,7 @@ import csv
 from io import StringIO
 from typing import List, Optional, Tuple
 
-from .box import get_rect_iou
+from .box import BoxIndex
 
 
 def check_col_conflicts(
@@ -90,14 +90,14 @@ def get_table_from_ocr(ocr_list: List[dict], table_list: List[dict]):
         _type_: _description_
     """
     table_texts = []
+    ocr_index = BoxIndex([ocr["location"] for ocr in ocr_list])
     for table in table_list:
         if table["type"] != "table":
             continue
-        cur_table_texts = []
-        for ocr in ocr_list:
-            _iou = get_rect_iou(table["location"], ocr["location"], iou_type=1)
-            if _iou > 0.8:
-                cur_table_texts.append(ocr["text"])
+        cur_table_texts = [
+            ocr_list[ocr_id]["text"]
+            for ocr_id in ocr_index.query(table["location"], 0.8, iou_type=1)
+        ]
         table_texts.append(cur_table_texts)
 
     return table_texts
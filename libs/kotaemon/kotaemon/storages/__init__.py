@@ -1,3 +1,11 @@
+from .blobstore import (
+    FileBlobStore,
+    blob_keys,
+    register_uri_resolver,
+    resolve_blob_uri,
+    set_default_blob_store,
+    store_images,
+)
 from .docstores import (
     BaseDocumentStore,
     ElasticsearchDocumentStore,
@@ -11,11 +19,19 @@ from .vectorstores import (
     InMemoryVectorStore,
     LanceDBVectorStore,
     MilvusVectorStore,
+    NumpyVectorStore,
     QdrantVectorStore,
     SimpleFileVectorStore,
 )
 
 __all__ = [
+    # Blob store
+    "FileBlobStore",
+    "blob_keys",
+    "register_uri_resolver",
+    "resolve_blob_uri",
+    "set_default_blob_store",
+    "store_images",
     # Document stores
     "BaseDocumentStore",
     "InMemoryDocumentStore",
@@ -30,4 +46,5 @@ __all__ = [
     "LanceDBVectorStore",
     "MilvusVectorStore",
     "QdrantVectorStore",
+    "NumpyVectorStore",
 ]
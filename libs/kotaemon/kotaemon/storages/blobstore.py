@@ -0,0 +1,166 @@
+"""Content-addressed storage of binary blobs, e.g. the images of documents
+
+Images extracted by the loaders (page thumbnails, figures) are large base64 data
+URIs. Keeping them in the documents' metadata bloats the docstore and every copy
+of the retrieved documents, so they are stored as files instead and the metadata
+only holds a `kh-blob://<sha256>.<ext>` reference, resolved when rendered.
+"""
+import base64
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from kotaemon.base import Document
+
+logger = logging.getLogger(__name__)
+
+BLOB_URI_PREFIX = "kh-blob://"
+_KEY_PATTERN = re.compile(r"[0-9a-f]{64}(\.[0-9a-z]+)?")
+_DATA_URI_PATTERN = re.compile(r"data:([\w/+.-]+);base64,(.*)", re.DOTALL)
+
+
+class FileBlobStore:
+    """Store blobs as files in a local folder, named by the sha256 of their content
+
+    Identical blobs are stored once. Writes are atomic, so concurrent writers of
+    the same blob are safe.
+
+    Args:
+        path: the folder of the blobs
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _blob_path(self, key: str) -> Path:
+        if not _KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid blob key: {key}")
+        return self.path / key[:2] / key
+
+    def put(self, data: bytes, extension: str = "") -> str:
+        """Store the blob, return its key"""
+        key = hashlib.sha256(data).hexdigest() + extension.lower()
+        blob_path = self._blob_path(key)
+        if not blob_path.exists():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = blob_path.with_name(f"{key}.{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, blob_path)
+        return key
+
+    def get(self, key: str) -> bytes:
+        return self._blob_path(key).read_bytes()
+
+    def exists(self, key: str) -> bool:
+        return self._blob_path(key).exists()
+
+    def delete(self, keys: Iterable[str]):
+        for key in keys:
+            self._blob_path(key).unlink(missing_ok=True)
+
+    def put_data_uri(self, data_uri: str) -> str:
+        """Store the content of a base64 data URI, return the blob URI"""
+        match = _DATA_URI_PATTERN.fullmatch(data_uri)
+        if not match:
+            raise ValueError("Not a base64 data URI")
+        mime_type, data = match.groups()
+        extension = mimetypes.guess_extension(mime_type) or ""
+        return BLOB_URI_PREFIX + self.put(base64.b64decode(data), extension)
+
+    def get_data_uri(self, blob_uri: str) -> str:
+        """Get the base64 data URI of a blob URI"""
+        key = blob_uri[len(BLOB_URI_PREFIX) :]
+        mime_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        data = base64.b64encode(self.get(key)).decode("utf-8")
+        return f"data:{mime_type};base64,{data}"
+
+
+_default_blob_store: Optional[FileBlobStore] = None
+# resolvers of other URI schemes, e.g. the thumbnails rendered on demand
+_uri_resolvers: dict[str, Callable[[str], str]] = {}
+
+
+def set_default_blob_store(blob_store: Optional[FileBlobStore]):
+    """Set the blob store in which the blob URIs are resolved"""
+    global _default_blob_store
+    _default_blob_store = blob_store
+
+
+def get_default_blob_store() -> Optional[FileBlobStore]:
+    return _default_blob_store
+
+
+def register_uri_resolver(prefix: str, resolver: Callable[[str], str]):
+    """Resolve the URIs starting with prefix to data URIs with resolver"""
+    _uri_resolvers[prefix] = resolver
+
+
+def store_images(
+    docs: Iterable[Document],
+    blob_store: Optional[FileBlobStore] = None,
+    keys: tuple[str, ...] = ("image_origin",),
+):
+    """Move the data URIs of the documents' metadata to the blob store, in place"""
+    blob_store = blob_store or _default_blob_store
+    if blob_store is None:
+        return
+
+    for doc in docs:
+        for key in keys:
+            value = doc.metadata.get(key)
+            if isinstance(value, str) and value.startswith("data:"):
+                try:
+                    doc.metadata[key] = blob_store.put_data_uri(value)
+                except ValueError:
+                    # not base64, e.g. a plain text data URI
+                    continue
+
+
+def blob_keys(
+    docs: Iterable[Document], keys: tuple[str, ...] = ("image_origin",)
+) -> set[str]:
+    """Get the keys of the blobs referenced by the documents' metadata"""
+    found = set()
+    for doc in docs:
+        for key in keys:
+            value = doc.metadata.get(key)
+            if isinstance(value, str) and value.startswith(BLOB_URI_PREFIX):
+                found.add(value[len(BLOB_URI_PREFIX) :])
+    return found
+
+
+def resolve_blob_uri(value: str, blob_store: Optional[FileBlobStore] = None) -> str:
+    """Get the data URI of a blob URI, other values are returned unchanged
+
+    URIs of the registered resolvers are resolved too. Missing blobs are resolved
+    to an empty string.
+    """
+    if not isinstance(value, str):
+        return value
+
+    for prefix, resolver in _uri_resolvers.items():
+        if value.startswith(prefix):
+            try:
+                return resolver(value)
+            except Exception as e:
+                logger.warning(f"Cannot resolve {value}: {e}")
+                return ""
+
+    if not value.startswith(BLOB_URI_PREFIX):
+        return value
+
+    blob_store = blob_store or _default_blob_store
+    if blob_store is None:
+        logger.warning(f"No blob store to resolve {value}")
+        return ""
+    try:
+        return blob_store.get_data_uri(value)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Cannot resolve {value}: {e}")
+        return ""
@@ -43,9 +43,21 @@ class BaseDocumentStore(ABC):
 
     @abstractmethod
     def query(
-        self, query: str, top_k: int = 10, doc_ids: Optional[list] = None
+        self,
+        query: str,
+        top_k: int = 10,
+        doc_ids: Optional[list] = None,
+        file_ids: Optional[list] = None,
     ) -> List[Document]:
-        """Search document store using search query"""
+        """Search document store using search query
+
+        Args:
+            query: the query text
+            top_k: number of top documents to return
+            doc_ids: if given, only search among these documents
+            file_ids: if given, only search among the documents whose `file_id`
+                metadata is one of these, instead of `doc_ids`
+        """
         ...
 
     @abstractmethod
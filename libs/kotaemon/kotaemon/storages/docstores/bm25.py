@@ -0,0 +1,186 @@
+import heapq
+import json
+import math
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Optional
+
+# CJK characters are indexed one by one, as these scripts don't separate words
+_CJK = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK}]|[^\W_{_CJK}]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lower-cased word tokens"""
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Incremental in-process inverted index with BM25 scoring
+
+    The index keeps, for every term, the postings `doc_id -> term frequency`.
+    Documents can be added and removed at any time. When `path` is given, every
+    change is also appended to a JSON-lines log at that path, which is replayed on
+    load and rewritten as a snapshot once it contains mostly stale records.
+
+    Args:
+        path: path of the persisted log, None to keep the index in memory only
+        k1: BM25 term frequency saturation
+        b: BM25 document length normalization
+    """
+
+    def __init__(
+        self, path: Optional[str | Path] = None, k1: float = 1.2, b: float = 0.75
+    ):
+        self._path = Path(path) if path else None
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._reset()
+        if self._path is not None and self._path.is_file():
+            self._load()
+
+    def _reset(self):
+        self._postings: dict[str, dict[str, int]] = {}
+        self._doc_lengths: dict[str, int] = {}
+        self._doc_terms: dict[str, list[str]] = {}
+        self._total_length = 0
+        self._n_records = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_lengths)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._doc_lengths
+
+    def doc_ids(self) -> set[str]:
+        return set(self._doc_lengths)
+
+    def _index(self, doc_id: str, term_freqs: dict[str, int]):
+        self._unindex(doc_id)
+        for term, freq in term_freqs.items():
+            self._postings.setdefault(term, {})[doc_id] = freq
+        length = sum(term_freqs.values())
+        self._doc_lengths[doc_id] = length
+        self._doc_terms[doc_id] = list(term_freqs)
+        self._total_length += length
+
+    def _unindex(self, doc_id: str):
+        length = self._doc_lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._doc_terms.pop(doc_id):
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+
+    def _load(self):
+        assert self._path is not None
+        with self._path.open() as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # remnant of an interrupted write
+                    continue
+                self._n_records += 1
+                if len(record) == 1:
+                    self._unindex(record[0])
+                else:
+                    self._index(record[0], record[1])
+
+    def _append_records(self, records: list[list]):
+        self._n_records += len(records)
+        if self._path is None or not records:
+            return
+        with self._path.open("a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+        if self._n_records > 2 * len(self) + 1000:
+            self._snapshot()
+
+    def _snapshot(self):
+        """Rewrite the log with only the current state of the index"""
+        assert self._path is not None
+        tmp_path = self._path.with_suffix(self._path.suffix + ".tmp")
+        with tmp_path.open("w") as f:
+            for doc_id, terms in self._doc_terms.items():
+                term_freqs = {term: self._postings[term][doc_id] for term in terms}
+                f.write(json.dumps([doc_id, term_freqs]) + "\n")
+        tmp_path.replace(self._path)
+        self._n_records = len(self._doc_terms)
+
+    def add(self, items: Iterable[tuple[str, str]]):
+        """Index the `(doc_id, text)` items, replacing the same-id documents"""
+        with self._lock:
+            records = []
+            for doc_id, text in items:
+                term_freqs = dict(Counter(tokenize(text or "")))
+                self._index(doc_id, term_freqs)
+                records.append([doc_id, term_freqs])
+            self._append_records(records)
+
+    def delete(self, doc_ids: Iterable[str]):
+        """Remove the documents from the index, unknown ids are ignored"""
+        with self._lock:
+            records = [[doc_id] for doc_id in doc_ids if doc_id in self._doc_lengths]
+            for (doc_id,) in records:
+                self._unindex(doc_id)
+            self._append_records(records)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            if self._path is not None:
+                self._path.unlink(missing_ok=True)
+
+    def search(
+        self, query: str, top_k: int = 10, doc_ids: Optional[Iterable[str]] = None
+    ) -> list[tuple[str, float]]:
+        """Return the `(doc_id, score)` of the best matching documents
+
+        Args:
+            query: the query text
+            top_k: maximum number of documents to return
+            doc_ids: if given, only these documents are searched
+
+        Returns:
+            the matches, by decreasing score
+        """
+        scope = set(doc_ids) if doc_ids is not None else None
+        with self._lock:
+            n_docs = len(self._doc_lengths)
+            if not n_docs:
+                return []
+            avg_length = self._total_length / n_docs or 1.0
+
+            scores: dict[str, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                if scope is not None and len(scope) < len(postings):
+                    # iterate over the smaller side when the scope is narrow
+                    matches: Iterable[tuple[str, int]] = (
+                        (doc_id, postings[doc_id])
+                        for doc_id in scope
+                        if doc_id in postings
+                    )
+                else:
+                    matches = postings.items()
+                for doc_id, freq in matches:
+                    if scope is not None and doc_id not in scope:
+                        continue
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length
+                    )
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (
+                        self.k1 + 1
+                    ) / (freq + norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
@@ -122,7 +122,11 @@ class ElasticsearchDocumentStore(BaseDocumentStore):
         return docs
 
     def query(
-        self, query: str, top_k: int = 10, doc_ids: Optional[list] = None
+        self,
+        query: str,
+        top_k: int = 10,
+        doc_ids: Optional[list] = None,
+        file_ids: Optional[list] = None,
     ) -> List[Document]:
         """Search Elasticsearch docstore using search query (BM25)
 
@@ -130,12 +134,24 @@ class ElasticsearchDocumentStore(BaseDocumentStore):
             query (str): query text
             top_k (int, optional): number of
                 top documents to return. Defaults to 10.
+            doc_ids (list, optional): only search among these documents
+            file_ids (list, optional): only search among the documents whose
+                `file_id` metadata is one of these, instead of `doc_ids`
 
         Returns:
             List[Document]: List of result documents
         """
         query_dict: dict = {"match": {"content": query}}
-        if doc_ids is not None:
+        if file_ids:
+            query_dict = {
+                "bool": {
+                    "must": [
+                        query_dict,
+                        {"terms": {"metadata.file_id.keyword": file_ids}},
+                    ]
+                }
+            }
+        elif doc_ids is not None:
             query_dict = {"bool": {"must": [query_dict, {"terms": {"_id": doc_ids}}]}}
         query_dict = {"query": query_dict, "size": top_k}
         return self.query_raw(query_dict)
@@ -5,13 +5,19 @@ from typing import List, Optional, Union
 from kotaemon.base import Document
 
 from .base import BaseDocumentStore
+from .bm25 import BM25Index
 
 
 class InMemoryDocumentStore(BaseDocumentStore):
-    """Simple memory document store that store document in a dictionary"""
+    """Simple memory document store that store document in a dictionary
+
+    Full-text search is served by an in-process BM25 index, which is kept up to
+    date on every change.
+    """
 
     def __init__(self):
         self._store = {}
+        self._bm25 = BM25Index()
 
     def add(
         self,
@@ -40,6 +46,7 @@ class InMemoryDocumentStore(BaseDocumentStore):
             if doc_id in self._store and not exist_ok:
                 raise ValueError(f"Document with id {doc_id} already exist")
             self._store[doc_id] = doc
+        self._bm25.add((doc_id, doc.text) for doc_id, doc in zip(doc_ids, docs))
 
     def get(self, ids: Union[List[str], str]) -> List[Document]:
         """Get document by id"""
@@ -63,6 +70,7 @@ class InMemoryDocumentStore(BaseDocumentStore):
 
         for doc_id in ids:
             del self._store[doc_id]
+        self._bm25.delete(ids)
 
     def save(self, path: Union[str, Path]):
         """Save document to path"""
@@ -80,12 +88,42 @@ class InMemoryDocumentStore(BaseDocumentStore):
         # For better query support, utilize SQLite as the default document store.
         # Also, for portability, use SQLAlchemy for document store.
         self._store = {key: Document.from_dict(value) for key, value in store.items()}
+        self._sync_fulltext_index()
+
+    def _sync_fulltext_index(self):
+        """Rebuild the full-text index if it does not match the stored documents"""
+        if self._bm25.doc_ids() != set(self._store):
+            self._bm25.clear()
+            self._bm25.add((doc_id, doc.text) for doc_id, doc in self._store.items())
 
     def query(
-        self, query: str, top_k: int = 10, doc_ids: Optional[list] = None
+        self,
+        query: str,
+        top_k: int = 10,
+        doc_ids: Optional[list] = None,
+        file_ids: Optional[list] = None,
     ) -> List[Document]:
-        """Perform full-text search on document store"""
-        return []
+        """Perform full-text search on document store
+
+        Args:
+            query: the query text
+            top_k: number of top documents to return
+            doc_ids: if given, only search among these documents
+            file_ids: if given, only search among the documents whose `file_id`
+                metadata is one of these, instead of `doc_ids`
+
+        Returns:
+            the matched documents, by decreasing BM25 score
+        """
+        if file_ids:
+            file_scope = set(file_ids)
+            doc_ids = [
+                doc_id
+                for doc_id, doc in list(self._store.items())
+                if doc.metadata.get("file_id") in file_scope
+            ]
+        matches = self._bm25.search(query, top_k=top_k, doc_ids=doc_ids)
+        return [self._store[doc_id] for doc_id, _ in matches]
 
     def __persist_flow__(self):
         return {}
@@ -93,3 +131,4 @@ class InMemoryDocumentStore(BaseDocumentStore):
     def drop(self):
         """Drop the document store"""
         self._store = {}
+        self._bm25.clear()
@@ -1,17 +1,68 @@
 import json
-from typing import List, Optional, Union
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
 
 from kotaemon.base import Document
 
 from .base import BaseDocumentStore
+from .bm25 import BM25Index
+
+logger = logging.getLogger(__name__)
 
 MAX_DOCS_TO_GET = 10**4
+# number of ids in the filter expression of each lookup
+GET_BATCH_SIZE = 1000
+# metadata fields also stored in their own column, to be filtered and indexed
+TYPED_FIELDS = ["file_id", "page_label", "type", "thumbnail_doc_id"]
+SCALAR_INDEXED_FIELDS = ["id", "file_id"]
+
+
+def _sql_list(values: Iterable[str]) -> str:
+    return ", ".join("'{}'".format(str(value).replace("'", "''")) for value in values)
+
+
+def _to_row(doc_id: str, text: str, metadata: dict) -> dict:
+    row = {"id": doc_id, "text": text, "attributes": json.dumps(metadata)}
+    for field in TYPED_FIELDS:
+        value = metadata.get(field)
+        row[field] = None if value is None else str(value)
+    return row
 
 
 class LanceDBDocumentStore(BaseDocumentStore):
-    """LancdDB document store which support full-text search query"""
+    """LancdDB document store which support full-text search query
 
-    def __init__(self, path: str = "lancedb", collection_name: str = "docstore"):
+    Besides the JSON `attributes`, the metadata fields in `TYPED_FIELDS` are stored
+    in their own string columns, and `id` and `file_id` have scalar indexes, so the
+    lookups by id and the searches scoped to some files don't scan the table. The
+    tables created before these columns existed are migrated when first opened.
+
+    Rebuilding the full-text index covers the whole collection, so it can be
+    deferred: inside a `deferred_refresh` block, or when `refresh_delay` is set, the
+    index is only marked dirty by `add` and `delete` and rebuilt once at the end of
+    the block, or after `refresh_delay` seconds without changes. Until then, the
+    rows added since the last rebuild are searched by brute force with BM25 and
+    fused by rank with the indexed results, while the deleted rows are filtered
+    out. For local databases, the table version covered by the last rebuild is
+    saved next to the table, so that the changes not indexed before a restart are
+    indexed when the table is opened again.
+
+    Args:
+        path: the uri of the LanceDB database
+        collection_name: the name of the table
+        refresh_delay: when positive, the number of seconds to wait for more changes
+            before rebuilding the full-text index. 0 to rebuild it after each change
+    """
+
+    def __init__(
+        self,
+        path: str = "lancedb",
+        collection_name: str = "docstore",
+        refresh_delay: float = 0.0,
+    ):
         try:
             import lancedb
         except ImportError:
@@ -22,6 +73,83 @@ class LanceDBDocumentStore(BaseDocumentStore):
         self.db_uri = path
         self.collection_name = collection_name
         self.db_connection = lancedb.connect(self.db_uri)  # type: ignore
+        self.refresh_delay = refresh_delay
+
+        self._lock = threading.RLock()
+        self._table = None
+        self._n_sessions = 0
+        self._dirty = False
+        self._timer: Optional[threading.Timer] = None
+        # the rows changed since the last rebuild of the full-text index
+        self._unindexed = BM25Index()
+        self._unindexed_file_ids: dict[str, Optional[str]] = {}
+        self._deleted_ids: set[str] = set()
+
+    @staticmethod
+    def _schema():
+        import pyarrow as pa
+
+        return pa.schema(
+            [(name, pa.string()) for name in ["id", "text", "attributes"]]
+            + [(name, pa.string()) for name in TYPED_FIELDS]
+        )
+
+    def _open_table(self):
+        """Return the cached handle of the table, None if it does not exist
+
+        The handle is moved to the latest version of the table, for the changes
+        made by other handles (e.g. other processes) to be visible.
+        """
+        with self._lock:
+            if self._table is not None:
+                try:
+                    self._table.checkout_latest()
+                except AttributeError:
+                    # older lancedb, whose handles always read the latest version
+                    pass
+                except Exception as e:
+                    logger.debug(f"Reopening {self.collection_name}: {e}")
+                    self._table = None
+            if self._table is None:
+                if self.collection_name not in self.db_connection.table_names():
+                    return None
+                self._table = self.db_connection.open_table(self.collection_name)
+                if not set(TYPED_FIELDS).issubset(self._table.schema.names):
+                    self._migrate()
+                elif self._indexed_version() not in (None, self._table.version):
+                    # changed since the last rebuild, e.g. before a restart
+                    self._dirty = True
+                    self.refresh_indices()
+            return self._table
+
+    def _version_path(self) -> Optional[Path]:
+        """The file saving the table version covered by the full-text index, for
+        local databases only"""
+        if "://" in str(self.db_uri):
+            return None
+        return Path(self.db_uri) / f"{self.collection_name}.indexed_version"
+
+    def _indexed_version(self) -> Optional[int]:
+        path = self._version_path()
+        if path is None or not path.exists():
+            return None
+        try:
+            return int(path.read_text())
+        except ValueError:
+            return -1
+
+    def _migrate(self):
+        """Rewrite a table without the typed columns, filling them from the JSON"""
+        logger.info(f"Adding the typed columns to {self.collection_name}")
+        rows = [
+            _to_row(row["id"], row["text"], json.loads(row["attributes"] or "{}"))
+            for row in self._table.to_arrow().to_pylist()
+        ]
+        self._table = self.db_connection.create_table(
+            self.collection_name, data=rows, schema=self._schema(), mode="overwrite"
+        )
+        self._dirty = True
+        self.refresh_indices()
 
     def add(
         self,
@@ -32,44 +160,78 @@ class LanceDBDocumentStore(BaseDocumentStore):
     ):
         """Load documents into lancedb storage."""
         doc_ids = ids if ids else [doc.doc_id for doc in docs]
-        data: list[dict[str, str]] | None = [
-            {
-                "id": doc_id,
-                "text": doc.text,
-                "attributes": json.dumps(doc.metadata),
-            }
+        data = [
+            _to_row(doc_id, doc.text, doc.metadata)
             for doc_id, doc in zip(doc_ids, docs)
         ]
 
-        if self.collection_name not in self.db_connection.table_names():
-            if data:
-                document_collection = self.db_connection.create_table(
-                    self.collection_name, data=data, mode="overwrite"
+        if not data:
+            return
+
+        with self._lock:
+            document_collection = self._open_table()
+            if document_collection is None:
+                self._table = self.db_connection.create_table(
+                    self.collection_name,
+                    data=data,
+                    schema=self._schema(),
+                    mode="overwrite",
                 )
-        else:
-            # add data to existing table
-            document_collection = self.db_connection.open_table(self.collection_name)
-            if data:
+            else:
+                # add data to existing table
                 document_collection.add(data)
 
-        if refresh_indices:
-            document_collection.create_fts_index(
-                "text",
-                tokenizer_name="en_stem",
-                replace=True,
-            )
+        self._mark_dirty(added=data, refresh_indices=refresh_indices)
 
     def query(
-        self, query: str, top_k: int = 10, doc_ids: Optional[list] = None
+        self,
+        query: str,
+        top_k: int = 10,
+        doc_ids: Optional[list] = None,
+        file_ids: Optional[list] = None,
     ) -> List[Document]:
-        if doc_ids:
-            id_filter = ", ".join([f"'{_id}'" for _id in doc_ids])
-            query_filter = f"id in ({id_filter})"
-        else:
-            query_filter = None
+        """Perform full-text search on the documents
+
+        Args:
+            query: the query text
+            top_k: number of top documents to return
+            doc_ids: if given, only search among these documents
+            file_ids: if given, only search among the documents with these
+                `file_id`, instead of `doc_ids`. Much cheaper than listing all the
+                chunks of the files in `doc_ids`
+        """
+        with self._lock:
+            deleted_ids = list(self._deleted_ids)
+            if file_ids:
+                file_scope = set(file_ids)
+                unindexed_scope: Optional[list] = [
+                    doc_id
+                    for doc_id, file_id in self._unindexed_file_ids.items()
+                    if file_id in file_scope
+                ]
+            else:
+                unindexed_scope = doc_ids or None
+            unindexed_matches = (
+                self._unindexed.search(query, top_k=top_k, doc_ids=unindexed_scope)
+                if unindexed_scope is None or unindexed_scope
+                else []
+            )
+            unindexed_ids = self._unindexed.doc_ids()
+
+        filters = []
+        if file_ids:
+            filters.append(f"file_id in ({_sql_list(file_ids)})")
+        elif doc_ids:
+            filters.append(f"id in ({_sql_list(doc_ids)})")
+        if deleted_ids:
+            # still in the full-text index until its next rebuild
+            filters.append(f"id not in ({_sql_list(deleted_ids)})")
+        query_filter = " AND ".join(f"({each})" for each in filters)
         try:
-            document_collection = self.db_connection.open_table(self.collection_name)
-            if query_filter:
+            document_collection = self._open_table()
+            if document_collection is None:
+                docs = []
+            elif query_filter:
                 docs = (
                     document_collection.search(query, query_type="fts")
                     .where(query_filter, prefilter=True)
@@ -84,14 +246,29 @@ class LanceDBDocumentStore(BaseDocumentStore):
                 )
         except (ValueError, FileNotFoundError):
             docs = []
-        return [
-            Document(
-                id_=doc["id"],
-                text=doc["text"] if doc["text"] else "<empty>",
-                metadata=json.loads(doc["attributes"]),
-            )
+
+        if not unindexed_matches:
+            return [self._to_document(doc) for doc in docs]
+
+        from kotaemon.indices.fusion import reciprocal_rank_fusion
+
+        # the indexed text of an unindexed row is stale, its brute-force match wins.
+        # The BM25 scores are not comparable to those of the index, only the ranks
+        indexed = {
+            doc["id"]: self._to_document(doc)
             for doc in docs
-        ]
+            if doc["id"] not in unindexed_ids
+        }
+        unindexed_ranking = [doc_id for doc_id, _ in unindexed_matches]
+        fused = reciprocal_rank_fusion([list(indexed), unindexed_ranking])
+        best_ids = sorted(fused, key=lambda doc_id: fused[doc_id], reverse=True)
+        best_ids = best_ids[:top_k]
+        found = dict(indexed)
+        found.update(
+            (doc.doc_id, doc)
+            for doc in self.get([id_ for id_ in best_ids if id_ not in indexed])
+        )
+        return [found[doc_id] for doc_id in best_ids if doc_id in found]
 
     def get(self, ids: Union[List[str], str]) -> List[Document]:
         """Get document by id"""
@@ -101,47 +278,179 @@ class LanceDBDocumentStore(BaseDocumentStore):
         if len(ids) == 0:
             return []
 
-        id_filter = ", ".join([f"'{_id}'" for _id in ids])
+        docs = []
         try:
-            document_collection = self.db_connection.open_table(self.collection_name)
-            query_filter = f"id in ({id_filter})"
-            docs = (
-                document_collection.search()
-                .where(query_filter)
-                .limit(MAX_DOCS_TO_GET)
-                .to_list()
-            )
+            document_collection = self._open_table()
+            if document_collection is not None:
+                for start in range(0, len(ids), GET_BATCH_SIZE):
+                    batch = ids[start : start + GET_BATCH_SIZE]
+                    docs += (
+                        document_collection.search()
+                        .where(f"id in ({_sql_list(batch)})")
+                        .select(["id", "text", "attributes"])
+                        .limit(min(len(batch), MAX_DOCS_TO_GET))
+                        .to_list()
+                    )
         except (ValueError, FileNotFoundError):
             docs = []
-        return [
-            Document(
-                id_=doc["id"],
-                text=doc["text"] if doc["text"] else "<empty>",
-                metadata=json.loads(doc["attributes"]),
-            )
-            for doc in docs
-        ]
+        return [self._to_document(doc) for doc in docs]
 
     def delete(self, ids: Union[List[str], str], refresh_indices: bool = True):
         """Delete document by id"""
         if not isinstance(ids, list):
             ids = [ids]
 
-        document_collection = self.db_connection.open_table(self.collection_name)
-        id_filter = ", ".join([f"'{_id}'" for _id in ids])
-        query_filter = f"id in ({id_filter})"
-        document_collection.delete(query_filter)
+        document_collection = self._open_table()
+        if document_collection is None or not ids:
+            return
+        for start in range(0, len(ids), GET_BATCH_SIZE):
+            batch = ids[start : start + GET_BATCH_SIZE]
+            document_collection.delete(f"id in ({_sql_list(batch)})")
+
+        self._mark_dirty(deleted=ids, refresh_indices=refresh_indices)
+
+    @contextmanager
+    def deferred_refresh(self):
+        """Only rebuild the full-text index once, when the block exits
+
+        The blocks can be nested and entered from several threads: the index is
+        rebuilt when the last one exits, if it was changed.
+        """
+        with self._lock:
+            self._n_sessions += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._n_sessions -= 1
+                last = self._n_sessions == 0
+            if last:
+                self.refresh_indices()
+
+    def refresh_indices(self, force: bool = False):
+        """Rebuild the full-text index if dirty, or if `force` is set
+
+        The scalar indices are only created when missing, then updated with the
+        new rows by optimizing the table.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not (self._dirty or force):
+                return
+            self._dirty = False
+            refreshed_ids = self._unindexed.doc_ids()
+            deleted_ids = set(self._deleted_ids)
+
+        try:
+            document_collection = self._open_table()
+            if document_collection is not None:
+                document_collection.create_fts_index(
+                    "text",
+                    tokenizer_name="en_stem",
+                    replace=True,
+                )
+                self._update_scalar_indices(document_collection)
+        except (ValueError, FileNotFoundError):
+            # the table does not exist (anymore)
+            pass
+        except Exception:
+            with self._lock:
+                self._dirty = True
+            raise
+        else:
+            if document_collection is not None:
+                self._save_indexed_version(document_collection.version)
+
+        with self._lock:
+            self._unindexed.delete(refreshed_ids)
+            for doc_id in refreshed_ids:
+                self._unindexed_file_ids.pop(doc_id, None)
+            self._deleted_ids -= deleted_ids
+
+    def _update_scalar_indices(self, document_collection):
+        try:
+            indexed_columns = {
+                column
+                for index in document_collection.list_indices()
+                for column in index.columns
+            }
+        except AttributeError:
+            # older lancedb, without index listing nor optimization
+            for field in SCALAR_INDEXED_FIELDS:
+                document_collection.create_scalar_index(field, replace=True)
+            return
+
+        missing_fields = [
+            field for field in SCALAR_INDEXED_FIELDS if field not in indexed_columns
+        ]
+        for field in missing_fields:
+            document_collection.create_scalar_index(field)
+        if len(missing_fields) < len(SCALAR_INDEXED_FIELDS):
+            # adds the new rows to the existing indices
+            document_collection.optimize()
+
+    def _save_indexed_version(self, version: int):
+        path = self._version_path()
+        if path is not None:
+            path.write_text(str(version))
 
-        if refresh_indices:
-            document_collection.create_fts_index(
-                "text",
-                tokenizer_name="en_stem",
-                replace=True,
+    def _mark_dirty(
+        self,
+        added: Iterable[dict] = (),
+        deleted: Iterable[str] = (),
+        refresh_indices: bool = True,
+    ):
+        """Track the changed rows, and rebuild the indices now or later"""
+        added = list(added)
+        deleted = list(deleted)
+        with self._lock:
+            self._unindexed.delete(deleted)
+            for doc_id in deleted:
+                self._unindexed_file_ids.pop(doc_id, None)
+            self._unindexed.add((row["id"], row["text"]) for row in added)
+            self._unindexed_file_ids.update(
+                (row["id"], row["file_id"]) for row in added
             )
+            self._deleted_ids.update(deleted)
+            self._deleted_ids.difference_update(row["id"] for row in added)
+            self._dirty = True
+
+            if not refresh_indices or self._n_sessions:
+                return
+            if self.refresh_delay > 0:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self.refresh_delay, self.refresh_indices)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+
+        self.refresh_indices()
+
+    def _to_document(self, doc: dict) -> Document:
+        return Document(
+            id_=doc["id"],
+            text=doc["text"] if doc["text"] else "<empty>",
+            metadata=json.loads(doc["attributes"]),
+        )
 
     def drop(self):
         """Drop the document store"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dirty = False
+            self._table = None
+            self._unindexed.clear()
+            self._unindexed_file_ids.clear()
+            self._deleted_ids.clear()
         self.db_connection.drop_table(self.collection_name)
+        path = self._version_path()
+        if path is not None:
+            path.unlink(missing_ok=True)
 
     def count(self) -> int:
         raise NotImplementedError
@@ -153,4 +462,5 @@ class LanceDBDocumentStore(BaseDocumentStore):
         return {
             "db_uri": self.db_uri,
             "collection_name": self.collection_name,
+            "refresh_delay": self.refresh_delay,
         }
@@ -1,36 +1,375 @@
+import json
+import logging
+import os
+import shutil
+import threading
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Iterable, List, Optional, Union
 
 from kotaemon.base import Document
 
+from .bm25 import BM25Index
 from .in_memory import InMemoryDocumentStore
 
+logger = logging.getLogger(__name__)
+
+
+class _DocumentLog:
+    """Append-only segment files of documents, plus an append-only offset index
+
+    Each document is written as one JSON line at the end of the current segment
+    file. The index file records, for every write, `[doc_id, segment, offset,
+    length]`, and `[doc_id]` for every deletion, so that both adding and deleting
+    cost O(batch) and reading a document is a single seek. Overwritten and deleted
+    documents leave dead bytes in the segments, which are reclaimed by `compact`.
+
+    Args:
+        path: directory holding the segments and the index
+        segment_size: size in bytes after which a new segment is started
+    """
+
+    def __init__(self, path: Path, segment_size: int = 64 * 1024 * 1024):
+        self._dir = path
+        self._segment_size = segment_size
+        self._index_file = path / "index.jsonl"
+        self._lock = threading.RLock()
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        # doc_id -> (segment, offset, length), in insertion order
+        self._offsets: dict[str, tuple[int, int, int]] = {}
+        self._live_bytes = 0
+        self._index_read_size = 0
+        self._index_inode: Optional[int] = None
+
+    def _segment_file(self, segment: int) -> Path:
+        return self._dir / f"segment-{segment:06d}.jsonl"
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(each.stem.split("-")[1]) for each in self._dir.glob("segment-*.jsonl")
+        )
+
+    def _set(self, doc_id: str, location: tuple[int, int, int]):
+        previous = self._offsets.get(doc_id)
+        if previous is not None:
+            self._live_bytes -= previous[2]
+        self._offsets[doc_id] = location
+        self._live_bytes += location[2]
+
+    def _unset(self, doc_id: str):
+        previous = self._offsets.pop(doc_id, None)
+        if previous is not None:
+            self._live_bytes -= previous[2]
+
+    def refresh(self):
+        """Read the index entries written since the last refresh
+
+        The index is re-read from the start if it was replaced by a compaction,
+        possibly from another process.
+        """
+        with self._lock:
+            try:
+                stat = self._index_file.stat()
+            except FileNotFoundError:
+                self._reset()
+                return
+            if stat.st_ino != self._index_inode or stat.st_size < self._index_read_size:
+                self._reset()
+                self._index_inode = stat.st_ino
+            if stat.st_size == self._index_read_size:
+                return
+
+            with self._index_file.open("rb") as f:
+                f.seek(self._index_read_size)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # incomplete write, will be read on a later refresh
+                        break
+                    self._index_read_size += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # remnant of an interrupted write
+                        continue
+                    if len(entry) == 1:
+                        self._unset(entry[0])
+                    else:
+                        self._set(entry[0], tuple(entry[1:]))  # type: ignore
+
+    def _write_index(self, entries: Iterable[list]):
+        data = "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+        with self._index_file.open("ab") as f:
+            # make sure an interrupted write cannot corrupt the first new entry
+            if f.tell() > self._index_read_size:
+                data = b"\n" + data
+            f.write(data)
+            self._index_read_size = f.tell()
+        if self._index_inode is None:
+            self._index_inode = self._index_file.stat().st_ino
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def ids(self) -> list[str]:
+        return list(self._offsets)
+
+    def append(self, items: list[tuple[str, dict]]):
+        """Write the documents at the end of the log, replacing same-id ones"""
+        if not items:
+            return
+
+        with self._lock:
+            self.refresh()
+            segments = self._segments()
+            segment = segments[-1] if segments else 0
+            segment_file = self._segment_file(segment)
+            if segment_file.is_file() and (
+                segment_file.stat().st_size >= self._segment_size
+            ):
+                segment += 1
+                segment_file = self._segment_file(segment)
+
+            entries = []
+            lines = []
+            with segment_file.open("ab") as f:
+                offset = f.tell()
+                for doc_id, doc in items:
+                    line = json.dumps(doc).encode() + b"\n"
+                    lines.append(line)
+                    entries.append([doc_id, segment, offset, len(line)])
+                    offset += len(line)
+                f.write(b"".join(lines))
+                # the documents must be on disk before the index references them
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._write_index(entries)
+            for doc_id, *location in entries:
+                self._set(doc_id, tuple(location))  # type: ignore
+
+    def delete(self, doc_ids: list[str]):
+        with self._lock:
+            self._write_index([doc_id] for doc_id in doc_ids)
+            for doc_id in doc_ids:
+                self._unset(doc_id)
+
+    def _read_locations(
+        self, locations: list[tuple[int, int, int]]
+    ) -> list[Optional[dict]]:
+        results: list[Optional[dict]] = [None] * len(locations)
+        by_segment: dict[int, list[int]] = {}
+        for idx, (segment, _, _) in enumerate(locations):
+            by_segment.setdefault(segment, []).append(idx)
+
+        for segment, indices in by_segment.items():
+            # sort by offset to read each segment sequentially
+            indices.sort(key=lambda idx: locations[idx][1])
+            with self._segment_file(segment).open("rb") as f:
+                for idx in indices:
+                    _, offset, length = locations[idx]
+                    f.seek(offset)
+                    results[idx] = json.loads(f.read(length))
+        return results
+
+    def read(self, doc_ids: list[str]) -> list[dict]:
+        """Read the documents, raise KeyError if one of them does not exist"""
+        with self._lock:
+            if any(doc_id not in self._offsets for doc_id in doc_ids):
+                # might have been written by another process
+                self.refresh()
+            locations = [self._offsets[doc_id] for doc_id in doc_ids]
+
+        try:
+            return self._read_locations(locations)  # type: ignore
+        except FileNotFoundError:
+            # the segment was removed by a compaction from another process
+            with self._lock:
+                self.refresh()
+                locations = [self._offsets[doc_id] for doc_id in doc_ids]
+            return self._read_locations(locations)  # type: ignore
+
+    def read_all(self) -> list[dict]:
+        with self._lock:
+            self.refresh()
+            return self.read(self.ids())
+
+    def dead_ratio(self) -> float:
+        total = sum(
+            self._segment_file(segment).stat().st_size for segment in self._segments()
+        )
+        return 1 - self._live_bytes / total if total else 0.0
+
+    def compact(self):
+        """Rewrite the live documents into new segments and drop the old ones"""
+        with self._lock:
+            self.refresh()
+            old_segments = self._segments()
+            segment = old_segments[-1] + 1 if old_segments else 0
+
+            tmp_index = self._index_file.with_suffix(".jsonl.tmp")
+            readers = {
+                each: self._segment_file(each).open("rb") for each in old_segments
+            }
+            segment_f = self._segment_file(segment).open("ab")
+            try:
+                with tmp_index.open("w") as index_f:
+                    for doc_id, (old_segment, old_offset, length) in list(
+                        self._offsets.items()
+                    ):
+                        if segment_f.tell() >= self._segment_size:
+                            segment_f.flush()
+                            os.fsync(segment_f.fileno())
+                            segment_f.close()
+                            segment += 1
+                            segment_f = self._segment_file(segment).open("ab")
+                        reader = readers[old_segment]
+                        reader.seek(old_offset)
+                        offset = segment_f.tell()
+                        segment_f.write(reader.read(length))
+                        index_f.write(
+                            json.dumps([doc_id, segment, offset, length]) + "\n"
+                        )
+                segment_f.flush()
+                os.fsync(segment_f.fileno())
+            finally:
+                segment_f.close()
+                for reader in readers.values():
+                    reader.close()
+
+            os.replace(tmp_index, self._index_file)
+            for each in old_segments:
+                self._segment_file(each).unlink(missing_ok=True)
+            self._reset()
+            self.refresh()
+
+    def drop(self):
+        with self._lock:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir.mkdir(parents=True, exist_ok=True)
+            self._reset()
+
 
 class SimpleFileDocumentStore(InMemoryDocumentStore):
-    """Improve InMemoryDocumentStore by auto saving whenever the corpus is changed"""
+    """Improve InMemoryDocumentStore by auto saving whenever the corpus is changed
+
+    Two storage modes are available:
+        - "json": the whole corpus is kept in memory and rewritten to
+            `{collection_name}.json` on every change. The changes are made one at
+            a time, for the store to be written from several threads.
+        - "log": documents are appended to segment files under
+            `{collection_name}_segments/` and read back with point reads, so
+            writes cost O(batch) regardless of the corpus size. An existing
+            `{collection_name}.json` is migrated on first use, and kept as
+            `{collection_name}.json.migrated`.
+
+    In both modes, the BM25 full-text index is persisted incrementally to
+    `{collection_name}.bm25.jsonl`, and rebuilt if it is missing or out of sync.
+
+    Args:
+        path: directory holding the collections
+        collection_name: name of the collection
+        mode: "json" or "log"
+        segment_size: in "log" mode, size in bytes of a segment file
+        compact_ratio: in "log" mode, fraction of dead bytes in the segments
+            above which they are compacted after a deletion. 0 or None to disable
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        collection_name: str = "default",
+        mode: str = "json",
+        segment_size: int = 64 * 1024 * 1024,
+        compact_ratio: Optional[float] = 0.5,
+    ):
+        if mode not in ("json", "log"):
+            raise ValueError(f"Unsupported mode {mode}, must be 'json' or 'log'")
 
-    def __init__(self, path: str | Path, collection_name: str = "default"):
         super().__init__()
+        self._lock = threading.RLock()
         self._path = path
         self._collection_name = collection_name
+        self._mode = mode
+        self._segment_size = segment_size
+        self._compact_ratio = compact_ratio
 
         Path(path).mkdir(parents=True, exist_ok=True)
         self._save_path = Path(path) / f"{collection_name}.json"
-        if self._save_path.is_file():
+        self._bm25 = BM25Index(Path(path) / f"{collection_name}.bm25.jsonl")
+        self._log: Optional[_DocumentLog] = None
+        # in "log" mode, file_id of the documents, filled as they are read
+        self._file_ids: dict[str, Optional[str]] = {}
+        if mode == "log":
+            self._log = _DocumentLog(
+                Path(path) / f"{collection_name}_segments", segment_size=segment_size
+            )
+            if self._save_path.is_file():
+                self._migrate()
+            self._sync_fulltext_index()
+        elif self._save_path.is_file():
             self.load(self._save_path)
+        else:
+            self._sync_fulltext_index()
+
+    def _migrate(self):
+        """Move the documents of the json file into the log"""
+        assert self._log is not None
+        logger.info(f"Migrating {self._save_path} to the append-only log")
+        with open(self._save_path) as f:
+            store = json.load(f)
+        self._log.append(list(store.items()))
+        self._save_path.rename(
+            self._save_path.with_suffix(self._save_path.suffix + ".migrated")
+        )
+
+    def _sync_fulltext_index(self):
+        """Rebuild the full-text index if it does not match the stored documents"""
+        if self._log is None:
+            return super()._sync_fulltext_index()
+
+        if self._bm25.doc_ids() != set(self._log.ids()):
+            logger.info(f"Rebuilding the full-text index of {self._collection_name}")
+            self._bm25.clear()
+            self._bm25.add(
+                (doc_id, value.get("text"))
+                for doc_id, value in zip(self._log.ids(), self._log.read_all())
+            )
 
     def get(self, ids: Union[List[str], str]) -> List[Document]:
         """Get document by id"""
         if not isinstance(ids, list):
             ids = [ids]
 
+        if self._log is not None:
+            return [Document.from_dict(value) for value in self._log.read(ids)]
+
         for doc_id in ids:
             if doc_id not in self._store:
-                self.load(self._save_path)
+                with self._lock:
+                    self.load(self._save_path)
                 break
 
         return [self._store[doc_id] for doc_id in ids]
 
+    def get_all(self) -> List[Document]:
+        """Get all documents"""
+        if self._log is not None:
+            return [Document.from_dict(value) for value in self._log.read_all()]
+        return super().get_all()
+
+    def count(self) -> int:
+        """Count number of documents"""
+        if self._log is not None:
+            self._log.refresh()
+            return len(self._log)
+        return super().count()
+
     def add(
         self,
         docs: Union[Document, List[Document]],
@@ -46,18 +385,111 @@ class SimpleFileDocumentStore(InMemoryDocumentStore):
             exist_ok: raise error when duplicate doc-id
                 found in the docstore (default to False)
         """
-        super().add(docs=docs, ids=ids, **kwargs)
-        self.save(self._save_path)
+        if self._log is None:
+            with self._lock:
+                super().add(docs=docs, ids=ids, **kwargs)
+                self.save(self._save_path)
+            return
+
+        exist_ok: bool = kwargs.pop("exist_ok", False)
+        if ids and not isinstance(ids, list):
+            ids = [ids]
+        if not isinstance(docs, list):
+            docs = [docs]
+        doc_ids = ids if ids else [doc.doc_id for doc in docs]
+
+        self._log.refresh()
+        if not exist_ok:
+            for doc_id in doc_ids:
+                if doc_id in self._log:
+                    raise ValueError(f"Document with id {doc_id} already exist")
+
+        self._log.append(
+            [(doc_id, doc.to_dict()) for doc_id, doc in zip(doc_ids, docs)]
+        )
+        self._bm25.add((doc_id, doc.text) for doc_id, doc in zip(doc_ids, docs))
+        for doc_id, doc in zip(doc_ids, docs):
+            self._file_ids[doc_id] = doc.metadata.get("file_id")
+        self._maybe_compact()
 
     def delete(self, ids: Union[List[str], str]):
         """Delete document by id"""
-        super().delete(ids=ids)
-        self.save(self._save_path)
+        if self._log is None:
+            with self._lock:
+                super().delete(ids=ids)
+                self.save(self._save_path)
+            return
+
+        if not isinstance(ids, list):
+            ids = [ids]
+        self._log.refresh()
+        for doc_id in ids:
+            if doc_id not in self._log:
+                raise KeyError(doc_id)
+        self._log.delete(ids)
+        self._bm25.delete(ids)
+        for doc_id in ids:
+            self._file_ids.pop(doc_id, None)
+        self._maybe_compact()
+
+    def query(
+        self,
+        query: str,
+        top_k: int = 10,
+        doc_ids: Optional[list] = None,
+        file_ids: Optional[list] = None,
+    ) -> List[Document]:
+        """Perform full-text search on document store
+
+        Args:
+            query: the query text
+            top_k: number of top documents to return
+            doc_ids: if given, only search among these documents
+            file_ids: if given, only search among the documents whose `file_id`
+                metadata is one of these, instead of `doc_ids`
+
+        Returns:
+            the matched documents, by decreasing BM25 score
+        """
+        if self._log is None:
+            return super().query(
+                query, top_k=top_k, doc_ids=doc_ids, file_ids=file_ids
+            )
+
+        if file_ids:
+            doc_ids = self._doc_ids_of_files(file_ids)
+        matches = self._bm25.search(query, top_k=top_k, doc_ids=doc_ids)
+        return self.get([doc_id for doc_id, _ in matches])
+
+    def _doc_ids_of_files(self, file_ids: list) -> list[str]:
+        """The ids of the logged documents whose `file_id` is one of `file_ids`"""
+        assert self._log is not None
+        self._log.refresh()
+        ids = self._log.ids()
+        missing = [doc_id for doc_id in ids if doc_id not in self._file_ids]
+        if missing:
+            # written before this store was opened, or by another process
+            for doc_id, value in zip(missing, self._log.read(missing)):
+                self._file_ids[doc_id] = value.get("metadata", {}).get("file_id")
+        file_scope = set(file_ids)
+        return [doc_id for doc_id in ids if self._file_ids.get(doc_id) in file_scope]
+
+    def _maybe_compact(self):
+        assert self._log is not None
+        if self._compact_ratio and self._log.dead_ratio() > self._compact_ratio:
+            self._log.compact()
+
+    def compact(self):
+        """Reclaim the space of the overwritten and deleted documents"""
+        if self._log is not None:
+            self._log.compact()
 
     def drop(self):
         """Drop the document store"""
         super().drop()
         self._save_path.unlink(missing_ok=True)
+        if self._log is not None:
+            self._log.drop()
 
     def __persist_flow__(self):
         from theflow.utils.modules import serialize
@@ -65,4 +497,7 @@ class SimpleFileDocumentStore(InMemoryDocumentStore):
         return {
             "path": serialize(self._path),
             "collection_name": self._collection_name,
+            "mode": self._mode,
+            "segment_size": self._segment_size,
+            "compact_ratio": self._compact_ratio,
         }
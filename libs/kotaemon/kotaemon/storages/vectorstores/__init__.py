@@ -3,6 +3,7 @@ from .chroma import ChromaVectorStore
 from .in_memory import InMemoryVectorStore
 from .lancedb import LanceDBVectorStore
 from .milvus import MilvusVectorStore
+from .numpy_file import NumpyVectorStore
 from .qdrant import QdrantVectorStore
 from .simple_file import SimpleFileVectorStore
 
@@ -14,4 +15,5 @@ __all__ = [
     "LanceDBVectorStore",
     "MilvusVectorStore",
     "QdrantVectorStore",
+    "NumpyVectorStore",
 ]
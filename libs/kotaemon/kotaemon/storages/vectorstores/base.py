@@ -158,6 +158,17 @@ class LlamaIndexVectorStore(BaseVectorStore):
         Returns:
             the matched embeddings, the similarity scores, and the ids
         """
+        return self._query_client(self._client, embedding, top_k, ids, **kwargs)
+
+    def _query_client(
+        self,
+        client: LIVectorStore | BasePydanticVectorStore,
+        embedding: list[float],
+        top_k: int,
+        ids: Optional[list[str]],
+        **kwargs,
+    ) -> tuple[list[list[float]], list[float], list[str]]:
+        """Query `client`, a llama-index store configured like `self._client`"""
         vsq_kwargs = {}
         vs_kwargs = {}
         for kwkey, kwvalue in kwargs.items():
@@ -166,7 +177,7 @@ class LlamaIndexVectorStore(BaseVectorStore):
             else:
                 vs_kwargs[kwkey] = kwvalue
 
-        output = self._client.query(
+        output = client.query(
             query=VectorStoreQuery(
                 query_embedding=embedding,
                 similarity_top_k=top_k,
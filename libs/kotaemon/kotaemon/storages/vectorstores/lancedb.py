@@ -1,11 +1,18 @@
-from typing import Any, List, Type, cast
+import logging
+import math
+import threading
+from typing import Any, List, Optional, Type, cast
 
 from llama_index.core.vector_stores.types import MetadataFilters
 from llama_index.vector_stores.lancedb import LanceDBVectorStore as LILanceDBVectorStore
 from llama_index.vector_stores.lancedb import base as base_lancedb
 
+from kotaemon.base import DocumentWithEmbedding
+
 from .base import LlamaIndexVectorStore
 
+logger = logging.getLogger(__name__)
+
 # custom monkey patch for LanceDB
 original_to_lance_filter = base_lancedb._to_lance_filter
 
@@ -28,16 +35,49 @@ base_lancedb._to_lance_filter = custom_to_lance_filter
 
 
 class LanceDBVectorStore(LlamaIndexVectorStore):
+    """LanceDB vector store, with automatic management of its ANN index
+
+    Queries scan the whole table until it holds `index_min_rows` vectors, at which
+    point an `index_type` index is built on the vectors, in a background thread so
+    that the ingestion is not blocked meanwhile. It is then re-optimized, which
+    indexes the new rows incrementally, every time the rows missing from the index
+    exceed `index_optimize_ratio` of the table. A scalar index on the `file_id`
+    metadata keeps the file filters of the queries cheap.
+
+    Args:
+        path: the uri of the LanceDB database
+        collection_name: the name of the table
+        index_min_rows: number of rows from which the vector index is built. None to
+            never build it
+        index_type: type of the vector index, "IVF_PQ" or "IVF_HNSW_SQ"
+        index_metric: distance of the vector index, must match the query metric
+        index_optimize_ratio: fraction of new rows after which the index is
+            re-optimized
+        nprobes: default number of IVF partitions searched by the queries
+        refine_factor: default number of candidates re-ranked with the exact
+            vectors, as a multiple of top_k. None to not refine
+    """
+
     _li_class: Type[LILanceDBVectorStore] = LILanceDBVectorStore
 
     def __init__(
         self,
         path: str = "./lancedb",
         collection_name: str = "default",
+        index_min_rows: Optional[int] = 100_000,
+        index_type: str = "IVF_PQ",
+        index_metric: str = "L2",
+        index_optimize_ratio: float = 0.2,
+        nprobes: int = 20,
+        refine_factor: Optional[int] = None,
         **kwargs: Any,
     ):
         self._path = path
         self._collection_name = collection_name
+        self._index_min_rows = index_min_rows
+        self._index_type = index_type
+        self._index_metric = index_metric
+        self._index_optimize_ratio = index_optimize_ratio
 
         try:
             import lancedb
@@ -59,11 +99,158 @@ class LanceDBVectorStore(LlamaIndexVectorStore):
             uri=path,
             table_name=collection_name,
             table=table,
+            nprobes=nprobes,
+            refine_factor=refine_factor,
             **kwargs,
         )
         self._client = cast(LILanceDBVectorStore, self._client)
         self._client._metadata_keys = ["file_id"]
 
+        self._index_lock = threading.Lock()
+        self._index_build: Optional[threading.Thread] = None
+        # number of rows added since the last build or optimization of the index,
+        # when lancedb can't tell how many rows are missing from the index
+        self._n_unindexed = 0
+        # the columns of the table with an index, listed on the first add
+        self._indexed_columns: Optional[set[str]] = None
+
+    def add(
+        self,
+        embeddings: list[list[float]] | list[DocumentWithEmbedding],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+    ):
+        out_ids = super().add(embeddings, metadatas=metadatas, ids=ids)
+        with self._index_lock:
+            self._n_unindexed += len(out_ids)
+            try:
+                self._maintain_indices()
+            except Exception as e:
+                # the queries are still correct without the indices, only slower
+                logger.warning(f"Cannot update the indices of {self._path}: {e}")
+        return out_ids
+
+    def _list_indexed_columns(self, table) -> set[str]:
+        try:
+            indices = table.list_indices()
+        except AttributeError:
+            # older lancedb, without index listing
+            return set()
+        return {column for index in indices for column in index.columns}
+
+    def _count_unindexed_rows(self, table, column: str) -> int:
+        """Get the number of rows missing from the index of the column"""
+        try:
+            for index in table.list_indices():
+                if column in index.columns:
+                    return table.index_stats(index.name).num_unindexed_rows
+        except AttributeError:
+            # older lancedb, without index statistics
+            pass
+        return self._n_unindexed
+
+    def _build_vector_index(self, table, n_rows: int):
+        vector_column = self._client.vector_column_name
+        logger.info(f"Building the {self._index_type} index of {self._path}")
+        try:
+            dim = len(table.search().limit(1).to_list()[0][vector_column])
+            # sqrt(n) partitions, and sub-vectors of 16 dimensions when possible
+            num_sub_vectors = max(
+                n for n in range(1, max(dim // 16, 1) + 1) if dim % n == 0
+            )
+            table.create_index(
+                metric=self._index_metric,
+                vector_column_name=vector_column,
+                num_partitions=max(1, int(math.sqrt(n_rows))),
+                num_sub_vectors=num_sub_vectors,
+                index_type=self._index_type,
+                replace=True,
+            )
+        except Exception as e:
+            # retried on the next add
+            logger.warning(f"Cannot build the vector index of {self._path}: {e}")
+            return
+
+        with self._index_lock:
+            if self._indexed_columns is not None:
+                self._indexed_columns.add(vector_column)
+            self._n_unindexed = 0
+
+    def _maintain_indices(self):
+        """Build the vector index once the table is large enough, re-optimize it
+        after large ingests, and create the scalar index on file_id"""
+        table = self._client._table
+        if table is None:
+            return
+
+        if self._indexed_columns is None:
+            self._indexed_columns = self._list_indexed_columns(table)
+        n_rows = table.count_rows()
+        vector_column = self._client.vector_column_name
+
+        file_id_column = "metadata.file_id"
+        if file_id_column not in self._indexed_columns:
+            # optimize() then keeps it up to date
+            self._indexed_columns.add(file_id_column)
+            try:
+                table.create_scalar_index(file_id_column, replace=True)
+            except Exception as e:
+                logger.debug(f"Cannot create the scalar index on file_id: {e}")
+
+        if vector_column not in self._indexed_columns:
+            if self._index_min_rows is None or n_rows < self._index_min_rows:
+                return
+            if self._index_build is not None and self._index_build.is_alive():
+                return
+            # the queries scan the table until the index is built
+            self._index_build = threading.Thread(
+                target=self._build_vector_index,
+                args=(table, n_rows),
+                name=f"lancedb-index-{self._collection_name}",
+                daemon=True,
+            )
+            self._index_build.start()
+        elif (
+            self._count_unindexed_rows(table, vector_column)
+            > self._index_optimize_ratio * n_rows
+        ):
+            logger.info(f"Optimizing the indices of {self._path}")
+            # adds the new rows to the existing indices
+            table.optimize()
+            self._n_unindexed = 0
+
+    def query(
+        self,
+        embedding: list[float],
+        top_k: int = 1,
+        ids: Optional[list[str]] = None,
+        **kwargs,
+    ) -> tuple[list[list[float]], list[float], list[str]]:
+        """Return the top k most similar vector embeddings
+
+        Args:
+            embedding: List of embeddings
+            top_k: Number of most similar embeddings to return
+            ids: List of ids of the embeddings to be queried
+            kwargs: extra query parameters, including `nprobes` and
+                `refine_factor` to override the defaults of the store
+
+        Returns:
+            the matched embeddings, the similarity scores, and the ids
+        """
+        overrides = {
+            key: kwargs.pop(key)
+            for key in ["nprobes", "refine_factor"]
+            if key in kwargs
+        }
+        if not overrides:
+            return super().query(embedding, top_k=top_k, ids=ids, **kwargs)
+
+        # the llama-index store reads them from its attributes, so they are set on
+        # a copy of it, which shares the table, for the concurrent queries
+        client = self._client.copy(update=overrides)
+        return self._query_client(client, embedding, top_k, ids, **kwargs)
+
     def delete(self, ids: List[str], **kwargs):
         """Delete vector embeddings from vector stores
 
@@ -76,12 +263,21 @@ class LanceDBVectorStore(LlamaIndexVectorStore):
     def drop(self):
         """Delete entire collection from vector stores"""
         self._client.client.drop_table(self.collection_name)
+        self._indexed_columns = None
+        self._n_unindexed = 0
 
     def count(self) -> int:
-        raise NotImplementedError
+        table = self._client._table
+        return table.count_rows() if table is not None else 0
 
     def __persist_flow__(self):
         return {
             "path": self._path,
             "collection_name": self._collection_name,
+            "index_min_rows": self._index_min_rows,
+            "index_type": self._index_type,
+            "index_metric": self._index_metric,
+            "index_optimize_ratio": self._index_optimize_ratio,
+            "nprobes": self._client.nprobes,
+            "refine_factor": self._client.refine_factor,
         }
@@ -0,0 +1,902 @@
+"""Brute-force vector store backed by a memory-mapped NumPy matrix."""
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+from kotaemon.base import DocumentWithEmbedding
+
+from .base import BaseVectorStore
+
+_SUPPORTED_DTYPES = ("float32", "float16")
+_SUPPORTED_QUANTIZATIONS = ("int8", "binary")
+_SUPPORTED_INDEXES = ("hnsw",)
+# number of rows scored at once, bounds the memory used to up-cast float16 rows
+_SCORE_BLOCK_SIZE = 65536
+# when the filtered rows are fewer than this fraction of the collection, only
+# those rows are gathered and scored instead of scanning the whole matrix
+_GATHER_RATIO = 0.25
+# metadata keys whose rows are listed by value, so that the EQ / IN filters on
+# them only touch the matching rows
+_POSTING_KEYS = ("file_id",)
+# number of rows inserted in the HNSW graph after which it is saved again
+_HNSW_SAVE_EVERY = 10_000
+# number of set bits of each byte value, to compute Hamming distances
+_POPCOUNT = (
+    np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1)
+    .sum(axis=1)
+    .astype(np.int32)
+)
+
+
+def _fsync_dir(path: Path):
+    """Persist the renames in a directory, where supported"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _hashable(value: Any) -> Any:
+    try:
+        hash(value)
+    except TypeError:
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+def _match(value: Any, metadata_filter: MetadataFilter) -> bool:
+    """Evaluate a single filter against a metadata value, row by row"""
+    operator, expected = metadata_filter.operator, metadata_filter.value
+    if operator == FilterOperator.EQ:
+        return value == expected
+    if operator == FilterOperator.NE:
+        return value != expected
+    if operator == FilterOperator.IN:
+        return value in (expected or [])
+    if operator == FilterOperator.NIN:
+        return value not in (expected or [])
+    if value is None:
+        return False
+    if operator == FilterOperator.GT:
+        return value > expected
+    if operator == FilterOperator.GTE:
+        return value >= expected
+    if operator == FilterOperator.LT:
+        return value < expected
+    if operator == FilterOperator.LTE:
+        return value <= expected
+    if operator == FilterOperator.TEXT_MATCH:
+        return str(expected) in str(value)
+    if operator == FilterOperator.CONTAINS:
+        return expected in value
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+class NumpyVectorStore(BaseVectorStore):
+    """Exact (brute-force) vector store kept in a contiguous NumPy matrix
+
+    The vectors are L2-normalized and stored row by row in a float32 (or float16)
+    binary file that is memory-mapped for querying, so a query is a single
+    matrix-vector product followed by `np.argpartition`. Adding appends rows to
+    the file, deleting only records a tombstone: neither rewrites existing data.
+    The ids and metadata of the rows are kept in an append-only JSON-lines log.
+    Deleted rows are physically removed by `compact`, which runs automatically
+    once they make up more than `compact_ratio` of the file.
+
+    The rows of each `file_id` are also listed, so that a query filtered on a few
+    files only gathers and scores their rows, in a time independent of the size
+    of the collection. Larger selections fall back to a scan of the whole matrix.
+
+    With `quantization`, the rows are also encoded in a much smaller matrix of
+    codes, which is scanned instead of the vectors: "int8" keeps one byte per
+    dimension and a scale per row (4x smaller than float32), "binary" keeps the
+    sign of each dimension (32x smaller). The `rescore_multiplier * top_k` best
+    rows of this coarse search are then rescored exactly from the vectors, of
+    which only these rows are read from the disk. A larger multiplier trades
+    latency for recall, binary codes typically need a larger one than int8.
+
+    With `index="hnsw"`, an approximate HNSW graph (from the optional `hnswlib`
+    package) is kept over the rows, so that the queries on large collections
+    don't scan them all. Its nodes are the rows: new rows are inserted in it,
+    deleted rows are only marked as such, and it is rebuilt with the rows when
+    the collection is compacted. It is saved to `hnsw.bin` every
+    `_HNSW_SAVE_EVERY` insertions; the rows added since are inserted on load.
+    Queries narrowed to a few files still score their rows exactly.
+
+    Files stored under `{path}/{collection_name}/`:
+        - meta.json: dimension and dtype of the matrix, and generation of the files
+        - vectors.bin: the raw row-major matrix
+        - rows.jsonl: one record per added row or deleted id
+
+    A compaction writes the matrix and the log of the next generation (e.g.
+    `vectors-1.bin` and `rows-1.jsonl`) then switches to them by replacing
+    meta.json, so that a crash never pairs the vectors of a generation with the
+    rows of another one. The files of the other generations are removed on load.
+
+    Args:
+        path: directory that contains the collections
+        collection_name: name of the collection
+        dtype: "float32" or "float16". Only used when creating the collection,
+            float16 halves the disk and memory footprint at a small precision cost
+        compact_ratio: fraction of deleted rows that triggers a compaction. Set to
+            0 or None to only compact manually
+        quantization: None, "int8" or "binary". The codes are computed from the
+            stored vectors when the mode is enabled on an existing collection
+        rescore_multiplier: number of coarse search candidates rescored exactly,
+            as a multiple of top_k
+        index: None for exact search, or "hnsw"
+        hnsw_m: number of neighbors of each node of the HNSW graph. More costs
+            memory and insertion time for a better recall
+        hnsw_ef_construction: size of the candidate list when inserting rows
+        hnsw_ef: size of the candidate list when querying, at least top_k. More
+            costs latency for a better recall
+    """
+
+    def __init__(
+        self,
+        path: str | Path = "./numpy_vectorstore",
+        collection_name: str = "default",
+        dtype: str = "float32",
+        compact_ratio: Optional[float] = 0.5,
+        quantization: Optional[str] = None,
+        rescore_multiplier: int = 4,
+        index: Optional[str] = None,
+        hnsw_m: int = 16,
+        hnsw_ef_construction: int = 200,
+        hnsw_ef: int = 64,
+        **kwargs: Any,
+    ):
+        if dtype not in _SUPPORTED_DTYPES:
+            raise ValueError(
+                f"Unsupported dtype {dtype}, must be one of {_SUPPORTED_DTYPES}"
+            )
+        if quantization is not None and quantization not in _SUPPORTED_QUANTIZATIONS:
+            raise ValueError(
+                f"Unsupported quantization {quantization}, must be one of "
+                f"{_SUPPORTED_QUANTIZATIONS}"
+            )
+        if index is not None and index not in _SUPPORTED_INDEXES:
+            raise ValueError(
+                f"Unsupported index {index}, must be one of {_SUPPORTED_INDEXES}"
+            )
+
+        self._path = path
+        self._collection_name = collection_name
+        self._dtype = dtype
+        self._compact_ratio = compact_ratio
+        self._quantization = quantization
+        self._rescore_multiplier = rescore_multiplier
+        self._index = index
+        self._hnsw_m = hnsw_m
+        self._hnsw_ef_construction = hnsw_ef_construction
+        self._hnsw_ef = hnsw_ef
+        self._save_path = Path(path) / collection_name
+        self._lock = threading.RLock()
+        self._load()
+
+    @property
+    def _meta_file(self) -> Path:
+        return self._save_path / "meta.json"
+
+    @property
+    def _vectors_file(self) -> Path:
+        return self._generation_files(self._generation)[0]
+
+    @property
+    def _rows_file(self) -> Path:
+        return self._generation_files(self._generation)[1]
+
+    def _generation_files(self, generation: int) -> tuple[Path, Path]:
+        """The matrix and the log of a generation of the collection"""
+        if not generation:
+            return self._save_path / "vectors.bin", self._save_path / "rows.jsonl"
+        return (
+            self._save_path / f"vectors-{generation}.bin",
+            self._save_path / f"rows-{generation}.jsonl",
+        )
+
+    @property
+    def _hnsw_file(self) -> Path:
+        return self._save_path / "hnsw.bin"
+
+    @property
+    def _codes_file(self) -> Path:
+        return self._save_path / f"codes-{self._quantization}.bin"
+
+    @property
+    def _scales_file(self) -> Path:
+        return self._save_path / f"scales-{self._quantization}.bin"
+
+    def _reset(self):
+        self._dim: Optional[int] = None
+        self._generation = 0
+        self._vectors: Optional[np.ndarray] = None
+        # quantized rows, and the scale of each row for int8
+        self._codes: Optional[np.ndarray] = None
+        self._scales: Optional[np.ndarray] = None
+        # the HNSW graph, whose labels are the rows, and its unsaved insertions
+        self._hnsw: Any = None
+        self._hnsw_unsaved = 0
+        self._ids: list[str] = []
+        self._metadatas: list[dict] = []
+        self._id_to_row: dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        # lazily built `metadata key -> (value codes per row, value -> code)`
+        self._columns: dict[str, tuple[np.ndarray, dict]] = {}
+        # `metadata key -> value -> rows`, including the deleted rows
+        self._postings: dict[str, dict[Any, list[int]]] = {
+            key: {} for key in _POSTING_KEYS
+        }
+
+    def _load(self):
+        self._reset()
+        if not self._meta_file.is_file():
+            return
+
+        meta = json.loads(self._meta_file.read_text())
+        self._dim, self._dtype = meta["dim"], meta["dtype"]
+        self._generation = meta.get("generation", 0)
+        self._remove_stale_files()
+        row_size = self._dim * np.dtype(self._dtype).itemsize
+        n_vectors = (
+            self._vectors_file.stat().st_size // row_size
+            if self._vectors_file.is_file()
+            else 0
+        )
+
+        ids: list[str] = []
+        metadatas: list[dict] = []
+        deleted: list[tuple[int, str]] = []
+        # byte size of the log prefix whose records are valid
+        valid_size = 0
+        if self._rows_file.is_file():
+            with self._rows_file.open("rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # partially written trailing record after a crash
+                        break
+                    if "deleted" in record:
+                        deleted.append((len(ids), record["deleted"]))
+                    elif len(ids) < n_vectors:
+                        ids.append(record["id"])
+                        metadatas.append(record.get("metadata") or {})
+                    else:
+                        # the vectors of this record were never written
+                        break
+                    valid_size += len(line)
+
+            if valid_size != self._rows_file.stat().st_size:
+                with self._rows_file.open("r+b") as f:
+                    f.truncate(valid_size)
+        if len(ids) != n_vectors:
+            # drop the vectors written without their record
+            with self._vectors_file.open("r+b") as f:
+                f.truncate(len(ids) * row_size)
+
+        self._append_rows(ids, metadatas)
+        for n_added, id_ in deleted:
+            # only tombstone the rows that were added before the deletion
+            row = self._id_to_row.get(id_)
+            if row is not None and row < n_added:
+                self._tombstone(id_)
+        self._remap()
+        if self._quantization is not None:
+            self._sync_codes()
+        if self._index == "hnsw" and self._ids:
+            self._load_hnsw()
+
+    def _write_meta(self, generation: int = 0):
+        """Replace meta.json in a single atomic step"""
+        tmp_meta = self._meta_file.with_suffix(".json.tmp")
+        with tmp_meta.open("w") as f:
+            json.dump(
+                {
+                    "dim": self._dim,
+                    "dtype": self._dtype,
+                    "generation": generation,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_meta, self._meta_file)
+        _fsync_dir(self._save_path)
+
+    def _remove_stale_files(self):
+        """Remove the files of the other generations, e.g. left by a compaction
+        interrupted before or after switching to the new generation"""
+        current = set(self._generation_files(self._generation))
+        for pattern in ("vectors*.bin", "rows*.jsonl", "*.tmp"):
+            for each in self._save_path.glob(pattern):
+                if each not in current:
+                    each.unlink(missing_ok=True)
+
+    def _remap(self):
+        n_rows = len(self._ids)
+        if not n_rows:
+            self._vectors = None
+            self._codes = self._scales = None
+            return
+        self._vectors = np.memmap(
+            self._vectors_file,
+            dtype=self._dtype,
+            mode="r",
+            shape=(n_rows, self._dim),  # type: ignore[arg-type]
+        )
+        self._codes = self._scales = None
+        if self._quantization is not None and self._has_codes(n_rows):
+            self._codes = np.memmap(
+                self._codes_file,
+                dtype=np.uint8 if self._quantization == "binary" else np.int8,
+                mode="r",
+                shape=(n_rows, self._code_size()),
+            )
+            if self._quantization == "int8":
+                self._scales = np.memmap(
+                    self._scales_file, dtype=np.float32, mode="r", shape=(n_rows,)
+                )
+
+    def _has_codes(self, n_rows: int) -> bool:
+        """Whether the codes (and scales) of the first n_rows rows are written"""
+        files = {self._codes_file: n_rows * self._code_size()}
+        if self._quantization == "int8":
+            files[self._scales_file] = n_rows * 4
+        return all(
+            each.is_file() and each.stat().st_size >= size
+            for each, size in files.items()
+        )
+
+    def _load_hnsw(self):
+        """Load the saved HNSW graph, or build it, and insert the missing rows"""
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("Please install hnswlib: 'pip install hnswlib'")
+
+        n_rows = len(self._ids)
+        graph = hnswlib.Index(space="ip", dim=self._dim)
+        n_indexed = 0
+        if self._hnsw_file.is_file():
+            try:
+                graph.load_index(str(self._hnsw_file), max_elements=n_rows)
+                n_indexed = graph.get_current_count()
+            except RuntimeError:
+                # e.g. truncated by a crash while saving, the graph is rebuilt
+                graph = hnswlib.Index(space="ip", dim=self._dim)
+        if n_indexed > n_rows:
+            # the graph of rows that were lost since, e.g. by a crash
+            graph = hnswlib.Index(space="ip", dim=self._dim)
+            n_indexed = 0
+        if not n_indexed:
+            graph.init_index(
+                max_elements=n_rows,
+                ef_construction=self._hnsw_ef_construction,
+                M=self._hnsw_m,
+            )
+        graph.set_ef(self._hnsw_ef)
+        self._hnsw = graph
+        self._hnsw_unsaved = 0
+
+        self._insert_hnsw(n_indexed, n_rows)
+        for row in np.flatnonzero(~self._alive):
+            self._mark_deleted_hnsw(int(row))
+
+    def _insert_hnsw(self, start: int, end: int):
+        """Insert the rows `start:end` in the HNSW graph, and save it if needed"""
+        assert self._vectors is not None
+        graph = self._hnsw
+        if end > graph.get_max_elements():
+            graph.resize_index(max(end, 2 * graph.get_max_elements()))
+        for block_start in range(start, end, _SCORE_BLOCK_SIZE):
+            block_end = min(block_start + _SCORE_BLOCK_SIZE, end)
+            graph.add_items(
+                self._vectors[block_start:block_end].astype(np.float32),
+                np.arange(block_start, block_end),
+            )
+        self._hnsw_unsaved += end - start
+        if self._hnsw_unsaved >= _HNSW_SAVE_EVERY:
+            tmp_file = self._hnsw_file.with_suffix(".bin.tmp")
+            graph.save_index(str(tmp_file))
+            os.replace(tmp_file, self._hnsw_file)
+            self._hnsw_unsaved = 0
+
+    def _mark_deleted_hnsw(self, row: int):
+        try:
+            self._hnsw.mark_deleted(row)
+        except RuntimeError:
+            # already marked
+            pass
+
+    def _query_hnsw(
+        self, query: np.ndarray, k: int, mask: Optional[np.ndarray]
+    ) -> Optional[np.ndarray]:
+        """Return the rows of the approximate k nearest neighbors among the rows
+        of the mask, None if the graph cannot find k of them"""
+        self._hnsw.set_ef(max(self._hnsw_ef, k))
+        try:
+            labels, _ = self._hnsw.knn_query(
+                query,
+                k=k,
+                filter=None if mask is None else (lambda row: bool(mask[row])),
+            )
+        except RuntimeError:
+            return None
+        return np.sort(labels[0].astype(np.int64))
+
+    def _code_size(self) -> int:
+        assert self._dim is not None
+        if self._quantization == "binary":
+            return (self._dim + 7) // 8
+        return self._dim
+
+    def _encode(self, matrix: np.ndarray) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        """Quantize the normalized rows, return the codes and the scales"""
+        if self._quantization == "binary":
+            return np.packbits(matrix > 0, axis=1), None
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _write_codes(self, matrix: np.ndarray):
+        codes, scales = self._encode(matrix)
+        with self._codes_file.open("ab") as f:
+            f.write(codes.tobytes())
+        if scales is not None:
+            with self._scales_file.open("ab") as f:
+                f.write(scales.tobytes())
+
+    def _sync_codes(self):
+        """Quantize the rows missing from the codes, e.g. if the quantization was
+        enabled on an existing collection, and drop the codes of unknown rows"""
+        n_rows = len(self._ids)
+        if not n_rows:
+            return
+
+        n_codes = (
+            self._codes_file.stat().st_size // self._code_size()
+            if self._codes_file.is_file()
+            else 0
+        )
+        if self._quantization == "int8":
+            n_scales = (
+                self._scales_file.stat().st_size // 4
+                if self._scales_file.is_file()
+                else 0
+            )
+            n_codes = min(n_codes, n_scales)
+        if n_codes == n_rows:
+            return
+
+        n_codes = min(n_codes, n_rows)
+        self._codes_file.touch()
+        with self._codes_file.open("r+b") as f:
+            f.truncate(n_codes * self._code_size())
+        if self._quantization == "int8":
+            self._scales_file.touch()
+            with self._scales_file.open("r+b") as f:
+                f.truncate(n_codes * 4)
+
+        assert self._vectors is not None
+        for start in range(n_codes, n_rows, _SCORE_BLOCK_SIZE):
+            block = self._vectors[start : start + _SCORE_BLOCK_SIZE]
+            self._write_codes(block.astype(np.float32))
+        self._remap()
+
+    def _append_rows(self, ids: list[str], metadatas: list[dict]):
+        """Register rows in memory, tombstoning previous rows with the same ids"""
+        start = len(self._ids)
+        self._ids.extend(ids)
+        self._metadatas.extend(metadatas)
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+        for row, id_ in enumerate(ids, start):
+            self._tombstone(id_)
+            self._id_to_row[id_] = row
+        for key, postings in self._postings.items():
+            for row, metadata in enumerate(metadatas, start):
+                if key in metadata:
+                    postings.setdefault(_hashable(metadata[key]), []).append(row)
+        self._columns.clear()
+
+    def _tombstone(self, id_: str) -> bool:
+        row = self._id_to_row.pop(id_, None)
+        if row is None:
+            return False
+        self._alive[row] = False
+        if self._hnsw is not None and row < self._hnsw.get_current_count():
+            self._mark_deleted_hnsw(row)
+        return True
+
+    def _append_records(self, records: Iterable[dict]):
+        with self._rows_file.open("a") as f:
+            f.write(
+                "".join(json.dumps(record, default=str) + "\n" for record in records)
+            )
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(
+        self,
+        embeddings: list[list[float]] | list[DocumentWithEmbedding],
+        metadatas: Optional[list[dict]] = None,
+        ids: Optional[list[str]] = None,
+    ) -> list[str]:
+        if not embeddings:
+            return []
+
+        if isinstance(embeddings[0], DocumentWithEmbedding):
+            docs: list[DocumentWithEmbedding] = embeddings  # type: ignore
+            vectors = [doc.embedding for doc in docs]
+            metadatas = metadatas or [doc.metadata for doc in docs]
+            ids = ids or [doc.doc_id for doc in docs]
+        else:
+            vectors = embeddings  # type: ignore
+            if ids is None:
+                raise ValueError("ids must be provided when adding raw embeddings")
+        metadatas = metadatas or [{} for _ in vectors]
+
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError("All embeddings must have the same dimension")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            if self._dim is None:
+                self._save_path.mkdir(parents=True, exist_ok=True)
+                self._dim = matrix.shape[1]
+                self._write_meta()
+            elif matrix.shape[1] != self._dim:
+                raise ValueError(
+                    f"Expected embeddings of dimension {self._dim}, "
+                    f"got {matrix.shape[1]}"
+                )
+
+            # vectors are written first: on load, records without vectors are
+            # dropped, as well as vectors without records
+            with self._vectors_file.open("ab") as f:
+                f.write(matrix.astype(self._dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            if self._quantization is not None:
+                self._write_codes(matrix)
+            self._append_records(
+                {"id": id_, "metadata": metadata}
+                for id_, metadata in zip(ids, metadatas)
+            )
+
+            n_indexed = len(self._ids)
+            self._append_rows(list(ids), list(metadatas))
+            self._remap()
+            if self._index == "hnsw":
+                if self._hnsw is None:
+                    self._load_hnsw()
+                else:
+                    self._insert_hnsw(n_indexed, len(self._ids))
+            self._maybe_compact()
+
+        return list(ids)
+
+    def delete(self, ids: list[str], **kwargs):
+        with self._lock:
+            deleted = [id_ for id_ in ids if self._tombstone(id_)]
+            if deleted:
+                self._append_records({"deleted": id_} for id_ in deleted)
+                self._maybe_compact()
+
+    def _maybe_compact(self):
+        n_rows = len(self._ids)
+        if not self._compact_ratio or not n_rows:
+            return
+        if (n_rows - len(self._id_to_row)) / n_rows > self._compact_ratio:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the collection files without the deleted rows"""
+        with self._lock:
+            if self._vectors is None:
+                return
+
+            rows = np.flatnonzero(self._alive)
+            new_vectors, new_rows = self._generation_files(self._generation + 1)
+            with new_vectors.open("wb") as f:
+                for start in range(0, len(rows), _SCORE_BLOCK_SIZE):
+                    block = rows[start : start + _SCORE_BLOCK_SIZE]
+                    f.write(np.ascontiguousarray(self._vectors[block]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with new_rows.open("w") as f:
+                for row in rows:
+                    record = {"id": self._ids[row], "metadata": self._metadatas[row]}
+                    f.write(json.dumps(record, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            # release the memory maps before removing the files they map
+            self._vectors = None
+            self._codes = self._scales = None
+            # the codes and graph are rebuilt from the vectors when missing
+            for each in self._save_path.glob("codes-*.bin"):
+                each.unlink()
+            for each in self._save_path.glob("scales-*.bin"):
+                each.unlink()
+            self._hnsw_file.unlink(missing_ok=True)
+
+            # switch to the new generation, whose files are removed on load if
+            # the switch does not happen
+            self._write_meta(self._generation + 1)
+            self._load()
+
+    def _column(self, key: str) -> tuple[np.ndarray, dict]:
+        """Encode the values of a metadata key as integer codes, -1 when missing"""
+        if key not in self._columns:
+            vocab: dict = {}
+            codes = np.fromiter(
+                (
+                    vocab.setdefault(_hashable(metadata[key]), len(vocab))
+                    if key in metadata
+                    else -1
+                    for metadata in self._metadatas
+                ),
+                dtype=np.int64,
+                count=len(self._metadatas),
+            )
+            self._columns[key] = (codes, vocab)
+        return self._columns[key]
+
+    def _filter_mask(self, filters: MetadataFilters | MetadataFilter) -> np.ndarray:
+        if isinstance(filters, MetadataFilters):
+            masks = [self._filter_mask(each) for each in filters.filters]
+            if not masks:
+                return np.ones(len(self._ids), dtype=bool)
+            if filters.condition == FilterCondition.OR:
+                return np.logical_or.reduce(masks)
+            return np.logical_and.reduce(masks)
+
+        operator = filters.operator
+        if operator in (
+            FilterOperator.EQ,
+            FilterOperator.NE,
+            FilterOperator.IN,
+            FilterOperator.NIN,
+        ):
+            codes, vocab = self._column(filters.key)
+            values = (
+                filters.value
+                if operator in (FilterOperator.IN, FilterOperator.NIN)
+                else [filters.value]
+            )
+            wanted = [
+                vocab[_hashable(value)]
+                for value in values or []
+                if _hashable(value) in vocab
+            ]
+            mask = np.isin(codes, wanted)
+            if operator in (FilterOperator.NE, FilterOperator.NIN):
+                mask = ~mask
+            return mask
+
+        return np.fromiter(
+            (
+                _match(metadata.get(filters.key), filters)
+                for metadata in self._metadatas
+            ),
+            dtype=bool,
+            count=len(self._metadatas),
+        )
+
+    def _posting_rows(
+        self, filters: MetadataFilters | MetadataFilter
+    ) -> Optional[np.ndarray]:
+        """Return the sorted rows matching the filters, deleted ones included, if
+        they can be answered from the postings, else None"""
+        if isinstance(filters, MetadataFilter):
+            filters = MetadataFilters(filters=[filters])
+        if not filters.filters or (
+            len(filters.filters) > 1 and filters.condition != FilterCondition.OR
+        ):
+            return None
+
+        rows: list[int] = []
+        for each in filters.filters:
+            if (
+                not isinstance(each, MetadataFilter)
+                or each.key not in self._postings
+                or each.operator not in (FilterOperator.EQ, FilterOperator.IN)
+            ):
+                return None
+            postings = self._postings[each.key]
+            if each.operator == FilterOperator.IN:
+                values = each.value or []
+            else:
+                values = [each.value]
+            for value in values:
+                rows.extend(postings.get(_hashable(value), []))
+        return np.unique(np.asarray(rows, dtype=np.int64))
+
+    def _score(
+        self, vectors: np.ndarray, query: np.ndarray, rows: Optional[np.ndarray]
+    ) -> np.ndarray:
+        """Compute the cosine similarity of the query with all rows or some rows"""
+        n_rows = len(vectors) if rows is None else len(rows)
+        scores = np.empty(n_rows, dtype=np.float32)
+        for start in range(0, n_rows, _SCORE_BLOCK_SIZE):
+            end = start + _SCORE_BLOCK_SIZE
+            block = vectors[start:end] if rows is None else vectors[rows[start:end]]
+            scores[start:end] = block.astype(np.float32, copy=False) @ query
+        return scores
+
+    def _coarse_score(
+        self,
+        codes: np.ndarray,
+        scales: Optional[np.ndarray],
+        query: np.ndarray,
+        rows: Optional[np.ndarray],
+    ) -> np.ndarray:
+        """Approximate the similarity of the query with all rows or some rows
+        from their codes"""
+        n_rows = len(codes) if rows is None else len(rows)
+        scores = np.empty(n_rows, dtype=np.float32)
+        if self._quantization == "binary":
+            query_code = np.packbits(query > 0)
+        for start in range(0, n_rows, _SCORE_BLOCK_SIZE):
+            end = start + _SCORE_BLOCK_SIZE
+            block_rows = slice(start, end) if rows is None else rows[start:end]
+            block = codes[block_rows]
+            if self._quantization == "binary":
+                # the fewer differing signs, the more similar
+                scores[start:end] = -_POPCOUNT[block ^ query_code].sum(
+                    axis=1, dtype=np.int32
+                )
+            else:
+                assert scales is not None
+                scores[start:end] = (block.astype(np.float32) @ query) * scales[
+                    block_rows
+                ]
+        return scores
+
+    def query(
+        self,
+        embedding: list[float],
+        top_k: int = 1,
+        ids: Optional[list[str]] = None,
+        filters: Optional[MetadataFilters] = None,
+        **kwargs,
+    ) -> tuple[list[list[float]], list[float], list[str]]:
+        """Return the top k most similar vector embeddings
+
+        Args:
+            embedding: the query embedding
+            top_k: Number of most similar embeddings to return
+            ids: if provided, only search among these ids
+            filters: metadata filters that the results must satisfy, e.g.
+                `file_id` IN [...]
+            kwargs: ignored, for compatibility with other vector stores
+
+        Returns:
+            the matched embeddings, the similarity scores, and the ids
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        approximate = False
+        with self._lock:
+            vectors = self._vectors
+            codes, scales = self._codes, self._scales
+            if vectors is None or not top_k:
+                return [], [], []
+            id_list = self._ids
+            n_rows = len(id_list)
+            candidates = self._posting_rows(filters) if filters is not None else None
+            if candidates is not None and len(candidates) < _GATHER_RATIO * n_rows:
+                # narrow selection: only the rows of the selected values are read
+                candidates = candidates[self._alive[candidates]]
+                if ids is not None:
+                    id_rows = [
+                        self._id_to_row[id_] for id_ in ids if id_ in self._id_to_row
+                    ]
+                    candidates = np.intersect1d(candidates, id_rows)
+                mask = None
+            else:
+                mask = self._alive.copy()
+                if filters is not None:
+                    mask &= self._filter_mask(filters)
+                if ids is not None:
+                    id_mask = np.zeros_like(mask)
+                    id_mask[
+                        [self._id_to_row[id_] for id_ in ids if id_ in self._id_to_row]
+                    ] = True
+                    mask &= id_mask
+                candidates = np.flatnonzero(mask)
+
+                if self._hnsw is not None and len(candidates):
+                    # the deleted rows are already skipped by the graph
+                    restricted = filters is not None or ids is not None
+                    rows = self._query_hnsw(
+                        query,
+                        min(top_k, len(candidates)),
+                        mask if restricted else None,
+                    )
+                    if rows is not None:
+                        candidates, approximate = rows, True
+
+        if not len(candidates):
+            return [], [], []
+
+        def score(rows: Optional[np.ndarray]) -> np.ndarray:
+            if codes is None:
+                return self._score(vectors, query, rows)
+            return self._coarse_score(codes, scales, query, rows)
+
+        if approximate:
+            # the neighbors found in the graph are scored exactly
+            scores = self._score(vectors, query, candidates)
+        elif mask is None or len(candidates) < _GATHER_RATIO * n_rows:
+            scores = score(candidates)
+        else:
+            scores = score(None)
+            scores[~mask] = -np.inf
+            scores = scores[candidates]
+
+        if codes is not None and not approximate:
+            # rescore the best candidates of the coarse search exactly
+            n_rescored = min(len(candidates), top_k * self._rescore_multiplier)
+            shortlist = np.argpartition(-scores, n_rescored - 1)[:n_rescored]
+            candidates = np.sort(candidates[shortlist])
+            scores = self._score(vectors, query, candidates)
+
+        k = min(top_k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        rows = candidates[top]
+
+        return (
+            vectors[rows].astype(np.float32).tolist(),
+            scores[top].tolist(),
+            [id_list[row] for row in rows],
+        )
+
+    def count(self) -> int:
+        return len(self._id_to_row)
+
+    def drop(self):
+        """Delete the collection"""
+        with self._lock:
+            self._vectors = None
+            shutil.rmtree(self._save_path, ignore_errors=True)
+            self._reset()
+
+    def __persist_flow__(self):
+        return {
+            "path": str(self._path),
+            "collection_name": self._collection_name,
+            "dtype": self._dtype,
+            "compact_ratio": self._compact_ratio,
+            "quantization": self._quantization,
+            "rescore_multiplier": self._rescore_multiplier,
+            "index": self._index,
+            "hnsw_m": self._hnsw_m,
+            "hnsw_ef_construction": self._hnsw_ef_construction,
+            "hnsw_ef": self._hnsw_ef,
+        }
@@ -1,3 +1,5 @@
+import base64
+import json
 import os
 from unittest.mock import patch
 
@@ -7,8 +9,13 @@ from elastic_transport import ApiResponseMeta
 from kotaemon.base import Document
 from kotaemon.storages import (
     ElasticsearchDocumentStore,
+    FileBlobStore,
     InMemoryDocumentStore,
+    LanceDBDocumentStore,
     SimpleFileDocumentStore,
+    blob_keys,
+    resolve_blob_uri,
+    store_images,
 )
 
 meta_success = ApiResponseMeta(
@@ -268,6 +275,86 @@ def test_inmemory_document_store_base_interfaces(tmp_path):
     os.remove(tmp_path / "store.json")
 
 
+def test_inmemory_document_store_query():
+    store = InMemoryDocumentStore()
+    store.add(
+        [
+            Document(text="The cat sat on the mat", id_="cat"),
+            Document(text="Dogs chase cats in the park", id_="dog"),
+            Document(text="Quarterly revenue grew by ten percent", id_="revenue"),
+            Document(text="日本語のテキスト", id_="ja"),
+        ]
+    )
+
+    assert [doc.doc_id for doc in store.query("revenue growth")] == ["revenue"]
+    assert [doc.doc_id for doc in store.query("the cat", top_k=1)] == ["cat"]
+    assert [doc.doc_id for doc in store.query("テキスト")] == ["ja"]
+    assert store.query("cat mat", doc_ids=["dog", "revenue"]) == []
+
+    store.delete("cat")
+    assert store.query("mat") == []
+    store.add(Document(text="A mat for the dog", id_="dog"), exist_ok=True)
+    assert [doc.doc_id for doc in store.query("mat")] == ["dog"]
+
+
+def test_simplefile_document_store_query(tmp_path):
+    for mode in ["json", "log"]:
+        store = SimpleFileDocumentStore(path=tmp_path, collection_name=mode, mode=mode)
+        store.add(
+            [
+                Document(text="The cat sat on the mat", id_="cat"),
+                Document(text="Quarterly revenue grew by ten percent", id_="revenue"),
+            ]
+        )
+        store.delete("cat")
+        store.add(Document(text="A mat for the dog", id_="dog"))
+
+        # the full-text index is persisted alongside the documents
+        store2 = SimpleFileDocumentStore(path=tmp_path, collection_name=mode, mode=mode)
+        assert [doc.doc_id for doc in store2.query("mat")] == ["dog"]
+        assert store2.query("revenue", doc_ids=["dog"]) == []
+
+        # and rebuilt when missing
+        (tmp_path / f"{mode}.bm25.jsonl").unlink()
+        store3 = SimpleFileDocumentStore(path=tmp_path, collection_name=mode, mode=mode)
+        assert [doc.text for doc in store3.query("revenue")] == [
+            "Quarterly revenue grew by ten percent"
+        ]
+
+
+@pytest.mark.parametrize("mode", ["memory", "json", "log"])
+def test_document_store_query_file_ids(tmp_path, mode):
+    def open_store():
+        if mode == "memory":
+            return store
+        return SimpleFileDocumentStore(path=tmp_path, mode=mode)
+
+    file_a, file_b, file_c = ({"file_id": each} for each in "abc")
+    store = InMemoryDocumentStore() if mode == "memory" else open_store()
+    store.add(
+        [
+            Document(text="The cat sat on the mat", id_="cat", metadata=file_a),
+            Document(text="A mat for the dog", id_="dog", metadata=file_b),
+            Document(text="A mat for the bird", id_="bird", metadata=file_c),
+        ]
+    )
+    store.delete("bird")
+
+    store2 = open_store()
+    assert sorted(doc.doc_id for doc in store2.query("mat", file_ids=["a", "c"])) == [
+        "cat"
+    ]
+    store2.add(Document(text="A mat for the fish", id_="fish", metadata=file_c))
+    assert sorted(doc.doc_id for doc in store2.query("mat", file_ids=["b", "c"])) == [
+        "dog",
+        "fish",
+    ]
+    # the file ids take precedence over the document ids
+    assert [
+        doc.doc_id for doc in store2.query("mat", doc_ids=["cat"], file_ids=["b"])
+    ] == ["dog"]
+
+
 def test_simplefile_document_store_base_interfaces(tmp_path):
     """Test all interfaces of a a document store"""
 
@@ -322,6 +409,138 @@ def test_simplefile_document_store_base_interfaces(tmp_path):
     os.remove(tmp_path / "default.json")
 
 
+def test_simple_file_document_store_log_mode(tmp_path):
+    docs = [
+        Document(text=f"Sample text {idx}", metadata={"meta_key": f"meta_value_{idx}"})
+        for idx in range(10)
+    ]
+
+    # migrate from an existing json collection
+    SimpleFileDocumentStore(path=tmp_path).add(docs[:5])
+    store = SimpleFileDocumentStore(path=tmp_path, mode="log", compact_ratio=None)
+    assert not (tmp_path / "default.json").exists(), "Json file should be migrated"
+    assert store.count() == 5, "Document store should have 5 migrated documents"
+
+    store.add(docs[5:])
+    assert store.count() == 10, "Document store should have 10 documents"
+    with pytest.raises(ValueError):
+        store.add(docs[0])
+    store.add(Document(text="Updated text"), ids=docs[0].doc_id, exist_ok=True)
+    store.delete([docs[1].doc_id, docs[2].doc_id])
+
+    matched = store.get([docs[0].doc_id, docs[9].doc_id])
+    assert [doc.text for doc in matched] == ["Updated text", "Sample text 9"]
+    assert matched[1].metadata == {"meta_key": "meta_value_9"}
+    with pytest.raises(KeyError):
+        store.get(docs[1].doc_id)
+
+    # another instance sees the documents written by the first one
+    store2 = SimpleFileDocumentStore(path=tmp_path, mode="log")
+    assert store2.count() == 8, "Loaded document store should have 8 documents"
+    store.add(Document(text="New text", id_="new"))
+    assert store2.get("new")[0].text == "New text"
+
+    segments_dir = tmp_path / "default_segments"
+    size_before = sum(f.stat().st_size for f in segments_dir.glob("segment-*"))
+    store.compact()
+    size_after = sum(f.stat().st_size for f in segments_dir.glob("segment-*"))
+    assert size_after < size_before, "Compaction should reclaim dead documents"
+    assert store2.get(docs[0].doc_id)[0].text == "Updated text"
+    assert len(store2.get_all()) == 9
+
+    store.drop()
+    assert SimpleFileDocumentStore(path=tmp_path, mode="log").count() == 0
+
+
+def test_lancedb_document_store_deferred_refresh(tmp_path):
+    pytest.importorskip("lancedb")
+    pytest.importorskip("tantivy")
+
+    store = LanceDBDocumentStore(path=str(tmp_path))
+    store.add(
+        [
+            Document(text="The cat sat on the mat", id_="cat"),
+            Document(text="Quarterly revenue grew by ten percent", id_="revenue"),
+        ]
+    )
+
+    with patch.object(
+        store, "_save_indexed_version", wraps=store._save_indexed_version
+    ) as rebuilds:
+        with store.deferred_refresh():
+            store.add([Document(text="A mat for the dog", id_="dog")])
+            store.delete("cat")
+            # searched by brute force, or filtered out, until the rebuild
+            assert [doc.doc_id for doc in store.query("mat")] == ["dog"]
+            assert store.query("cat") == []
+            assert [doc.doc_id for doc in store.query("revenue")] == ["revenue"]
+            assert rebuilds.call_count == 0
+
+        assert rebuilds.call_count == 1
+        assert store._unindexed.doc_ids() == set() and not store._deleted_ids
+        assert [doc.doc_id for doc in store.query("mat")] == ["dog"]
+        assert store.query("cat") == []
+
+    # a change not indexed before a restart is indexed when the table is reopened
+    store.add([Document(text="A mat for the fish", id_="fish")], refresh_indices=False)
+    store2 = LanceDBDocumentStore(path=str(tmp_path))
+    table_version = store2.db_connection.open_table("docstore").version
+    assert store2._indexed_version() != table_version
+    assert [doc.doc_id for doc in store2.query("fish")] == ["fish"]
+    assert store2._indexed_version() == store2._table.version
+
+
+def test_lancedb_document_store_typed_columns(tmp_path, monkeypatch):
+    lancedb = pytest.importorskip("lancedb")
+    pytest.importorskip("tantivy")
+    from kotaemon.storages.docstores import lancedb as lancedb_docstore
+
+    # a table created before the typed columns existed
+    rows = [
+        {
+            "id": f"chunk-{idx}",
+            "text": f"Chunk {idx} of the report",
+            "attributes": json.dumps({"file_id": f"file-{idx % 2}", "page_label": idx}),
+        }
+        for idx in range(5)
+    ]
+    lancedb.connect(str(tmp_path)).create_table("docstore", data=rows)
+
+    store = LanceDBDocumentStore(path=str(tmp_path))
+    assert store.get("chunk-3")[0].metadata == {"file_id": "file-1", "page_label": 3}
+    migrated = {row["id"]: row for row in store._table.to_arrow().to_pylist()}
+    assert migrated["chunk-3"]["file_id"] == "file-1"
+    assert migrated["chunk-3"]["page_label"] == "3"
+    assert migrated["chunk-3"]["type"] is None
+
+    # the lookups are split in several batches
+    monkeypatch.setattr(lancedb_docstore, "GET_BATCH_SIZE", 2)
+    ids = [row["id"] for row in rows]
+    assert sorted(doc.doc_id for doc in store.get(ids)) == ids
+
+    assert sorted(
+        doc.doc_id for doc in store.query("report", file_ids=["file-1"])
+    ) == ["chunk-1", "chunk-3"]
+    store.add(
+        [Document(text="Chunk 5 of the report", id_="chunk-5")],
+        refresh_indices=False,
+    )
+    store.add(
+        [
+            Document(
+                text="Chunk 6 of the report",
+                id_="chunk-6",
+                metadata={"file_id": "file-1"},
+            )
+        ],
+        refresh_indices=False,
+    )
+    # including the chunks not indexed yet
+    assert sorted(
+        doc.doc_id for doc in store.query("report", file_ids=["file-1"])
+    ) == ["chunk-1", "chunk-3", "chunk-6"]
+
+
 @patch(
     "elastic_transport.Transport.perform_request",
     side_effect=_elastic_search_responses,
@@ -354,3 +573,30 @@ def test_elastic_document_store(elastic_api):
     assert store.count() == 2, "Document store delete() failed"
 
     elastic_api.assert_called()
+
+
+def test_file_blob_store(tmp_path):
+    store = FileBlobStore(tmp_path / "blobs")
+    image = "data:image/png;base64," + base64.b64encode(b"png bytes").decode()
+
+    docs = [
+        Document(text="figure", metadata={"image_origin": image, "type": "image"}),
+        Document(text="same figure", metadata={"image_origin": image}),
+        Document(text="no figure", metadata={"image_origin": "https://x.org/a.png"}),
+    ]
+    store_images(docs, store)
+
+    blob_uri = docs[0].metadata["image_origin"]
+    assert blob_uri.startswith("kh-blob://") and blob_uri.endswith(".png")
+    assert docs[1].metadata["image_origin"] == blob_uri, "blobs are deduplicated"
+    assert docs[2].metadata["image_origin"] == "https://x.org/a.png"
+    assert len(list((tmp_path / "blobs").glob("*/*"))) == 1
+
+    assert resolve_blob_uri(blob_uri, store) == image
+    assert resolve_blob_uri("https://x.org/a.png", store) == "https://x.org/a.png"
+
+    assert blob_keys(docs) == {blob_uri[len("kh-blob://") :]}
+    store.delete(blob_keys(docs))
+    assert resolve_blob_uri(blob_uri, store) == ""
+    with pytest.raises(ValueError):
+        store.get("../secret")
@@ -7,6 +7,7 @@ from openai.types.create_embedding_response import CreateEmbeddingResponse
 from kotaemon.base import Document
 from kotaemon.embeddings import (
     AzureOpenAIEmbeddings,
+    CachedEmbeddings,
     FastEmbedEmbeddings,
     LCCohereEmbeddings,
     LCHuggingFaceEmbeddings,
@@ -155,3 +156,119 @@ def test_fastembed_embeddings():
     model = FastEmbedEmbeddings()
     output = model("Hello World")
     assert_embedding_result(output)
+
+
+def make_openai_embedding_response(*args, **kwargs):
+    """Embed each input text as [its trailing number, its length]"""
+    return CreateEmbeddingResponse.model_validate(
+        {
+            "object": "list",
+            "model": "text-embedding-ada-002",
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": idx,
+                    "embedding": [float(text.split()[-1]), float(len(text))],
+                }
+                for idx, text in enumerate(kwargs["input"])
+            ],
+        }
+    )
+
+
+@patch(
+    "openai.resources.embeddings.Embeddings.create",
+    side_effect=make_openai_embedding_response,
+)
+def test_openai_embeddings_concurrent_batches(openai_embedding_call):
+    model = OpenAIEmbeddings(
+        api_key="some-key",
+        model="text-embedding-ada-002",
+        max_batch_size=3,
+        max_concurrency=4,
+    )
+    texts = [f"text {idx}" for idx in range(10)]
+    output = model(texts)
+
+    assert openai_embedding_call.call_count == 4
+    assert [doc.embedding[0] for doc in output] == list(range(10))
+    assert [doc.text for doc in output] == texts
+
+
+def test_openai_embeddings_split_batches_by_tokens():
+    model = OpenAIEmbeddings(
+        api_key="some-key",
+        model="text-embedding-ada-002",
+        max_batch_tokens=10,
+    )
+    batches = model.split_batches([[0] * 4, [0] * 4, [0] * 4, [0] * 20, [0]])
+    assert batches == [(0, 2), (2, 3), (3, 4), (4, 5)]
+
+
+def test_openai_embeddings_retry_after():
+    from httpx import Request, Response
+    from openai import RateLimitError
+
+    from kotaemon.embeddings.openai import get_retry_after
+
+    def rate_limit_error(headers):
+        response = Response(
+            429, headers=headers, request=Request("POST", "https://api.openai.com")
+        )
+        return RateLimitError("rate limited", response=response, body=None)
+
+    assert get_retry_after(rate_limit_error({"retry-after-ms": "250"})) == 0.25
+    assert get_retry_after(rate_limit_error({"retry-after": "3"})) == 3
+    assert (
+        get_retry_after(
+            rate_limit_error(
+                {
+                    "x-ratelimit-reset-tokens": "1m30s",
+                    "x-ratelimit-reset-requests": "2s",
+                }
+            )
+        )
+        == 90
+    )
+    assert get_retry_after(rate_limit_error({})) is None
+
+
+@patch(
+    "openai.resources.embeddings.Embeddings.create",
+    side_effect=lambda *args, **kwargs: openai_embedding,
+)
+def test_cached_embeddings(openai_embedding_call, tmp_path):
+    model = CachedEmbeddings(
+        embedding=OpenAIEmbeddings(api_key="some-key", model="text-embedding-ada-002"),
+        cache_path=str(tmp_path / "embedding_cache.db"),
+    )
+    output = model("Hello world")
+    assert_embedding_result(output)
+    assert openai_embedding_call.call_count == 1
+
+    # identical text is served from the cache, even with a rotated api key
+    model.embedding.api_key = "another-key"
+    cached_output = model("Hello world")
+    assert_embedding_result(cached_output)
+    assert cached_output[0].embedding == output[0].embedding
+    assert openai_embedding_call.call_count == 1
+    assert model.stats()["hits"] == 1
+    assert model.stats()["misses"] == 1
+
+    # a different model doesn't share the cached vectors
+    model.embedding.dimensions = 256
+    model("Hello world")
+    assert openai_embedding_call.call_count == 2
+
+
+def test_cached_embeddings_eviction(tmp_path):
+    from kotaemon.embeddings import EmbeddingCache
+
+    cache = EmbeddingCache(tmp_path / "embedding_cache.db", max_entries=2)
+    cache.put_many({"a": [1.0], "b": [2.0]})
+    assert cache.get_many(["a"]) == {"a": [1.0]}
+    cache.put_many({"c": [3.0]})
+
+    assert cache.count() == 2
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
@@ -3,11 +3,13 @@ from pathlib import Path
 from typing import cast
 from unittest.mock import patch
 
+import pytest
 from openai.types.create_embedding_response import CreateEmbeddingResponse
 
 from kotaemon.base import Document
 from kotaemon.embeddings import AzureOpenAIEmbeddings
 from kotaemon.indices import VectorIndexing, VectorRetrieval
+from kotaemon.indices.fusion import reciprocal_rank_fusion, weighted_score_fusion
 from kotaemon.storages import ChromaVectorStore, InMemoryDocumentStore
 
 with open(Path(__file__).parent / "resources" / "embedding_openai.json") as f:
@@ -65,3 +67,117 @@ def test_retrieving(tmp_path):
 
     assert len(output) == 1, "Expect 1 results"
     assert output == output1, "Expect identical results"
+
+
+@patch(
+    "openai.resources.embeddings.Embeddings.create",
+    side_effect=lambda *args, **kwargs: openai_embedding,
+)
+def test_retrieving_scope(tmp_path):
+    db = ChromaVectorStore(path=str(tmp_path))
+    doc_store = InMemoryDocumentStore()
+    embedding = AzureOpenAIEmbeddings(
+        azure_deployment="text-embedding-ada-002",
+        azure_endpoint="https://test.openai.azure.com/",
+        api_key="some-key",
+        api_version="version",
+    )
+
+    index_pipeline = VectorIndexing(
+        vector_store=db, embedding=embedding, doc_store=doc_store
+    )
+    retrieval_pipeline = VectorRetrieval(
+        vector_store=db, doc_store=doc_store, embedding=embedding, top_k=10
+    )
+
+    # a duplicate file shares the chunks of the file that created them
+    scope = [f"chunk-{idx}" for idx in range(3)]
+    for chunk_id in scope:
+        index_pipeline(
+            text=Document(
+                text=f"Hello world {chunk_id}", id_=chunk_id, metadata={"file_id": "a"}
+            )
+        )
+    output = retrieval_pipeline(text="Hello world", scope=scope)
+    assert sorted(doc.doc_id for doc in output) == scope
+
+    # the reindexed file keeps its id, its new chunks are not in the scope
+    index_pipeline(
+        text=Document(text="Hello world", id_="chunk-new", metadata={"file_id": "a"})
+    )
+    output1 = retrieval_pipeline(text="Hello world", scope=scope)
+    assert [doc.doc_id for doc in output1] == [doc.doc_id for doc in output]
+
+
+def test_retrieving_scope_widens_search(tmp_path):
+    retrieval_pipeline = VectorRetrieval(
+        vector_store=ChromaVectorStore(path=str(tmp_path)),
+        doc_store=InMemoryDocumentStore(),
+        embedding=AzureOpenAIEmbeddings(
+            azure_deployment="text-embedding-ada-002",
+            azure_endpoint="https://test.openai.azure.com/",
+            api_key="some-key",
+            api_version="version",
+        ),
+    )
+    # the documents of the scope are ranked after many others
+    ranked = [f"other-{idx}" for idx in range(10)] + ["chunk-0", "chunk-1"]
+
+    def query(embedding, top_k, **kwargs):
+        ids = ranked[:top_k]
+        return [], [1.0 / (rank + 1) for rank in range(len(ids))], ids
+
+    with patch.object(ChromaVectorStore, "query", side_effect=query) as mock:
+        scores, ids = retrieval_pipeline._query_vectorstore(
+            [0.1], top_k=2, scope=["chunk-0", "chunk-1"]
+        )
+        assert ids == ["chunk-0", "chunk-1"]
+        assert scores == [1 / 11, 1 / 12]
+        assert [call.kwargs["top_k"] for call in mock.call_args_list] == [4, 8, 16]
+
+        # stop once the store is exhausted
+        mock.reset_mock()
+        _, ids = retrieval_pipeline._query_vectorstore(
+            [0.1], top_k=3, scope=["chunk-1", "missing"]
+        )
+        assert ids == ["chunk-1"]
+        assert [call.kwargs["top_k"] for call in mock.call_args_list] == [6, 12, 24]
+
+
+def test_fusion_functions():
+    scores = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=1)
+    assert scores == pytest.approx({"a": 1 / 2 + 1 / 3, "b": 1 / 3, "c": 1 / 4 + 1 / 2})
+
+    scores = weighted_score_fusion(
+        [[("a", 0.9), ("b", 0.7), ("c", 0.5)], [("c", None), ("d", None)]],
+        weights=[0.5, 0.5],
+    )
+    assert scores == pytest.approx({"a": 0.5, "b": 0.25, "c": 0.5, "d": 0.0})
+
+
+def test_hybrid_fusion(tmp_path):
+    retrieval_pipeline = VectorRetrieval(
+        vector_store=ChromaVectorStore(path=str(tmp_path)),
+        doc_store=InMemoryDocumentStore(),
+        embedding=AzureOpenAIEmbeddings(
+            azure_deployment="text-embedding-ada-002",
+            azure_endpoint="https://test.openai.azure.com/",
+            api_key="some-key",
+            api_version="version",
+        ),
+    )
+    docs = {id_: Document(text=id_, id_=id_) for id_ in ["a", "b", "c", "d"]}
+    vs_ids, vs_scores = ["a", "b", "c"], [0.9, 0.8, 0.7]
+    # the docstore may return the documents in any order
+    vs_docs = [docs["c"], docs["a"], docs["b"]]
+    ds_docs = [docs["c"], docs["d"], docs["b"]]
+
+    result = retrieval_pipeline._fuse(vs_ids, vs_scores, vs_docs, ds_docs)
+    assert [doc.doc_id for doc in result] == ["c", "b", "a", "d"]
+    assert [doc.score for doc in result] == [0.7, 0.8, 0.9, -1.0]
+
+    retrieval_pipeline.fusion_method = "weighted"
+    retrieval_pipeline.vector_weight = 0.8
+    result = retrieval_pipeline._fuse(vs_ids, vs_scores, vs_docs, ds_docs)
+    assert [doc.doc_id for doc in result] == ["a", "b", "c", "d"]
+    assert result[0].metadata["fusion_score"] == pytest.approx(0.8)
@@ -8,11 +8,16 @@ from kotaemon.base import Document
 from kotaemon.loaders import (
     AutoReader,
     AzureAIDocumentIntelligenceLoader,
+    CachedReader,
     DocxReader,
     HtmlReader,
     MhtmlReader,
+    PDFThumbnailReader,
     UnstructuredReader,
+    pdf_loader,
 )
+from kotaemon.loaders.utils.adobe import generate_figure_captions
+from kotaemon.storages import resolve_blob_uri
 
 from .conftest import skip_when_unstructured_pdf_not_installed
 
@@ -74,6 +79,101 @@ def test_unstructured_pdf_reader():
     assert len(documents) == 1
 
 
+def test_pdf_thumbnail_reader(tmp_path, monkeypatch):
+    input_path = Path(__file__).parent / "resources" / "multimodal.pdf"
+
+    reader = PDFThumbnailReader(image_format="jpeg", max_size=100, n_workers=2)
+    # render each page in its own process
+    monkeypatch.setattr(pdf_loader, "PDF_THUMBNAIL_PAGES_PER_TASK", 1)
+    thumbnails = [
+        doc for doc in reader.load_data(input_path) if doc.metadata.get("type")
+    ]
+    assert [doc.metadata["page_label"] for doc in thumbnails] == ["1", "2", "3"]
+    assert all(
+        doc.metadata["image_origin"].startswith("data:image/jpeg;base64,")
+        for doc in thumbnails
+    )
+
+    reader = PDFThumbnailReader(thumbnail_mode="none")
+    assert not any(doc.metadata.get("type") for doc in reader.load_data(input_path))
+
+    reader = PDFThumbnailReader(thumbnail_mode="deferred")
+    thumbnails = [
+        doc for doc in reader.load_data(input_path) if doc.metadata.get("type")
+    ]
+    uri = thumbnails[1].metadata["image_origin"]
+    assert uri.startswith(pdf_loader.PDF_PAGE_URI_PREFIX)
+
+    # the file storage keeps the files of each index under their sha256
+    file_hash = uri[len(pdf_loader.PDF_PAGE_URI_PREFIX) :].split("/")[0]
+    (tmp_path / "index_1").mkdir()
+    (tmp_path / "index_1" / file_hash).write_bytes(input_path.read_bytes())
+    monkeypatch.setattr(
+        pdf_loader.flowsettings, "KH_FILESTORAGE_PATH", str(tmp_path), raising=False
+    )
+    assert resolve_blob_uri(uri).startswith("data:image/png;base64,")
+
+
+def test_pdf_thumbnail_reader_lazy(monkeypatch):
+    input_path = Path(__file__).parent / "resources" / "multimodal.pdf"
+    reader = PDFThumbnailReader(n_workers=2)
+    monkeypatch.setattr(pdf_loader, "PDF_THUMBNAIL_PAGES_PER_TASK", 1)
+
+    documents = reader.load_data(input_path)
+    lazy_documents = list(reader.lazy_load_data(input_path))
+    assert sorted((doc.text, doc.metadata["page_label"]) for doc in documents) == (
+        sorted((doc.text, doc.metadata["page_label"]) for doc in lazy_documents)
+    )
+    # the thumbnail of each page comes before its text
+    assert [doc.metadata.get("type", "text") for doc in lazy_documents] == [
+        "thumbnail",
+        "text",
+    ] * 3
+
+
+@patch("kotaemon.loaders.utils.adobe.generate_gpt4v")
+def test_generate_figure_captions(mock_generate):
+    mock_generate.side_effect = lambda endpoint, prompt, images: f"caption {images}"
+    figures = ["data:image/png;base64,logo", "data:image/png;base64,chart"]
+
+    captions = generate_figure_captions("http://vlm", figures + figures[:1], 3)
+    assert captions == [
+        "caption data:image/png;base64,logo",
+        "caption data:image/png;base64,chart",
+        "caption data:image/png;base64,logo",
+    ]
+    # the repeated figure is captioned once
+    assert mock_generate.call_count == 2
+
+    # the captions are cached across documents
+    assert generate_figure_captions("http://vlm", figures[::-1], 1) == [
+        "caption data:image/png;base64,chart",
+        "",
+    ]
+    assert mock_generate.call_count == 2
+
+
+def test_cached_reader(tmp_path):
+    input_path = Path(__file__).parent / "resources" / "multimodal.pdf"
+    cache_path = str(tmp_path / "parse_cache.db")
+    reader = CachedReader(
+        loader=PDFThumbnailReader(thumbnail_mode="none"), cache_path=cache_path
+    )
+
+    documents = reader.load_data(input_path, extra_info={"file_id": "a"})
+    with patch.object(PDFThumbnailReader, "load_data") as mock_load:
+        cached_documents = reader.load_data(input_path, extra_info={"file_id": "b"})
+        assert not mock_load.called
+    assert [doc.text for doc in cached_documents] == [doc.text for doc in documents]
+    assert all(doc.metadata["file_id"] == "b" for doc in cached_documents)
+    assert reader.stats()["hits"] == 1
+
+    # other loader params produce other documents
+    reader = CachedReader(loader=PDFThumbnailReader(), cache_path=cache_path)
+    assert len(reader.load_data(input_path)) == 2 * len(documents)
+    assert reader.stats()["entries"] == 2
+
+
 def test_mhtml_reader():
     reader = MhtmlReader()
     input_path = Path(__file__).parent / "resources" / "dummy.mhtml"
@@ -1,7 +1,7 @@
 from llama_index.core.schema import NodeRelationship
 
 from kotaemon.base import Document
-from kotaemon.indices.splitters import TokenSplitter
+from kotaemon.indices.splitters import TiktokenSplitter, TokenSplitter
 
 source1 = Document(
     content="The City Hall and Raffles Place MRT stations are paired cross-platform "
@@ -53,3 +53,36 @@ def test_split_token():
     )
     assert chunks[1].relationships[NodeRelationship.NEXT].node_id == chunks[2].doc_id
     assert chunks[-1].relationships[NodeRelationship.SOURCE].node_id == source2.doc_id
+
+
+def test_split_tiktoken():
+    """Test that it splits on the token windows and records the token counts"""
+    splitter = TiktokenSplitter(chunk_size=30, chunk_overlap=10)
+    chunks = splitter([source1, source2])
+
+    assert isinstance(chunks[0], Document), "Chunks should be a list of Documents"
+    for chunk in chunks:
+        assert chunk.metadata["token_count"] <= 30
+        assert "token_count" in chunk.excluded_embed_metadata_keys
+
+    assert chunks[0].text.startswith("The City Hall")
+    assert chunks[0].relationships[NodeRelationship.SOURCE].node_id == source1.doc_id
+    assert (
+        chunks[1].relationships[NodeRelationship.PREVIOUS].node_id == chunks[0].doc_id
+    )
+    assert chunks[-1].relationships[NodeRelationship.SOURCE].node_id == source2.doc_id
+    assert chunks[-1].text.endswith("New South Wales.")
+
+
+def test_split_tiktoken_executor():
+    """Test that splitting in an executor gives the same chunks"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    splitter = TiktokenSplitter(chunk_size=30, chunk_overlap=10)
+    expected = [chunk.text for chunk in splitter([source1, source2])]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        splitter = TiktokenSplitter(
+            chunk_size=30, chunk_overlap=10, executor=executor, min_chars_per_task=100
+        )
+        assert [chunk.text for chunk in splitter([source1, source2])] == expected
@@ -1,9 +1,12 @@
 import json
+import random
 from pathlib import Path
 
 import pytest
 
 from kotaemon.loaders import MathpixPDFReader, OCRReader, PandasExcelReader
+from kotaemon.loaders.utils.box import BoxIndex, bbox_to_points, get_rect_iou
+from kotaemon.loaders.utils.pdf_ocr import merge_ocr_and_pdf_texts
 
 from .conftest import skip_when_unstructured_pdf_not_installed
 
@@ -49,3 +52,38 @@ def test_excel_reader():
         input_file_excel,
     )
     assert len(documents) == 1
+
+
+def test_box_index():
+    rng = random.Random(0)
+
+    def random_location():
+        x, y = rng.randint(0, 1000), rng.randint(0, 1000)
+        w, h = rng.choice([1, 5, 20, 100, 1500]), rng.choice([1, 5, 20, 600])
+        return bbox_to_points([x, y, x + w, y + h])
+
+    locations = [random_location() for _ in range(300)]
+    index = BoxIndex(locations)
+    for _ in range(50):
+        query = random_location()
+        for iou_type in (0, 1):
+            expected = [
+                idx
+                for idx, location in enumerate(locations)
+                if get_rect_iou(query, location, iou_type=iou_type) > 0.1
+            ]
+            assert index.query(query, 0.1, iou_type=iou_type).tolist() == expected
+
+    ocr_list = [{"text": str(idx), "location": random_location()} for idx in range(50)]
+    pdf_list = [
+        {"text": str(idx), "location": loc} for idx, loc in enumerate(locations)
+    ]
+    merged = merge_ocr_and_pdf_texts(ocr_list, pdf_list)
+    assert [item["text"] for item in merged[len(pdf_list) :]] == [
+        item["text"]
+        for item in ocr_list
+        if all(
+            get_rect_iou(item["location"], pdf_item["location"], iou_type=1) <= 0.5
+            for pdf_item in pdf_list
+        )
+    ]
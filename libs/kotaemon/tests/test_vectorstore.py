@@ -7,7 +7,9 @@ from kotaemon.base import DocumentWithEmbedding
 from kotaemon.storages import (
     ChromaVectorStore,
     InMemoryVectorStore,
+    LanceDBVectorStore,
     MilvusVectorStore,
+    NumpyVectorStore,
     QdrantVectorStore,
     SimpleFileVectorStore,
 )
@@ -159,6 +161,264 @@ class TestSimpleFileVectorStore:
         os.remove(tmp_path / collection_name)
 
 
+class TestNumpyVectorStore:
+    def test_add_from_docs(self, tmp_path):
+        db = NumpyVectorStore(path=tmp_path)
+
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]
+        metadatas = [{"a": 1, "b": 2}, {"a": 3, "b": 4}]
+        documents = [
+            DocumentWithEmbedding(embedding=embedding, metadata=metadata)
+            for embedding, metadata in zip(embeddings, metadatas)
+        ]
+        assert db.count() == 0, "Expected empty collection"
+        output = db.add(documents)
+        assert output == [doc.doc_id for doc in documents]
+        assert db.count() == 2, "Expected 2 added entries"
+
+    def test_query(self, tmp_path):
+        db = NumpyVectorStore(path=tmp_path)
+
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+        metadatas = [{"a": 1, "b": 2}, {"a": 3, "b": 4}, {"a": 5, "b": 6}]
+        ids = ["a", "b", "c"]
+        db.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
+
+        _, sim, out_ids = db.query(embedding=[0.1, 0.2, 0.3], top_k=1)
+        assert abs(sim[0] - 1.0) < 1e-6
+        assert out_ids == ["a"]
+
+        _, sim, out_ids = db.query(embedding=[0.41, 0.5, 0.6], top_k=3)
+        assert out_ids[0] == "b"
+        assert sim == sorted(sim, reverse=True)
+
+        _, _, out_ids = db.query(embedding=[0.1, 0.2, 0.3], top_k=2, ids=["b", "c"])
+        assert out_ids == ["b", "c"]
+
+    def test_query_filters(self, tmp_path):
+        from llama_index.core.vector_stores.types import (
+            FilterCondition,
+            FilterOperator,
+            MetadataFilter,
+            MetadataFilters,
+        )
+
+        db = NumpyVectorStore(path=tmp_path)
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+        metadatas = [{"file_id": "x"}, {"file_id": "y"}, {"file_id": "z", "page": 3}]
+        db.add(embeddings=embeddings, metadatas=metadatas, ids=["a", "b", "c"])
+
+        file_filter = MetadataFilters(
+            filters=[
+                MetadataFilter(
+                    key="file_id", value=["y", "z"], operator=FilterOperator.IN
+                )
+            ],
+            condition=FilterCondition.OR,
+        )
+        _, _, out_ids = db.query(
+            embedding=[0.1, 0.2, 0.3], top_k=3, filters=file_filter
+        )
+        assert sorted(out_ids) == ["b", "c"]
+
+        page_filter = MetadataFilters(
+            filters=[MetadataFilter(key="page", value=2, operator=FilterOperator.GT)]
+        )
+        _, _, out_ids = db.query(
+            embedding=[0.1, 0.2, 0.3], top_k=3, filters=page_filter
+        )
+        assert out_ids == ["c"]
+
+    def test_query_file_postings(self, tmp_path):
+        from llama_index.core.vector_stores.types import (
+            FilterOperator,
+            MetadataFilter,
+        )
+
+        db = NumpyVectorStore(path=tmp_path, compact_ratio=None)
+        n_files = 20
+        embeddings = [[1.0, float(i), 0.5] for i in range(n_files * 2)]
+        metadatas = [{"file_id": f"f{i % n_files}"} for i in range(n_files * 2)]
+        ids = [str(i) for i in range(n_files * 2)]
+        db.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
+        db.delete(["1"])
+
+        # narrow selection, answered from the postings
+        file_filter = MetadataFilter(
+            key="file_id", value=["f1", "f2"], operator=FilterOperator.IN
+        )
+        _, _, out_ids = db.query(
+            embedding=[1.0, 0.0, 0.5], top_k=10, filters=file_filter
+        )
+        assert out_ids == ["2", "21", "22"]
+
+        _, _, out_ids = db.query(
+            embedding=[1.0, 0.0, 0.5], top_k=10, filters=file_filter, ids=["22"]
+        )
+        assert out_ids == ["22"]
+
+        # wide selection, answered by a full scan
+        file_filter = MetadataFilter(
+            key="file_id",
+            value=[f"f{i}" for i in range(n_files)],
+            operator=FilterOperator.IN,
+        )
+        _, _, out_ids = db.query(
+            embedding=[1.0, 0.0, 0.5], top_k=100, filters=file_filter
+        )
+        assert len(out_ids) == n_files * 2 - 1
+
+    @pytest.mark.parametrize("quantization", ["int8", "binary"])
+    def test_query_quantized(self, tmp_path, quantization):
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, -0.9]]
+        ids = ["a", "b", "c"]
+        NumpyVectorStore(path=tmp_path).add(embeddings=embeddings, ids=ids)
+
+        # the codes of the existing rows are computed on load
+        db = NumpyVectorStore(
+            path=tmp_path, quantization=quantization, rescore_multiplier=3
+        )
+        db.add(embeddings=[[-0.1, -0.2, -0.3]], ids=["d"])
+        assert db.count() == 4
+
+        _, sim, out_ids = db.query(embedding=[0.1, 0.2, 0.3], top_k=2)
+        assert out_ids == ["a", "b"]
+        assert abs(sim[0] - 1.0) < 1e-6, "Expected exact rescored similarities"
+
+        db.delete(["a"])
+        db.compact()
+        db2 = NumpyVectorStore(path=tmp_path, quantization=quantization)
+        _, _, out_ids = db2.query(embedding=[0.1, 0.2, 0.3], top_k=1)
+        assert out_ids == ["b"]
+
+    def test_query_hnsw(self, tmp_path):
+        pytest.importorskip("hnswlib")
+
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, -0.9]]
+        metadatas = [{"file_id": "x"}, {"file_id": "y"}, {"file_id": "y"}]
+        ids = ["a", "b", "c"]
+        db = NumpyVectorStore(path=tmp_path, index="hnsw", compact_ratio=None)
+        db.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
+
+        _, sim, out_ids = db.query(embedding=[0.1, 0.2, 0.3], top_k=2)
+        assert out_ids == ["a", "b"]
+        assert abs(sim[0] - 1.0) < 1e-6
+
+        db.delete(["a"])
+        _, _, out_ids = db.query(embedding=[0.1, 0.2, 0.3], top_k=3)
+        assert out_ids == ["b", "c"]
+
+        # the graph is rebuilt on load from the rows added since its last save
+        db2 = NumpyVectorStore(path=tmp_path, index="hnsw")
+        db2.add(embeddings=[[0.1, 0.2, 0.31]], metadatas=[{"file_id": "z"}], ids=["d"])
+        _, _, out_ids = db2.query(embedding=[0.1, 0.2, 0.3], top_k=1)
+        assert out_ids == ["d"]
+
+    def test_save_load_delete(self, tmp_path):
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+        metadatas = [{"a": 1, "b": 2}, {"a": 3, "b": 4}, {"a": 5, "b": 6}]
+        ids = ["1", "2", "3"]
+        db = NumpyVectorStore(path=tmp_path, dtype="float16", compact_ratio=None)
+        db.add(embeddings=embeddings, metadatas=metadatas, ids=ids)
+        db.delete(["3"])
+        # re-adding an id replaces its previous vector
+        db.add(embeddings=[[0.7, 0.8, 0.9]], metadatas=[{"a": 7}], ids=["1"])
+
+        db2 = NumpyVectorStore(path=tmp_path)
+        assert db2.count() == 2, "load function does not load data completely"
+        _, sim, out_ids = db2.query(embedding=[0.7, 0.8, 0.9], top_k=3)
+        assert out_ids[0] == "1" and "3" not in out_ids
+        assert abs(sim[0] - 1.0) < 1e-3
+
+        db2.compact()
+        assert db2._vectors.shape == (2, 3), "compact should drop deleted rows"
+        db3 = NumpyVectorStore(path=tmp_path)
+        assert db3.query(embedding=[0.4, 0.5, 0.6], top_k=1)[2] == ["2"]
+
+        db3.drop()
+        assert NumpyVectorStore(path=tmp_path).count() == 0
+
+    def test_recover_partial_write(self, tmp_path):
+        db = NumpyVectorStore(path=tmp_path)
+        db.add(embeddings=[[0.1, 0.2, 0.3]], ids=["a"])
+        # simulate a crash after the vectors of a new row are written
+        with open(tmp_path / "default" / "vectors.bin", "ab") as f:
+            f.write(b"\x00" * 12)
+
+        db2 = NumpyVectorStore(path=tmp_path)
+        assert db2.count() == 1
+        db2.add(embeddings=[[0.4, 0.5, 0.6]], ids=["b"])
+        assert NumpyVectorStore(path=tmp_path).query([0.4, 0.5, 0.6])[2] == ["b"]
+
+    @pytest.mark.parametrize("crash_after_switch", [False, True])
+    def test_recover_interrupted_compact(
+        self, tmp_path, monkeypatch, crash_after_switch
+    ):
+        embeddings = [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6], [0.7, 0.8, 0.9]]
+        db = NumpyVectorStore(path=tmp_path, compact_ratio=None)
+        db.add(embeddings=embeddings, ids=["a", "b", "c"])
+        db.delete(["a"])
+
+        # simulate a crash before or after switching to the compacted files
+        replace = os.replace
+
+        def crashing_replace(src, dst):
+            if os.path.basename(dst) == "meta.json":
+                if crash_after_switch:
+                    replace(src, dst)
+                raise KeyboardInterrupt
+            replace(src, dst)
+
+        monkeypatch.setattr(os, "replace", crashing_replace)
+        with pytest.raises(KeyboardInterrupt):
+            db.compact()
+        monkeypatch.undo()
+
+        db2 = NumpyVectorStore(path=tmp_path)
+        assert db2.count() == 2
+        assert len(db2._ids) == (2 if crash_after_switch else 3)
+        for embedding, id_ in zip(embeddings[1:], ["b", "c"]):
+            assert db2.query(embedding=embedding, top_k=1)[2] == [id_]
+        assert sorted(os.listdir(tmp_path / "default")) == (
+            ["meta.json", "rows-1.jsonl", "vectors-1.bin"]
+            if crash_after_switch
+            else ["meta.json", "rows.jsonl", "vectors.bin"]
+        )
+
+
+class TestLanceDBVectorStore:
+    def test_build_vector_index(self, tmp_path):
+        pytest.importorskip("lancedb")
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((300, 16)).tolist()
+        ids = [f"id-{idx}" for idx in range(300)]
+        metadatas = [{"file_id": f"file-{idx % 3}"} for idx in range(300)]
+        db = LanceDBVectorStore(path=str(tmp_path), index_min_rows=256)
+        db.add(embeddings=embeddings[:200], metadatas=metadatas[:200], ids=ids[:200])
+        assert db._index_build is None, "Expected no index below index_min_rows"
+
+        db.add(embeddings=embeddings[200:], metadatas=metadatas[200:], ids=ids[200:])
+        assert db._index_build is not None
+        db._index_build.join()
+        indexed_columns = {
+            column
+            for index in db._client._table.list_indices()
+            for column in index.columns
+        }
+        assert db._client.vector_column_name in indexed_columns
+
+        _, _, out_ids = db.query(embedding=embeddings[42], top_k=10)
+        assert "id-42" in out_ids
+        # all the 17 partitions are searched, and the candidates re-ranked exactly
+        _, _, out_ids = db.query(
+            embedding=embeddings[42], top_k=1, nprobes=17, refine_factor=10
+        )
+        assert out_ids == ["id-42"]
+        assert db._client.nprobes == 20 and db._client.refine_factor is None
+
+
 class TestMilvusVectorStore:
     def test_add(self, tmp_path):
         """Test that the DB add correctly"""
@@ -9,7 +9,12 @@ from theflow.settings import settings
 from theflow.utils.modules import deserialize
 
 from kotaemon.base import BaseComponent
-from kotaemon.storages import BaseDocumentStore, BaseVectorStore
+from kotaemon.storages import (
+    BaseDocumentStore,
+    BaseVectorStore,
+    FileBlobStore,
+    set_default_blob_store,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +22,10 @@ logger = logging.getLogger(__name__)
 filestorage_path = Path(settings.KH_FILESTORAGE_PATH)
 filestorage_path.mkdir(parents=True, exist_ok=True)
 
+# images of the documents, referenced by their metadata
+blob_store = FileBlobStore(filestorage_path / "blobs")
+set_default_blob_store(blob_store)
+
 
 @cache
 def get_docstore(collection_name: str = "default") -> BaseDocumentStore:
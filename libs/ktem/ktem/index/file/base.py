@@ -57,6 +57,16 @@ class BaseFileIndexIndexing(BaseComponent):
     private = Param(False, help="Whether this is private index")
     chunk_size = Param(help="Chunk size for this index")
     chunk_overlap = Param(help="Chunk overlap for this index")
+    thumbnail_mode = Param(
+        "eager",
+        help='When to render the PDF page thumbnails: "eager" when indexing, '
+        '"deferred" when first viewed, "none" to skip them',
+    )
+    embedding_scheduler = Param(
+        None,
+        help="Callable queueing the embedding of a loaded file in the background, "
+        "given its file id and name. None to embed in a thread",
+    )
 
     def run(
         self, file_paths: str | Path | list[str | Path], *args, **kwargs
@@ -85,7 +95,9 @@ class BaseFileIndexIndexing(BaseComponent):
             file_paths (str | Path | list[str | Path]): the file paths to index
 
         Yields:
-            Document: the output message to the UI, must have channel == index or debug
+            Document: the output message to the UI, must have channel == index or
+                debug. Documents on the progress channel report the indexing stage
+                of a file to the ingestion queue, as a dict
 
         Returns:
             - the indexed file ids (each file id corresponds to an input file path, or
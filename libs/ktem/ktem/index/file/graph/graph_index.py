@@ -13,6 +13,13 @@ class GraphRAGIndex(FileIndex):
     def _setup_retriever_cls(self):
         self._retriever_pipeline_cls = [GraphRAGRetrieverPipeline]
 
+    def _setup_job_queue(self):
+        """Don't index in the background
+
+        The graph is built from all the files of an upload at once, while the
+        ingestion queue indexes the files one by one.
+        """
+
     def get_indexing_pipeline(self, settings, user_id) -> BaseFileIndexIndexing:
         """Define the interface of the indexing pipeline"""
 
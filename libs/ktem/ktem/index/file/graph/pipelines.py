@@ -67,9 +67,15 @@ class GraphRAGIndexingPipeline(IndexDocumentPipeline):
     """GraphRAG specific indexing pipeline"""
 
     def route(self, file_path: str | Path) -> IndexPipeline:
-        """Simply disable the splitter (chunking) for this pipeline"""
+        """Simply disable the splitter (chunking) for this pipeline
+
+        The graph is built from the loaded documents, so identical files are not
+        deduplicated and the documents are not streamed.
+        """
         pipeline = super().route(file_path)
         pipeline.splitter = None
+        pipeline.dedup_files = False
+        pipeline.streaming_batch_size = 0
 
         return pipeline
 
@@ -1,13 +1,23 @@
+import shutil
 import uuid
 from datetime import datetime
+from functools import partial
 from typing import Any, Optional, Type
 
-from ktem.components import filestorage_path, get_docstore, get_vectorstore
+from ktem.components import (
+    blob_store,
+    filestorage_path,
+    get_docstore,
+    get_vectorstore,
+)
 from ktem.db.engine import engine
 from ktem.index.base import BaseIndex
-from sqlalchemy import JSON, Column, DateTime, Integer, String, UniqueConstraint
+from sqlalchemy import JSON, Boolean, Column, DateTime
+from sqlalchemy import Index as SQLIndex
+from sqlalchemy import Integer, String, UniqueConstraint, inspect, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.mutable import MutableDict
+from sqlalchemy.orm import Session
 from theflow.settings import settings as flowsettings
 from theflow.utils.modules import import_dotted_string
 from tzlocal import get_localzone
@@ -15,6 +25,9 @@ from tzlocal import get_localzone
 from kotaemon.storages import BaseDocumentStore, BaseVectorStore
 
 from .base import BaseFileIndexIndexing, BaseFileIndexRetriever
+from .jobs import IngestionJobQueue
+from .scope_cache import chunk_scope_cache
+from .utils import filter_unreferenced_blobs
 
 
 def generate_uuid():
@@ -33,6 +46,8 @@ class FileIndex(BaseIndex):
         in this document store is associated with a vector in the vector store.
         - SQL table Index: store the relationship between (1) the source and the
         docstore, and (2) the source and the vector store.
+        - SQL tables IngestionJob and IngestionJobFile: the queue of files to index
+        in the background, when `KH_INGESTION_WORKERS` is set.
     """
 
     def __init__(self, app, id: int, name: str, config: dict):
@@ -44,6 +59,7 @@ class FileIndex(BaseIndex):
         self._selector_ui: Any = None
         self._index_ui_cls: Type
         self._index_ui: Any = None
+        self._job_queue: Optional[IngestionJobQueue] = None
 
         self._default_settings: dict[str, dict] = {}
         self._setting_mappings: dict[str, dict] = {}
@@ -67,6 +83,8 @@ class FileIndex(BaseIndex):
                     "__tablename__": f"index__{self.id}__source",
                     "__table_args__": (
                         UniqueConstraint("name", "user", name="_name_user_uc"),
+                        # covers the lookup of the files with the same content
+                        SQLIndex(f"ix_index__{self.id}__source_path", "path"),
                     ),
                     "id": Column(
                         String,
@@ -93,6 +111,9 @@ class FileIndex(BaseIndex):
                 (Base,),
                 {
                     "__tablename__": f"index__{self.id}__source",
+                    "__table_args__": (
+                        SQLIndex(f"ix_index__{self.id}__source_path", "path"),
+                    ),
                     "id": Column(
                         String,
                         primary_key=True,
@@ -117,6 +138,16 @@ class FileIndex(BaseIndex):
             (Base,),
             {
                 "__tablename__": f"index__{self.id}__index",
+                "__table_args__": (
+                    # covers the lookup of a file's chunks by relation type
+                    SQLIndex(
+                        f"ix_index__{self.id}__index_source_relation",
+                        "source_id",
+                        "relation_type",
+                        "target_id",
+                    ),
+                    SQLIndex(f"ix_index__{self.id}__index_target", "target_id"),
+                ),
                 "id": Column(Integer, primary_key=True, autoincrement=True),
                 "source_id": Column(String),
                 "target_id": Column(String),
@@ -150,6 +181,57 @@ class FileIndex(BaseIndex):
             },
         )
 
+        IngestionJob = type(
+            "IngestionJobTable",
+            (Base,),
+            {
+                "__tablename__": f"index__{self.id}__job",
+                "id": Column(
+                    String,
+                    primary_key=True,
+                    default=lambda: str(uuid.uuid4()),
+                    unique=True,
+                ),
+                "date_created": Column(
+                    DateTime(timezone=True),
+                    default=lambda: datetime.now(get_localzone()),
+                ),
+                "user": Column(String, default=""),
+                "reindex": Column(Boolean, default=False),
+                "settings": Column(JSON, default={}),
+            },
+        )
+        IngestionJobFile = type(
+            "IngestionJobFileTable",
+            (Base,),
+            {
+                "__tablename__": f"index__{self.id}__job_file",
+                "__table_args__": (
+                    # covers the lookup of the next file to index
+                    SQLIndex(f"ix_index__{self.id}__job_file_status", "status", "id"),
+                    SQLIndex(
+                        f"ix_index__{self.id}__job_file_job", "job_id", "position"
+                    ),
+                ),
+                "id": Column(Integer, primary_key=True, autoincrement=True),
+                "job_id": Column(String),
+                "position": Column(Integer, default=0),
+                "name": Column(String),
+                "path": Column(String),
+                "status": Column(String, default="pending"),
+                "stage": Column(String, default="queued"),
+                "file_id": Column(String, nullable=True),
+                "n_chunks": Column(Integer, default=0),
+                "n_embedded": Column(Integer, default=0),
+                "attempts": Column(Integer, default=0),
+                "message": Column(String, default=""),
+                "date_updated": Column(
+                    DateTime(timezone=True),
+                    default=lambda: datetime.now(get_localzone()),
+                ),
+            },
+        )
+
         self._vs: BaseVectorStore = get_vectorstore(f"index_{self.id}")
         self._docstore: BaseDocumentStore = get_docstore(f"index_{self.id}")
         self._fs_path = filestorage_path / f"index_{self.id}"
@@ -157,6 +239,8 @@ class FileIndex(BaseIndex):
             "Source": Source,
             "Index": Index,
             "FileGroup": FileGroup,
+            "IngestionJob": IngestionJob,
+            "IngestionJobFile": IngestionJobFile,
             "VectorStore": self._vs,
             "DocStore": self._docstore,
             "FileStoragePath": self._fs_path,
@@ -329,27 +413,85 @@ class FileIndex(BaseIndex):
         self._resources["Source"].metadata.create_all(engine)  # type: ignore
         self._resources["Index"].metadata.create_all(engine)  # type: ignore
         self._resources["FileGroup"].metadata.create_all(engine)  # type: ignore
+        self._resources["IngestionJob"].metadata.create_all(engine)  # type: ignore
         self._fs_path.mkdir(parents=True, exist_ok=True)
 
     def on_delete(self):
         """Clean up the index when the user delete it"""
-        import shutil
-
         self._setup_resources()
+        if self._job_queue is not None:
+            self._job_queue.stop(timeout=0)
+            shutil.rmtree(self._job_queue.jobs_path, ignore_errors=True)
+            self._job_queue = None
+        for table in ("IngestionJob", "IngestionJobFile"):
+            self._resources[table].__table__.drop(  # type: ignore
+                engine, checkfirst=True
+            )
+        Index = self._resources["Index"]
+        with Session(engine) as session:
+            keys = list(
+                session.scalars(
+                    select(Index.target_id)
+                    .where(Index.relation_type == "blob")
+                    .distinct()
+                )
+            )
         self._resources["Source"].__table__.drop(engine)  # type: ignore
-        self._resources["Index"].__table__.drop(engine)  # type: ignore
+        Index.__table__.drop(engine)  # type: ignore
+        chunk_scope_cache.invalidate(Index.__tablename__)
         self._resources["FileGroup"].__table__.drop(engine)  # type: ignore
         self._vs.drop()
         self._docstore.drop()
         shutil.rmtree(self._fs_path)
+        # the blobs that the files of the other indices don't refer to
+        with Session(engine) as session:
+            blob_store.delete(filter_unreferenced_blobs(session, keys))
+
+    def _create_missing_db_indexes(self):
+        """Add the lookup indexes to the Source and Index tables of existing
+        deployments
+
+        Tables created before these indexes were declared don't have them, and
+        `create_all` does not alter existing tables.
+        """
+        for resource in ("Source", "Index"):
+            table = self._resources[resource].__table__
+            if not inspect(engine).has_table(table.name):
+                continue
+
+            existing = {
+                each["name"] for each in inspect(engine).get_indexes(table.name)
+            }
+            for db_index in table.indexes:
+                if db_index.name not in existing:
+                    print(f"Creating database index {db_index.name}")
+                    db_index.create(engine)
+
+    def _setup_job_queue(self):
+        """Start the background ingestion workers, if enabled in the settings"""
+        n_workers = getattr(flowsettings, "KH_INGESTION_WORKERS", 0)
+        if not n_workers:
+            return
+
+        # the job tables are missing from indices created before the queue existed
+        self._resources["IngestionJob"].metadata.create_all(engine)  # type: ignore
+        self._job_queue = IngestionJobQueue(self, n_workers=n_workers)
+        self._job_queue.start()
+
+    @property
+    def job_queue(self) -> Optional[IngestionJobQueue]:
+        """The background ingestion queue, None if files are indexed in-request"""
+        return self._job_queue
 
     def on_start(self):
         """Setup the classes and hooks"""
         self._setup_resources()
+        self._create_missing_db_indexes()
         self._setup_indexing_cls()
         self._setup_retriever_cls()
         self._setup_file_index_ui_cls()
         self._setup_file_selector_ui_cls()
+        self._setup_job_queue()
 
     def get_selector_component_ui(self):
         if self._selector_ui is None:
@@ -435,6 +577,20 @@ class FileIndex(BaseIndex):
                     "Set 0 to use developer setting."
                 ),
             },
+            "thumbnail_mode": {
+                "name": "PDF page thumbnails",
+                "value": "eager",
+                "component": "dropdown",
+                "choices": [
+                    ("Render when indexing", "eager"),
+                    ("Render when first viewed", "deferred"),
+                    ("Disabled", "none"),
+                ],
+                "info": (
+                    "Deferred rendering speeds up the indexing of large PDFs. "
+                    "Disabled thumbnails can't be sent to vision models."
+                ),
+            },
         }
 
     def get_indexing_pipeline(self, settings, user_id) -> BaseFileIndexIndexing:
@@ -456,6 +612,11 @@ class FileIndex(BaseIndex):
         obj.private = self.config.get("private", False)
         obj.chunk_size = self.config.get("chunk_size", 0)
         obj.chunk_overlap = self.config.get("chunk_overlap", 0)
+        obj.thumbnail_mode = self.config.get("thumbnail_mode", "eager")
+        if self._job_queue is not None:
+            obj.embedding_scheduler = partial(
+                self._job_queue.submit_embedding, settings=settings, user_id=user_id
+            )
 
         return obj
 
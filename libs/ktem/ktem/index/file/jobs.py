@@ -0,0 +1,369 @@
+import logging
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from ktem.db.engine import engine
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from tzlocal import get_localzone
+
+from kotaemon.base import Document
+
+if TYPE_CHECKING:
+    from .index import FileIndex
+
+logger = logging.getLogger(__name__)
+
+# status of a file in a job
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+# stage reached by the indexing of a file, to resume from after a restart
+STAGE_QUEUED = "queued"
+STAGE_LOADING = "loading"
+STAGE_EMBEDDING = "embedding"
+STAGE_DONE = "done"
+
+
+class IngestionJobQueue:
+    """Persistent queue of the files to index, processed by background workers
+
+    Jobs are recorded in the `IngestionJob` and `IngestionJobFile` tables of the
+    file index, so they survive browser disconnects and server restarts. Uploaded
+    files are copied next to the file storage until they are indexed.
+
+    The workers record the progress reported by the indexing pipeline on the
+    "progress" channel. A file interrupted while its chunks were being embedded
+    resumes from the chunks already stored in the docstore, otherwise it is
+    indexed again from the start.
+
+    Args:
+        index: the file index whose files are indexed
+        n_workers: number of worker threads
+        poll_interval: seconds between checks for new files when idle
+        max_attempts: number of times a file is retried after being interrupted
+    """
+
+    def __init__(
+        self,
+        index: "FileIndex",
+        n_workers: int = 1,
+        poll_interval: float = 2.0,
+        max_attempts: int = 3,
+    ):
+        self._index = index
+        self.n_workers = n_workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wake_up = threading.Event()
+        self._stop = threading.Event()
+        self._workers: list[threading.Thread] = []
+
+    @property
+    def Job(self):
+        return self._index._resources["IngestionJob"]
+
+    @property
+    def JobFile(self):
+        return self._index._resources["IngestionJobFile"]
+
+    @property
+    def jobs_path(self) -> Path:
+        return self._index._fs_path.parent / f"{self._index._fs_path.name}_jobs"
+
+    def start(self):
+        """Requeue the files interrupted by a restart and start the workers"""
+        if self._workers:
+            return
+
+        with Session(engine) as session:
+            session.execute(
+                update(self.JobFile)
+                .where(self.JobFile.status == RUNNING)
+                .values(status=PENDING)
+            )
+            session.commit()
+
+        self._stop.clear()
+        for idx in range(self.n_workers):
+            worker = threading.Thread(
+                target=self._work,
+                name=f"ingestion-{self._index.id}-{idx}",
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the workers once they finish their current file"""
+        self._stop.set()
+        self._wake_up.set()
+        for worker in self._workers:
+            worker.join(timeout)
+        self._workers = []
+
+    def submit(
+        self,
+        file_paths: list[str | Path],
+        reindex: bool,
+        settings: dict,
+        user_id,
+    ) -> str:
+        """Queue the files (or URLs) to be indexed, return the job id"""
+        job_id = str(uuid.uuid4())
+        job_files = []
+        for position, file_path in enumerate(file_paths):
+            if self._is_url(file_path):
+                name = path = str(file_path)
+            else:
+                # the uploaded file might be removed before it is indexed
+                name = Path(file_path).name
+                path = str(self.jobs_path / job_id / str(position) / name)
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(file_path, path)
+            job_files.append(
+                self.JobFile(job_id=job_id, position=position, name=name, path=path)
+            )
+
+        with Session(engine) as session:
+            session.add(
+                self.Job(id=job_id, user=user_id, reindex=reindex, settings=settings)
+            )
+            session.add_all(job_files)
+            session.commit()
+
+        self._wake_up.set()
+        return job_id
+
+    def submit_embedding(self, file_id: str, file_name: str, settings: dict, user_id):
+        """Queue the embedding of the chunks of an already loaded file"""
+        job_id = str(uuid.uuid4())
+        with Session(engine) as session:
+            session.add(
+                self.Job(id=job_id, user=user_id, reindex=False, settings=settings)
+            )
+            session.add(
+                self.JobFile(
+                    job_id=job_id,
+                    position=0,
+                    name=file_name,
+                    path="",
+                    file_id=file_id,
+                    stage=STAGE_EMBEDDING,
+                )
+            )
+            session.commit()
+
+        self._wake_up.set()
+        return job_id
+
+    def cancel(self, job_id: str):
+        """Cancel the files of the job that are not being indexed yet"""
+        with Session(engine) as session:
+            session.execute(
+                update(self.JobFile)
+                .where(self.JobFile.job_id == job_id, self.JobFile.status == PENDING)
+                .values(status=CANCELLED, date_updated=_now())
+            )
+            session.commit()
+        shutil.rmtree(self.jobs_path / job_id, ignore_errors=True)
+
+    def status(self, job_id: str) -> dict:
+        """Get the progress of the job and of each of its files"""
+        with Session(engine) as session:
+            files = session.scalars(
+                select(self.JobFile)
+                .where(self.JobFile.job_id == job_id)
+                .order_by(self.JobFile.position)
+            ).all()
+
+        statuses = {each.status for each in files}
+        if not files or statuses <= {CANCELLED}:
+            status = CANCELLED
+        elif statuses <= set(FINISHED):
+            status = FAILED if FAILED in statuses else COMPLETED
+        elif statuses == {PENDING}:
+            status = PENDING
+        else:
+            status = RUNNING
+
+        return {
+            "id": job_id,
+            "status": status,
+            "files": [
+                {
+                    "name": each.name,
+                    "status": each.status,
+                    "stage": each.stage,
+                    "file_id": each.file_id,
+                    "n_chunks": each.n_chunks,
+                    "n_embedded": each.n_embedded,
+                    "message": each.message,
+                }
+                for each in files
+            ],
+        }
+
+    def list_jobs(self, user_id=None, limit: int = 20) -> list[dict]:
+        """Get the status of the latest jobs, of a user or of everyone"""
+        stmt = select(self.Job.id).order_by(self.Job.date_created.desc())
+        if user_id is not None:
+            stmt = stmt.where(self.Job.user == user_id)
+        with Session(engine) as session:
+            job_ids = session.scalars(stmt.limit(limit)).all()
+        return [self.status(job_id) for job_id in job_ids]
+
+    def _is_url(self, file_path: str | Path) -> bool:
+        return isinstance(file_path, str) and (
+            file_path.startswith("http://") or file_path.startswith("https://")
+        )
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job_file_id = self._claim()
+            except Exception as e:
+                logger.exception(e)
+                job_file_id = None
+
+            if job_file_id is None:
+                self._wake_up.wait(self.poll_interval)
+                self._wake_up.clear()
+                continue
+
+            try:
+                self._process(job_file_id)
+            except Exception as e:
+                logger.exception(e)
+                self._finish(job_file_id, FAILED, str(e))
+
+    def _claim(self) -> Optional[int]:
+        """Mark the oldest pending file as running, return its id"""
+        with Session(engine) as session:
+            while True:
+                job_file_id = session.scalars(
+                    select(self.JobFile.id)
+                    .where(self.JobFile.status == PENDING)
+                    .order_by(self.JobFile.id)
+                    .limit(1)
+                ).first()
+                if job_file_id is None:
+                    return None
+
+                # the status check makes the claim atomic between the workers
+                claimed = session.execute(
+                    update(self.JobFile)
+                    .where(
+                        self.JobFile.id == job_file_id,
+                        self.JobFile.status == PENDING,
+                    )
+                    .values(
+                        status=RUNNING,
+                        attempts=self.JobFile.attempts + 1,
+                        date_updated=_now(),
+                    )
+                )
+                session.commit()
+                if claimed.rowcount:
+                    return job_file_id
+
+    def _process(self, job_file_id: int):
+        with Session(engine) as session:
+            job_file = session.get(self.JobFile, job_file_id)
+            job = session.get(self.Job, job_file.job_id)
+            session.expunge_all()
+
+        # counts the attempt being claimed, the first one is not a retry
+        if job_file.attempts > self.max_attempts + 1:
+            self._finish(job_file_id, FAILED, "Interrupted too many times")
+            return
+
+        pipeline = self._index.get_indexing_pipeline(job.settings, job.user)
+        if job_file.stage == STAGE_EMBEDDING:
+            if not self._source_exists(job_file.file_id):
+                self._finish(job_file_id, FAILED, "The file was deleted")
+                return
+
+            # the chunks are in the docstore, only embed those that are missing.
+            # The file name is enough to route to the same pipeline
+            file_pipeline = pipeline.route(
+                job_file.name if self._is_url(job_file.name) else Path(job_file.name)
+            )
+            for doc in file_pipeline.stream_embedding(job_file.file_id, job_file.name):
+                self._record(job_file_id, doc)
+            file_pipeline.finish(job_file.file_id, job_file.name)
+            self._finish(job_file_id, COMPLETED)
+            return
+
+        file_path: str | Path = (
+            job_file.path if self._is_url(job_file.path) else Path(job_file.path)
+        )
+        # a previous attempt may have partially indexed the file
+        reindex = job.reindex or job_file.file_id is not None
+        output = pipeline.stream([file_path], reindex=reindex)
+        try:
+            while True:
+                self._record(job_file_id, next(output))
+        except StopIteration as e:
+            _, errors, _ = e.value
+
+        if errors[0]:
+            self._finish(job_file_id, FAILED, errors[0])
+        else:
+            self._finish(job_file_id, COMPLETED)
+
+    def _record(self, job_file_id: int, doc: Document):
+        """Save the progress reported by the indexing pipeline"""
+        if doc is None or doc.channel != "progress":
+            return
+
+        values = {
+            key: doc.content[key]
+            for key in ("file_id", "stage", "n_chunks", "n_embedded")
+            if key in doc.content
+        }
+        with Session(engine) as session:
+            session.execute(
+                update(self.JobFile)
+                .where(self.JobFile.id == job_file_id)
+                .values(date_updated=_now(), **values)
+            )
+            session.commit()
+
+    def _source_exists(self, file_id: Optional[str]) -> bool:
+        if not file_id:
+            return False
+        Source = self._index._resources["Source"]
+        with Session(engine) as session:
+            return session.get(Source, file_id) is not None
+
+    def _finish(self, job_file_id: int, status: str, message: str = ""):
+        with Session(engine) as session:
+            job_file = session.get(self.JobFile, job_file_id)
+            job_file.status = status
+            job_file.message = message
+            job_file.date_updated = _now()
+            if status == COMPLETED:
+                job_file.stage = STAGE_DONE
+            session.add(job_file)
+            session.commit()
+            path, job_id = job_file.path, job_file.job_id
+
+        if path and not self._is_url(path):
+            shutil.rmtree(Path(path).parent, ignore_errors=True)
+            try:
+                (self.jobs_path / job_id).rmdir()
+            except OSError:
+                pass
+
+
+def _now() -> datetime:
+    return datetime.now(get_localzone())
@@ -2,19 +2,33 @@ from __future__ import annotations
 
 import json
 import logging
+import pickle
+import queue
 import shutil
 import threading
 import time
 import warnings
 from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from copy import deepcopy
 from functools import lru_cache
 from hashlib import sha256
+from itertools import islice
 from pathlib import Path
-from typing import Generator, Optional, Sequence
+from typing import (
+    Callable,
+    ContextManager,
+    Generator,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+)
 
 import tiktoken
 from decouple import config
+from ktem.components import blob_store
 from ktem.db.models import engine
 from ktem.embeddings.manager import embedding_models_manager
 from ktem.llms.manager import llms
@@ -34,7 +48,7 @@ from theflow.settings import settings
 from theflow.utils.modules import import_dotted_string
 
 from kotaemon.base import BaseComponent, Document, Node, Param, RetrievedDocument
-from kotaemon.embeddings import BaseEmbeddings
+from kotaemon.embeddings import BaseEmbeddings, CachedEmbeddings
 from kotaemon.indices import VectorIndexing, VectorRetrieval
 from kotaemon.indices.ingests.files import (
     KH_DEFAULT_FILE_EXTRACTORS,
@@ -45,9 +59,21 @@ from kotaemon.indices.ingests.files import (
     web_reader,
 )
 from kotaemon.indices.rankings import BaseReranking, LLMReranking, LLMTrulensScoring
-from kotaemon.indices.splitters import BaseSplitter, TokenSplitter
+from kotaemon.indices.splitters import BaseSplitter, TiktokenSplitter
+from kotaemon.loaders import (
+    AdobeReader,
+    AzureAIDocumentIntelligenceLoader,
+    CachedReader,
+    DoclingReader,
+    MathpixPDFReader,
+    OCRReader,
+    PDFThumbnailReader,
+)
+from kotaemon.storages import BaseDocumentStore, blob_keys, store_images
 
 from .base import BaseFileIndexIndexing, BaseFileIndexRetriever
+from .scope_cache import chunk_scope_cache
+from .utils import filter_unreferenced, filter_unreferenced_blobs
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +102,105 @@ def dev_settings():
 
 _default_token_func = tiktoken.encoding_for_model("gpt-3.5-turbo").encode
 
+# the loaders calling remote services or running heavy models, whose output is
+# worth caching
+_PARSE_CACHED_LOADERS = (
+    AdobeReader,
+    AzureAIDocumentIntelligenceLoader,
+    DoclingReader,
+    MathpixPDFReader,
+    OCRReader,
+)
+
+
+# the metadata that, with the text, identify the content of a chunk. The others
+# (e.g. file path or dates) change across uploads of the same content
+_CHUNK_HASH_METADATA = (
+    "type",
+    "page_label",
+    "thumbnail_doc_id",
+    "image_origin",
+    "table_origin",
+)
+
+
+def chunk_hash(doc: Document) -> str:
+    """Hash the content of a chunk, to find the unchanged chunks on reindex"""
+    content = [
+        doc.text,
+        {key: doc.metadata.get(key) for key in _CHUNK_HASH_METADATA},
+    ]
+    return sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def reuse_chunk_ids(docs: list[Document], previous_chunks: dict[str, list[str]]):
+    """Give the documents the id of the indexed chunks with the same content
+
+    The reused ids are removed from `previous_chunks`, leaving the chunks that no
+    longer exist.
+
+    Returns:
+        the reused ids
+    """
+    reused_ids = []
+    for doc in docs:
+        chunk_ids = previous_chunks.get(chunk_hash(doc))
+        if chunk_ids:
+            doc.doc_id = chunk_ids.pop()
+            reused_ids.append(doc.doc_id)
+    return reused_ids
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Split the iterable into lists of `size` items, the last one may be shorter"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _load_data(loader: BaseReader, file_path: str | Path, extra_info: dict):
+    return loader.load_data(file_path, extra_info=extra_info)
+
+
+def with_embedding_cache(embedding: BaseEmbeddings) -> BaseEmbeddings:
+    """Wrap the embedding model with the persistent embedding cache, if enabled"""
+    cache_path = getattr(settings, "KH_EMBEDDING_CACHE_PATH", None)
+    if not cache_path or isinstance(embedding, CachedEmbeddings):
+        return embedding
+
+    return CachedEmbeddings(
+        embedding=embedding,
+        cache_path=str(cache_path),
+        max_entries=getattr(settings, "KH_EMBEDDING_CACHE_MAX_ENTRIES", None),
+    )
+
+
+def deferred_refresh(docstore: BaseDocumentStore) -> ContextManager:
+    """Defer the index rebuilds of the docstore until the block exits, if supported"""
+    if hasattr(docstore, "deferred_refresh"):
+        return docstore.deferred_refresh()
+    return nullcontext()
+
+
+def with_parse_cache(loader: BaseReader) -> BaseReader:
+    """Wrap the expensive loaders with the persistent parse cache, if enabled"""
+    cache_path = getattr(settings, "KH_PARSE_CACHE_PATH", None)
+    if not cache_path or not isinstance(loader, _PARSE_CACHED_LOADERS):
+        return loader
+
+    return CachedReader(
+        loader=loader,
+        cache_path=str(cache_path),
+        max_entries=getattr(settings, "KH_PARSE_CACHE_MAX_ENTRIES", None),
+    )
+
+
+def loader_name(loader: BaseReader) -> str:
+    """Get the class name of the loader, unwrapped from the parse cache"""
+    if isinstance(loader, CachedReader):
+        loader = loader.get_from_path("loader")
+    return loader.__class__.__name__
+
 
 class DocumentRetrievalPipeline(BaseFileIndexRetriever):
     """Retrieve relevant document
@@ -99,6 +224,7 @@ class DocumentRetrievalPipeline(BaseFileIndexRetriever):
     mmr: bool = False
     top_k: int = 5
     retrieval_mode: str = "hybrid"
+    fusion_method: str = "rrf"
 
     @Node.auto(depends_on=["embedding", "VS", "DS"])
     def vector_retrieval(self) -> VectorRetrieval:
@@ -107,6 +233,7 @@ class DocumentRetrievalPipeline(BaseFileIndexRetriever):
             vector_store=self.VS,
             doc_store=self.DS,
             retrieval_mode=self.retrieval_mode,  # type: ignore
+            fusion_method=self.fusion_method,  # type: ignore
             rerankers=self.rerankers,
         )
 
@@ -142,22 +269,39 @@ class DocumentRetrievalPipeline(BaseFileIndexRetriever):
             return []
 
         retrieval_kwargs: dict = {}
-        with Session(engine) as session:
-            stmt = select(self.Index).where(
-                self.Index.relation_type == "document",
-                self.Index.source_id.in_(doc_ids),
+        index_key = self.Index.__tablename__
+        scope = chunk_scope_cache.get(index_key, doc_ids)
+        if scope is None:
+            generation = chunk_scope_cache.generation(index_key)
+            with Session(engine) as session:
+                stmt = select(self.Index.relation_type, self.Index.target_id).where(
+                    self.Index.relation_type.in_(["document", "file"]),
+                    self.Index.source_id.in_(doc_ids),
+                )
+                relations = session.execute(stmt).all()
+            scope = (
+                [target for relation, target in relations if relation == "document"],
+                # the files that share the chunks of an identical file are related
+                # to it, as its id is in the chunks' metadata
+                [target for relation, target in relations if relation == "file"],
             )
-            results = session.execute(stmt)
-            chunk_ids = [r[0].target_id for r in results.all()]
+            chunk_scope_cache.put(index_key, doc_ids, scope, generation)
+        logger.debug("Chunk scope cache: %s", chunk_scope_cache.stats())
+        chunk_ids, owner_ids = scope
 
         # do first round top_k extension
         retrieval_kwargs["do_extend"] = True
         retrieval_kwargs["scope"] = chunk_ids
+        if not owner_ids:
+            # the chunks of the files, for the docstores that can filter on file_id
+            retrieval_kwargs["scope_file_ids"] = doc_ids
+        # else the chunks with an owner id are not all in the scope: the owner may
+        # have been reindexed since. The retrieval restricts them to the scope
         retrieval_kwargs["filters"] = MetadataFilters(
             filters=[
                 MetadataFilter(
                     key="file_id",
-                    value=doc_ids,
+                    value=doc_ids + owner_ids,
                     operator=FilterOperator.IN,
                 )
             ],
@@ -251,6 +395,12 @@ class DocumentRetrievalPipeline(BaseFileIndexRetriever):
                 "choices": ["vector", "text", "hybrid"],
                 "component": "dropdown",
             },
+            "fusion_method": {
+                "name": "Hybrid fusion method",
+                "value": "rrf",
+                "choices": ["rrf", "weighted"],
+                "component": "dropdown",
+            },
             "prioritize_table": {
                 "name": "Prioritize table",
                 "value": False,
@@ -297,6 +447,7 @@ class DocumentRetrievalPipeline(BaseFileIndexRetriever):
                 )
             ],
             retrieval_mode=user_settings["retrieval_mode"],
+            fusion_method=user_settings.get("fusion_method", "rrf"),
             llm_scorer=(LLMTrulensScoring() if use_llm_reranking else None),
             rerankers=[
                 reranking_models_manager[
@@ -342,15 +493,188 @@ class IndexPipeline(BaseComponent):
     private: bool = False
     run_embedding_in_thread: bool = False
     embedding: BaseEmbeddings
+    loader_executor: Optional[Executor] = Param(
+        None,
+        help="Executor (e.g. a process pool) to run the loader in. The loader is "
+        "run in the current process if None or if it cannot be pickled",
+    )
+    embedding_scheduler: Optional[Callable] = Param(
+        None,
+        help="Callable queueing the embedding of a file given its id and name, used "
+        "instead of a thread when run_embedding_in_thread is set",
+    )
+    store_images_as_blobs: bool = Param(
+        getattr(settings, "KH_STORE_IMAGES_AS_BLOBS", True),
+        help="Store the images of the documents (e.g. page thumbnails) in the blob "
+        "store, their metadata only referencing them",
+    )
+    dedup_files: bool = Param(
+        getattr(settings, "KH_INDEXING_DEDUP_FILES", True),
+        help="Reuse the chunks of an indexed file with the same content and loader "
+        "instead of indexing a new file",
+    )
+    incremental_reindex: bool = Param(
+        getattr(settings, "KH_INDEXING_INCREMENTAL_REINDEX", True),
+        help="When reindexing a file, keep the chunks whose content did not change "
+        "and only embed the new ones",
+    )
+    streaming_batch_size: int = Param(
+        getattr(settings, "KH_INDEXING_STREAMING_BATCH_SIZE", 64),
+        help="Number of documents (e.g. pages) split, stored and embedded at a time "
+        "when the loader can yield them lazily and does not run in the loader "
+        "executor. 0 to always load the whole file before indexing it",
+    )
 
     @Node.auto(depends_on=["Source", "Index", "embedding"])
     def vector_indexing(self) -> VectorIndexing:
         return VectorIndexing(
-            vector_store=self.VS, doc_store=self.DS, embedding=self.embedding
+            vector_store=self.VS,
+            doc_store=self.DS,
+            embedding=with_embedding_cache(self.embedding),
         )
 
-    def handle_docs(self, docs, file_id, file_name) -> Generator[Document, None, int]:
+    def handle_docs(
+        self,
+        docs: list[Document] | Iterator[Document],
+        file_id,
+        file_name,
+        previous_chunks: Optional[dict[str, list[str]]] = None,
+    ) -> Generator[Document, None, tuple[int, int]]:
+        """Split, store and embed the documents of the file
+
+        Documents given as an iterator (e.g. by a lazy loader) are processed by
+        batches of `streaming_batch_size`, so that only one batch is in memory at a
+        time. The loader must then yield the thumbnail of a page before its text,
+        for the chunks to be linked to it.
+
+        Args:
+            docs: the documents loaded from the file
+            file_id: the file id
+            file_name: the file name
+            previous_chunks: when reindexing, the ids of the chunks already indexed
+                for the file, by content hash. The unchanged chunks are kept, the
+                others are deleted
+
+        Returns:
+            - the number of chunks stored
+            - the number of tokens of the chunks of the file, kept ones included
+        """
         s_time = time.time()
+        streaming = not isinstance(docs, list)
+        batches = (
+            batched(docs, self.streaming_batch_size or 64) if streaming else [docs]
+        )
+        embed_each_batch = streaming and not self.run_embedding_in_thread
+
+        page_label_to_thumbnail: dict[str, str] = {}
+        kept_ids: list[str] = []
+        file_blob_keys: set[str] = set()
+        to_index_chunks: list[Document] = []
+        n_chunks = 0
+        n_tokens = 0
+        n_embedded = 0
+        for batch in batches:
+            n_kept = len(kept_ids)
+            all_chunks = self.prepare_chunks(
+                batch, page_label_to_thumbnail, previous_chunks, kept_ids
+            )
+            n_tokens += self.count_tokens(all_chunks)
+            batch_blob_keys = blob_keys(all_chunks)
+            self.link_blobs(file_id, batch_blob_keys - file_blob_keys)
+            file_blob_keys |= batch_blob_keys
+            reused = set(kept_ids[n_kept:])
+            to_index_chunks = [doc for doc in all_chunks if doc.doc_id not in reused]
+
+            # add to doc store
+            chunk_size = self.chunk_batch_size * 4
+            for start_idx in range(0, len(to_index_chunks), chunk_size):
+                chunks = to_index_chunks[start_idx : start_idx + chunk_size]
+                self.handle_chunks_docstore(chunks, file_id)
+                n_chunks += len(chunks)
+                yield Document(
+                    f" => [{file_name}] Processed {n_chunks} chunks",
+                    channel="debug",
+                )
+
+            if embed_each_batch:
+                n_embedded = yield from self.insert_chunks_to_vectorstore(
+                    to_index_chunks, file_id, file_name, n_embedded
+                )
+
+        print(f"Got {len(page_label_to_thumbnail)} page thumbnails")
+        if previous_chunks is not None:
+            stale_ids = [
+                chunk_id
+                for chunk_ids in previous_chunks.values()
+                for chunk_id in chunk_ids
+            ]
+            self.delete_chunks(file_id, stale_ids)
+            self.unlink_blobs(file_id, keep=file_blob_keys)
+            yield Document(
+                f" => [{file_name}] Kept {len(kept_ids)} unchanged chunks, deleted "
+                f"{len(stale_ids)} and added {n_chunks}",
+                channel="debug",
+            )
+        yield Document(
+            {"file_id": file_id, "stage": "embedding", "n_chunks": n_chunks},
+            channel="progress",
+        )
+
+        # run vector indexing in the background if specified
+        if self.run_embedding_in_thread and self.embedding_scheduler is not None:
+            print("Queueing embedding")
+            self.embedding_scheduler(file_id, file_name)
+        elif self.run_embedding_in_thread:
+            print("Running embedding in thread")
+
+            def embed():
+                if streaming:
+                    # the chunks were not kept in memory, read them from the docstore
+                    list(self.stream_embedding(file_id, file_name))
+                else:
+                    list(
+                        self.insert_chunks_to_vectorstore(
+                            to_index_chunks, file_id, file_name
+                        )
+                    )
+
+            threading.Thread(target=embed).start()
+        elif not embed_each_batch:
+            yield from self.insert_chunks_to_vectorstore(
+                to_index_chunks, file_id, file_name
+            )
+
+        embedding = self.vector_indexing.embedding
+        if isinstance(embedding, CachedEmbeddings):
+            print("embedding cache", embedding.stats())
+
+        print("indexing step took", time.time() - s_time)
+        return n_chunks, n_tokens
+
+    def prepare_chunks(
+        self,
+        docs: list[Document],
+        page_label_to_thumbnail: dict[str, str],
+        previous_chunks: Optional[dict[str, list[str]]] = None,
+        kept_ids: Optional[list[str]] = None,
+    ) -> list[Document]:
+        """Split the documents and link the chunks to their page thumbnail
+
+        Args:
+            docs: the loaded documents
+            page_label_to_thumbnail: the ids of the page thumbnails, by page label.
+                Updated with the thumbnails of the documents
+            previous_chunks: when reindexing, the ids of the chunks already indexed
+                for the file, by content hash. The reused ids are removed from it
+            kept_ids: extended with the ids of the reused chunks
+
+        Returns:
+            the chunks of the documents. Those reusing the id of an indexed chunk
+                are already stored, and their ids are added to `kept_ids`
+        """
+        if self.store_images_as_blobs:
+            store_images(docs, blob_store)
+
         text_docs = []
         non_text_docs = []
         thumbnail_docs = []
@@ -364,10 +688,13 @@ class IndexPipeline(BaseComponent):
             else:
                 non_text_docs.append(doc)
 
-        print(f"Got {len(thumbnail_docs)} page thumbnails")
-        page_label_to_thumbnail = {
-            doc.metadata["page_label"]: doc.doc_id for doc in thumbnail_docs
-        }
+        reused_ids = []
+        if previous_chunks is not None:
+            # before linking the chunks, that refer to the thumbnail ids
+            reused_ids += reuse_chunk_ids(thumbnail_docs, previous_chunks)
+        page_label_to_thumbnail.update(
+            {doc.metadata["page_label"]: doc.doc_id for doc in thumbnail_docs}
+        )
 
         if self.splitter:
             all_chunks = self.splitter(text_docs)
@@ -380,46 +707,229 @@ class IndexPipeline(BaseComponent):
             if page_label and page_label in page_label_to_thumbnail:
                 chunk.metadata["thumbnail_doc_id"] = page_label_to_thumbnail[page_label]
 
-        to_index_chunks = all_chunks + non_text_docs + thumbnail_docs
+        if previous_chunks is not None:
+            reused_ids += reuse_chunk_ids(all_chunks + non_text_docs, previous_chunks)
+            if kept_ids is not None:
+                kept_ids.extend(reused_ids)
 
-        # add to doc store
-        chunks = []
-        n_chunks = 0
-        chunk_size = self.chunk_batch_size * 4
-        for start_idx in range(0, len(to_index_chunks), chunk_size):
-            chunks = to_index_chunks[start_idx : start_idx + chunk_size]
-            self.handle_chunks_docstore(chunks, file_id)
-            n_chunks += len(chunks)
-            yield Document(
-                f" => [{file_name}] Processed {n_chunks} chunks",
-                channel="debug",
+        return all_chunks + non_text_docs + thumbnail_docs
+
+    def insert_chunks_to_vectorstore(
+        self,
+        chunks: list[Document],
+        file_id: str,
+        file_name: str,
+        n_embedded: int = 0,
+    ) -> Generator[Document, None, int]:
+        """Embed the chunks by batches
+
+        Args:
+            chunks: the chunks to embed
+            file_id: the file id
+            file_name: the file name
+            n_embedded: the number of chunks of the file already embedded, for the
+                progress report
+
+        Returns:
+            the number of chunks of the file embedded
+        """
+        for start_idx in range(0, len(chunks), self.chunk_batch_size):
+            batch = chunks[start_idx : start_idx + self.chunk_batch_size]
+            self.handle_chunks_vectorstore(batch, file_id)
+            n_embedded += len(batch)
+            if self.VS:
+                yield Document(
+                    f" => [{file_name}] Created embedding for {n_embedded} chunks",
+                    channel="debug",
+                )
+                yield Document(
+                    {"file_id": file_id, "n_embedded": n_embedded},
+                    channel="progress",
+                )
+        return n_embedded
+
+    def get_previous_chunks(
+        self, file_id: str
+    ) -> tuple[dict[str, list[str]], list[str]]:
+        """Get the ids of the chunks of an indexed file, by content hash
+
+        Returns:
+            - the chunk ids by content hash
+            - the ids of the chunks missing from the vector store, e.g. because the
+                indexing was interrupted. They can't be reused
+        """
+        with Session(engine) as session:
+            relations = session.execute(
+                select(self.Index.relation_type, self.Index.target_id).where(
+                    self.Index.source_id == file_id
+                )
+            ).all()
+        doc_ids = [target for relation, target in relations if relation == "document"]
+        vector_ids = {target for relation, target in relations if relation == "vector"}
+
+        previous_chunks: dict[str, list[str]] = defaultdict(list)
+        unembedded_ids = []
+        for start_idx in range(0, len(doc_ids), self.chunk_batch_size * 4):
+            chunks = self.DS.get(
+                doc_ids[start_idx : start_idx + self.chunk_batch_size * 4]
             )
+            for chunk in chunks:
+                if self.VS and chunk.doc_id not in vector_ids:
+                    unembedded_ids.append(chunk.doc_id)
+                else:
+                    previous_chunks[chunk_hash(chunk)].append(chunk.doc_id)
 
-        def insert_chunks_to_vectorstore():
-            chunks = []
-            n_chunks = 0
-            chunk_size = self.chunk_batch_size
-            for start_idx in range(0, len(to_index_chunks), chunk_size):
-                chunks = to_index_chunks[start_idx : start_idx + chunk_size]
-                self.handle_chunks_vectorstore(chunks, file_id)
-                n_chunks += len(chunks)
-                if self.VS:
-                    yield Document(
-                        f" => [{file_name}] Created embedding for {n_chunks} chunks",
-                        channel="debug",
+        return previous_chunks, unembedded_ids
+
+    def delete_chunks(self, file_id: str, chunk_ids: list[str]):
+        """Delete some chunks of the file from the stores and the Index table"""
+        if not chunk_ids:
+            return
+
+        with Session(engine) as session:
+            relations = session.execute(
+                select(self.Index.relation_type, self.Index.target_id).where(
+                    self.Index.source_id == file_id
+                )
+            ).all()
+            for start_idx in range(0, len(chunk_ids), 500):
+                session.execute(
+                    delete(self.Index).where(
+                        self.Index.source_id == file_id,
+                        self.Index.target_id.in_(
+                            chunk_ids[start_idx : start_idx + 500]
+                        ),
                     )
+                )
 
-        # run vector indexing in thread if specified
-        if self.run_embedding_in_thread:
-            print("Running embedding in thread")
-            threading.Thread(
-                target=lambda: list(insert_chunks_to_vectorstore())
-            ).start()
-        else:
-            yield from insert_chunks_to_vectorstore()
+            to_delete = set(chunk_ids)
+            vs_ids = [
+                target
+                for relation, target in relations
+                if relation == "vector" and target in to_delete
+            ]
+            ds_ids = [
+                target
+                for relation, target in relations
+                if relation == "document" and target in to_delete
+            ]
+            vs_ids = filter_unreferenced(session, self.Index, vs_ids)
+            ds_ids = filter_unreferenced(session, self.Index, ds_ids)
+            session.commit()
+        chunk_scope_cache.invalidate(self.Index.__tablename__, file_id)
 
-        print("indexing step took", time.time() - s_time)
-        return n_chunks
+        if vs_ids and self.VS:
+            self.VS.delete(vs_ids)
+        if ds_ids:
+            self.DS.delete(ds_ids)
+
+    def link_blobs(self, file_id: str, keys: Iterable[str]):
+        """Record that the chunks of the file refer to these blobs"""
+        keys = list(keys)
+        if not keys:
+            return
+
+        with Session(engine) as session:
+            linked = set(
+                session.scalars(
+                    select(self.Index.target_id).where(
+                        self.Index.source_id == file_id,
+                        self.Index.relation_type == "blob",
+                    )
+                )
+            )
+            session.add_all(
+                self.Index(source_id=file_id, target_id=key, relation_type="blob")
+                for key in keys
+                if key not in linked
+            )
+            session.commit()
+
+    def unlink_blobs(self, file_id: str, keep: Iterable[str] = ()):
+        """Forget the blobs of the file but `keep`, e.g. those of the chunks left
+        after a reindex, and delete the blobs that no file refers to anymore"""
+        keep = set(keep)
+        with Session(engine) as session:
+            keys = [
+                key
+                for key in session.scalars(
+                    select(self.Index.target_id).where(
+                        self.Index.source_id == file_id,
+                        self.Index.relation_type == "blob",
+                    )
+                )
+                if key not in keep
+            ]
+            for start_idx in range(0, len(keys), 500):
+                session.execute(
+                    delete(self.Index).where(
+                        self.Index.source_id == file_id,
+                        self.Index.relation_type == "blob",
+                        self.Index.target_id.in_(keys[start_idx : start_idx + 500]),
+                    )
+                )
+            keys = filter_unreferenced_blobs(session, keys)
+            session.commit()
+        blob_store.delete(keys)
+
+    def update_file(self, file_id: str, file_path: Path) -> str:
+        """Replace the stored file of an indexed file, keeping its file id"""
+        file_hash = self.get_file_hash(file_path)
+        shutil.copy(file_path, self.FSPath / file_hash)
+        with Session(engine) as session:
+            source = session.get(self.Source, file_id)
+            source.path = file_hash
+            source.size = file_path.stat().st_size
+            session.add(source)
+            session.commit()
+
+        return file_id
+
+    def stream_embedding(
+        self, file_id: str, file_name: str
+    ) -> Generator[Document, None, int]:
+        """Embed the chunks of the file that are in the docstore but not yet in the
+        vector store, e.g. after the indexing was interrupted
+
+        Returns:
+            the number of chunks embedded
+        """
+        if not self.VS:
+            return 0
+
+        with Session(engine) as session:
+            doc_ids = session.scalars(
+                select(self.Index.target_id).where(
+                    self.Index.source_id == file_id,
+                    self.Index.relation_type == "document",
+                )
+            ).all()
+            embedded_ids = set(
+                session.scalars(
+                    select(self.Index.target_id).where(
+                        self.Index.source_id == file_id,
+                        self.Index.relation_type == "vector",
+                    )
+                ).all()
+            )
+        missing_ids = [doc_id for doc_id in doc_ids if doc_id not in embedded_ids]
+
+        n_chunks = len(embedded_ids)
+        for start_idx in range(0, len(missing_ids), self.chunk_batch_size):
+            chunks = self.DS.get(
+                missing_ids[start_idx : start_idx + self.chunk_batch_size]
+            )
+            self.handle_chunks_vectorstore(chunks, file_id)
+            n_chunks += len(chunks)
+            yield Document(
+                f" => [{file_name}] Created embedding for {n_chunks} chunks",
+                channel="debug",
+            )
+            yield Document(
+                {"file_id": file_id, "n_embedded": n_chunks}, channel="progress"
+            )
+
+        return len(missing_ids)
 
     def handle_chunks_docstore(self, chunks, file_id):
         """Run chunks"""
@@ -439,6 +949,7 @@ class IndexPipeline(BaseComponent):
                 )
             session.add_all(nodes)
             session.commit()
+        chunk_scope_cache.invalidate(self.Index.__tablename__, file_id)
 
     def handle_chunks_vectorstore(self, chunks, file_id):
         """Run chunks"""
@@ -510,18 +1021,22 @@ class IndexPipeline(BaseComponent):
 
         return file_id
 
-    def store_file(self, file_path: Path) -> str:
+    def get_file_hash(self, file_path: Path) -> str:
+        """Get the sha256 of the file content, under which the file is stored"""
+        with file_path.open("rb") as fi:
+            return sha256(fi.read()).hexdigest()
+
+    def store_file(self, file_path: Path, file_hash: Optional[str] = None) -> str:
         """Store file into the database and storage, return the file id
 
         Args:
             file_path: the path to the file
+            file_hash: the sha256 of the file, computed if not given
 
         Returns:
             the file id
         """
-        with file_path.open("rb") as fi:
-            file_hash = sha256(fi.read()).hexdigest()
-
+        file_hash = file_hash or self.get_file_hash(file_path)
         shutil.copy(file_path, self.FSPath / file_hash)
         source = self.Source(
             name=file_path.name,
@@ -536,8 +1051,17 @@ class IndexPipeline(BaseComponent):
 
         return file_id
 
-    def finish(self, file_id: str, file_path: str | Path) -> str:
-        """Finish the indexing"""
+    def finish(
+        self, file_id: str, file_path: str | Path, n_tokens: Optional[int] = None
+    ) -> str:
+        """Finish the indexing
+
+        Args:
+            file_id: the file id
+            file_path: the path to the file
+            n_tokens: the number of tokens of the file's chunks, counted as they
+                were stored. Left unchanged if not given
+        """
         with Session(engine) as session:
             stmt = select(self.Source).where(self.Source.id == file_id)
             result = session.execute(stmt).first()
@@ -547,28 +1071,76 @@ class IndexPipeline(BaseComponent):
             item = result[0]
 
             # populate the number of tokens
-            doc_ids_stmt = select(self.Index.target_id).where(
-                self.Index.source_id == file_id,
-                self.Index.relation_type == "document",
-            )
-            doc_ids = [_[0] for _ in session.execute(doc_ids_stmt)]
-            token_func = self.get_token_func()
-            if doc_ids and token_func:
-                docs = self.DS.get(doc_ids)
-                item.note["tokens"] = sum([len(token_func(doc.text)) for doc in docs])
+            if n_tokens:
+                item.note["tokens"] = n_tokens
 
             # populate the note
-            item.note["loader"] = self.get_from_path("loader").__class__.__name__
+            item.note["loader"] = loader_name(self.get_from_path("loader"))
 
             session.add(item)
             session.commit()
 
         return file_id
 
+    def can_use_loader_executor(self) -> bool:
+        """Whether the loader can run in the loader executor"""
+        if self.loader_executor is None:
+            return False
+        if getattr(self, "_loader_picklable", None) is None:
+            try:
+                pickle.dumps(self.loader)
+            except Exception as e:
+                logger.warning(
+                    f"Cannot run {self.loader.__class__.__name__} in the loader "
+                    f"executor, running it in the current process instead: {e}"
+                )
+                self._loader_picklable = False
+            else:
+                self._loader_picklable = True
+        return self._loader_picklable
+
+    def load_data(self, file_path: str | Path, extra_info: dict) -> list[Document]:
+        """Convert the file to documents, in the loader executor if possible"""
+        if self.can_use_loader_executor():
+            return self.loader_executor.submit(
+                _load_data, self.loader, file_path, extra_info
+            ).result()
+
+        return self.loader.load_data(file_path, extra_info=extra_info)
+
+    def lazy_load_data(
+        self, file_path: str | Path, extra_info: dict
+    ) -> Optional[Iterator[Document]]:
+        """Convert the file to documents lazily, if enabled and supported by the loader
+
+        The loaders that can run in the loader executor are not run lazily: the
+        executor returns all the documents of the file at once.
+
+        Returns:
+            an iterator over the documents, None if they must be loaded at once
+        """
+        if not self.streaming_batch_size or self.can_use_loader_executor():
+            return None
+        lazy_load_data = getattr(type(self.loader), "lazy_load_data", None)
+        if lazy_load_data is None or lazy_load_data is BaseReader.lazy_load_data:
+            return None
+        return iter(self.loader.lazy_load_data(file_path, extra_info=extra_info))
+
     def get_token_func(self):
         """Get the token function for calculating the number of tokens"""
         return _default_token_func
 
+    def count_tokens(self, chunks: list[Document]) -> int:
+        """Get the total number of tokens of the chunks"""
+        token_func = self.get_token_func()
+        if not token_func:
+            return 0
+        # the chunks of TiktokenSplitter already have their number of tokens
+        return sum(
+            chunk.metadata.get("token_count") or len(token_func(chunk.text))
+            for chunk in chunks
+        )
+
     def delete_file(self, file_id: str):
         """Delete a file from the db, including its chunks in docstore and vectorstore
 
@@ -577,22 +1149,87 @@ class IndexPipeline(BaseComponent):
         """
         with Session(engine) as session:
             session.execute(delete(self.Source).where(self.Source.id == file_id))
-            vs_ids, ds_ids = [], []
+            vs_ids, ds_ids, keys = [], [], []
             index = session.execute(
-                select(self.Index).where(self.Index.source_id == file_id)
+                select(self.Index.relation_type, self.Index.target_id).where(
+                    self.Index.source_id == file_id
+                )
             ).all()
-            for each in index:
-                if each[0].relation_type == "vector":
-                    vs_ids.append(each[0].target_id)
-                elif each[0].relation_type == "document":
-                    ds_ids.append(each[0].target_id)
-                session.delete(each[0])
+            for relation_type, target_id in index:
+                if relation_type == "vector":
+                    vs_ids.append(target_id)
+                elif relation_type == "document":
+                    ds_ids.append(target_id)
+                elif relation_type == "blob":
+                    keys.append(target_id)
+            session.execute(delete(self.Index).where(self.Index.source_id == file_id))
+            # the chunks shared with files of the same content are kept
+            vs_ids = filter_unreferenced(session, self.Index, vs_ids)
+            ds_ids = filter_unreferenced(session, self.Index, ds_ids)
+            keys = filter_unreferenced_blobs(session, keys)
             session.commit()
+        chunk_scope_cache.invalidate(self.Index.__tablename__, file_id)
 
         if vs_ids and self.VS:
             self.VS.delete(vs_ids)
         if ds_ids:
             self.DS.delete(ds_ids)
+        blob_store.delete(keys)
+
+    def get_duplicate_id(self, file_hash: str) -> Optional[str]:
+        """Get the id of a file indexed with the same content and loader
+
+        Args:
+            file_hash: the sha256 of the file content
+
+        Returns:
+            the id of the file, None if there is no such file
+        """
+        loader = loader_name(self.get_from_path("loader"))
+        with Session(engine) as session:
+            sources = session.scalars(
+                select(self.Source).where(self.Source.path == file_hash)
+            ).all()
+        for source in sources:
+            # files being indexed don't have their loader recorded yet
+            if (source.note or {}).get("loader") == loader:
+                return source.id
+
+        return None
+
+    def link_duplicate(self, file_id: str, duplicate_id: str):
+        """Make the file share the chunks of the file with the same content
+
+        Besides the chunks and their blobs, the file is related to the files whose
+        id is in the chunks' metadata, for the retrieval to filter on.
+        """
+        with Session(engine) as session:
+            relations = session.execute(
+                select(self.Index.relation_type, self.Index.target_id).where(
+                    self.Index.source_id == duplicate_id,
+                    self.Index.relation_type.in_(
+                        ["document", "vector", "file", "blob"]
+                    ),
+                )
+            ).all()
+            owner_ids = [target for relation, target in relations if relation == "file"]
+            nodes = [
+                self.Index(source_id=file_id, target_id=target, relation_type=relation)
+                for relation, target in relations
+                if relation != "file"
+            ]
+            nodes += [
+                self.Index(source_id=file_id, target_id=owner_id, relation_type="file")
+                for owner_id in owner_ids or [duplicate_id]
+            ]
+            session.add_all(nodes)
+
+            source = session.get(self.Source, file_id)
+            duplicate = session.get(self.Source, duplicate_id)
+            source.note = dict(duplicate.note or {})
+            session.add(source)
+            session.commit()
+        chunk_scope_cache.invalidate(self.Index.__tablename__, file_id)
 
     def run(
         self, file_path: str | Path, reindex: bool, **kwargs
@@ -607,6 +1244,7 @@ class IndexPipeline(BaseComponent):
             file_path = file_path.resolve()
 
         file_id = self.get_id_if_exists(file_path)
+        previous_chunks = None
 
         if isinstance(file_path, Path):
             if file_id is not None:
@@ -615,6 +1253,14 @@ class IndexPipeline(BaseComponent):
                         f"File {file_path.name} already indexed. Please rerun with "
                         "reindex=True to force reindexing."
                     )
+                elif self.incremental_reindex:
+                    yield Document(
+                        f" => Comparing with the indexed {file_path.name}",
+                        channel="debug",
+                    )
+                    previous_chunks, unembedded_ids = self.get_previous_chunks(file_id)
+                    self.delete_chunks(file_id, unembedded_ids)
+                    self.update_file(file_id, file_path)
                 else:
                     # remove the existing records
                     yield Document(
@@ -624,7 +1270,22 @@ class IndexPipeline(BaseComponent):
                     file_id = self.store_file(file_path)
             else:
                 # add record to db
-                file_id = self.store_file(file_path)
+                file_hash = self.get_file_hash(file_path)
+                duplicate_id = (
+                    self.get_duplicate_id(file_hash) if self.dedup_files else None
+                )
+                file_id = self.store_file(file_path, file_hash)
+                if duplicate_id is not None:
+                    yield Document(
+                        " => Reusing the chunks of the identical file for "
+                        f"{file_path.name}",
+                        channel="debug",
+                    )
+                    self.link_duplicate(file_id, duplicate_id)
+                    yield Document(
+                        f" => Finished indexing {file_path.name}", channel="debug"
+                    )
+                    return file_id, []
         else:
             if file_id is not None:
                 raise ValueError(f"URL {file_path} already indexed.")
@@ -642,13 +1303,24 @@ class IndexPipeline(BaseComponent):
 
         extra_info["file_id"] = file_id
         extra_info["collection_name"] = self.collection_name
+        yield Document({"file_id": file_id, "stage": "loading"}, channel="progress")
 
         yield Document(f" => Converting {file_name} to text", channel="debug")
-        docs = self.loader.load_data(file_path, extra_info=extra_info)
-        yield Document(f" => Converted {file_name} to text", channel="debug")
-        yield from self.handle_docs(docs, file_id, file_name)
+        lazy_docs = self.lazy_load_data(file_path, extra_info)
+        if lazy_docs is not None:
+            # the documents are indexed as they are loaded, without being kept
+            _, n_tokens = yield from self.handle_docs(
+                lazy_docs, file_id, file_name, previous_chunks
+            )
+            docs = []
+        else:
+            docs = self.load_data(file_path, extra_info)
+            yield Document(f" => Converted {file_name} to text", channel="debug")
+            _, n_tokens = yield from self.handle_docs(
+                docs, file_id, file_name, previous_chunks
+            )
 
-        self.finish(file_id, file_path)
+        self.finish(file_id, file_path, n_tokens)
 
         yield Document(f" => Finished indexing {file_name}", channel="debug")
         return file_id, docs
@@ -669,6 +1341,16 @@ class IndexDocumentPipeline(BaseFileIndexIndexing):
     reader_mode: str = Param("default", help="The reader mode")
     embedding: BaseEmbeddings
     run_embedding_in_thread: bool = False
+    max_workers: int = Param(
+        getattr(settings, "KH_INDEXING_MAX_WORKERS", 1),
+        help="Number of files indexed concurrently. The docstore and vectorstore "
+        "must support concurrent writes when larger than 1",
+    )
+    loader_processes: int = Param(
+        getattr(settings, "KH_INDEXING_LOADER_PROCESSES", 0),
+        help="Size of the process pool running the (CPU-bound) file loaders. 0 to "
+        "run the loaders in the indexing threads",
+    )
 
     @Param.auto(depends_on="reader_mode")
     def readers(self):
@@ -748,17 +1430,23 @@ class IndexDocumentPipeline(BaseFileIndexIndexing):
                     f"No supported pipeline to index {file_path.name}. Please specify "
                     "the suitable pipeline for this file type in the settings."
                 )
+            if (
+                isinstance(reader, PDFThumbnailReader)
+                and reader.thumbnail_mode != self.thumbnail_mode
+            ):
+                reader = PDFThumbnailReader(thumbnail_mode=self.thumbnail_mode)
 
         print(f"Chunk size: {chunk_size}, chunk overlap: {chunk_overlap}")
 
         print("Using reader", reader)
         pipeline: IndexPipeline = IndexPipeline(
-            loader=reader,
-            splitter=TokenSplitter(
+            loader=with_parse_cache(reader),
+            splitter=TiktokenSplitter(
                 chunk_size=chunk_size or 1024,
                 chunk_overlap=chunk_overlap or 256,
                 separator="\n\n",
                 backup_separators=["\n", ".", "\u200B"],
+                executor=getattr(self, "_loader_executor", None),
             ),
             run_embedding_in_thread=self.run_embedding_in_thread,
             Source=self.Source,
@@ -769,6 +1457,8 @@ class IndexDocumentPipeline(BaseFileIndexIndexing):
             user_id=self.user_id,
             private=self.private,
             embedding=self.embedding,
+            loader_executor=getattr(self, "_loader_executor", None),
+            embedding_scheduler=self.embedding_scheduler,
         )
 
         return pipeline
@@ -778,6 +1468,96 @@ class IndexDocumentPipeline(BaseFileIndexIndexing):
     ) -> tuple[list[str | None], list[str | None]]:
         raise NotImplementedError
 
+    def stream_file(
+        self, idx: int, n_files: int, file_path: str | Path, reindex: bool, **kwargs
+    ) -> Generator[Document, None, tuple[str | None, str | None, list[Document]]]:
+        """Index a single file, return its file id, error message and documents"""
+        if self.is_url(file_path):
+            file_name = file_path
+        else:
+            file_path = Path(file_path)
+            file_name = file_path.name
+
+        yield Document(
+            content=f"Indexing [{idx + 1}/{n_files}]: {file_name}",
+            channel="debug",
+        )
+
+        try:
+            pipeline = self.route(file_path)
+            file_id, docs = yield from pipeline.stream(
+                file_path, reindex=reindex, **kwargs
+            )
+            yield Document(
+                content={
+                    "file_path": file_path,
+                    "file_name": file_name,
+                    "status": "success",
+                },
+                channel="index",
+            )
+            return file_id, None, docs
+        except Exception as e:
+            logger.exception(e)
+            yield Document(
+                content={
+                    "file_path": file_path,
+                    "file_name": file_name,
+                    "status": "failed",
+                    "message": str(e),
+                },
+                channel="index",
+            )
+            return None, str(e), []
+
+    def stream_files_concurrently(
+        self, file_paths: list[str | Path], reindex: bool, **kwargs
+    ) -> Generator[Document, None, list[tuple[str | None, str | None, list[Document]]]]:
+        """Index the files in a thread pool
+
+        The progress documents are yielded in the same order as when indexing the
+        files one after another: those of the first file as they are produced,
+        then those of the second file, that were buffered in the meantime, etc.
+        """
+        n_files = len(file_paths)
+        outputs: list[queue.Queue] = [queue.Queue() for _ in file_paths]
+        # marks the end of the documents of a file, followed by its result
+        done = object()
+
+        def index_file(idx: int, file_path: str | Path):
+            result: tuple = (None, "Indexing was interrupted", [])
+            try:
+                result = yield_into(
+                    outputs[idx],
+                    self.stream_file(idx, n_files, file_path, reindex, **kwargs),
+                )
+            finally:
+                outputs[idx].put(done)
+                outputs[idx].put(result)
+
+        def yield_into(output: queue.Queue, generator: Generator):
+            while True:
+                try:
+                    output.put(next(generator))
+                except StopIteration as e:
+                    return e.value
+
+        results = []
+        executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="index-file"
+        )
+        try:
+            for idx, file_path in enumerate(file_paths):
+                executor.submit(index_file, idx, file_path)
+            for output in outputs:
+                while (item := output.get()) is not done:
+                    yield item
+                results.append(output.get())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
     def stream(
         self, file_paths: str | Path | list[str | Path], reindex: bool = False, **kwargs
     ) -> Generator[
@@ -791,47 +1571,33 @@ class IndexDocumentPipeline(BaseFileIndexIndexing):
         errors: list[str | None] = []
         all_docs = []
 
-        n_files = len(file_paths)
-        for idx, file_path in enumerate(file_paths):
-            if self.is_url(file_path):
-                file_name = file_path
-            else:
-                file_path = Path(file_path)
-                file_name = file_path.name
-
-            yield Document(
-                content=f"Indexing [{idx + 1}/{n_files}]: {file_name}",
-                channel="debug",
-            )
-
-            try:
-                pipeline = self.route(file_path)
-                file_id, docs = yield from pipeline.stream(
-                    file_path, reindex=reindex, **kwargs
-                )
-                all_docs.extend(docs)
-                file_ids.append(file_id)
-                errors.append(None)
-                yield Document(
-                    content={
-                        "file_path": file_path,
-                        "file_name": file_name,
-                        "status": "success",
-                    },
-                    channel="index",
-                )
-            except Exception as e:
-                logger.exception(e)
-                file_ids.append(None)
-                errors.append(str(e))
-                yield Document(
-                    content={
-                        "file_path": file_path,
-                        "file_name": file_name,
-                        "status": "failed",
-                        "message": str(e),
-                    },
-                    channel="index",
-                )
+        self._loader_executor = (
+            ProcessPoolExecutor(max_workers=self.loader_processes)
+            if self.loader_processes > 0
+            else None
+        )
+        try:
+            # rebuild the full-text index once, after all the files are stored
+            with deferred_refresh(self.DS):
+                if self.max_workers > 1 and len(file_paths) > 1:
+                    results = yield from self.stream_files_concurrently(
+                        file_paths, reindex=reindex, **kwargs
+                    )
+                else:
+                    results = []
+                    for idx, file_path in enumerate(file_paths):
+                        result = yield from self.stream_file(
+                            idx, len(file_paths), file_path, reindex=reindex, **kwargs
+                        )
+                        results.append(result)
+        finally:
+            if self._loader_executor is not None:
+                self._loader_executor.shutdown(wait=False, cancel_futures=True)
+            self._loader_executor = None
+
+        for file_id, error, docs in results:
+            file_ids.append(file_id)
+            errors.append(error)
+            all_docs.extend(docs)
 
         return file_ids, errors, all_docs
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from theflow.settings import settings
+
+Scope = tuple[list[str], list[str]]
+
+
+class ChunkScopeCache:
+    """LRU cache of the retrieval scope of a selection of files
+
+    Retrieval restricts the search to the chunks of the selected files, which
+    requires expanding the file ids into chunk ids through the Index table. Users
+    tend to keep the same selection during a conversation, so the expansion is
+    cached by (index table, sorted file ids). Entries that contain a file are
+    invalidated whenever chunks of that file are added or deleted.
+
+    The scope is `(chunk ids, ids of the other files owning these chunks)`. The
+    cached lists are shared, callers must not modify them.
+
+    Args:
+        max_entries: maximum number of selections to keep
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[str, tuple[str, ...]], Scope] = (
+            OrderedDict()
+        )
+        # bumped on every invalidation, to not cache a result computed before it
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(index_key: str, file_ids: Iterable[str]) -> tuple:
+        return index_key, tuple(sorted(set(file_ids)))
+
+    def get(self, index_key: str, file_ids: Iterable[str]) -> Optional[Scope]:
+        """Get the scope of the files, None if it is not cached"""
+        key = self.make_key(index_key, file_ids)
+        with self._lock:
+            scope = self._entries.get(key)
+            if scope is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return scope
+
+    def generation(self, index_key: str) -> int:
+        """Get the invalidation counter of an index, to be passed to `put`"""
+        return self._generations.get(index_key, 0)
+
+    def put(
+        self,
+        index_key: str,
+        file_ids: Iterable[str],
+        scope: Scope,
+        generation: Optional[int] = None,
+    ):
+        """Cache the scope of the files
+
+        Args:
+            index_key: the identifier of the index
+            file_ids: the selected file ids
+            scope: the chunk ids of these files and the ids of the files owning
+                them
+            generation: the generation of the index when the scope was
+                queried. If the index was invalidated since, nothing is cached
+        """
+        if not self.max_entries:
+            return
+        key = self.make_key(index_key, file_ids)
+        with self._lock:
+            if generation is not None and generation != self.generation(index_key):
+                return
+            self._entries[key] = scope
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, index_key: str, file_id: Optional[str] = None):
+        """Drop the entries of an index that contain the file, or all of them"""
+        with self._lock:
+            self._generations[index_key] = self.generation(index_key) + 1
+            for key in list(self._entries):
+                if key[0] == index_key and (file_id is None or file_id in key[1]):
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+
+chunk_scope_cache = ChunkScopeCache(
+    max_entries=getattr(settings, "KH_CHUNK_SCOPE_CACHE_SIZE", 128)
+)
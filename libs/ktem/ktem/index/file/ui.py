@@ -3,6 +3,7 @@ import json
 import os
 import shutil
 import tempfile
+import time
 import zipfile
 from copy import deepcopy
 from pathlib import Path
@@ -13,15 +14,24 @@ import pandas as pd
 from gradio.data_classes import FileData
 from gradio.utils import NamedString
 from ktem.app import BasePage
+from ktem.components import blob_store
 from ktem.db.engine import engine
 from ktem.utils.render import Render
-from sqlalchemy import select
+from sqlalchemy import delete, select
 from sqlalchemy.orm import Session
 from theflow.settings import settings as flowsettings
 
+from kotaemon.storages import resolve_blob_uri
+
 from ...utils.commands import WEB_SEARCH_COMMAND
 from ...utils.rate_limit import check_rate_limit
-from .utils import download_arxiv_pdf, is_arxiv_url
+from .scope_cache import chunk_scope_cache
+from .utils import (
+    download_arxiv_pdf,
+    filter_unreferenced,
+    filter_unreferenced_blobs,
+    is_arxiv_url,
+)
 
 KH_DEMO_MODE = getattr(flowsettings, "KH_DEMO_MODE", False)
 KH_SSO_ENABLED = getattr(flowsettings, "KH_SSO_ENABLED", False)
@@ -283,6 +293,32 @@ class FileIndexPage(BasePage):
                 variant="primary",
             )
 
+    def render_job_list(self):
+        self.job_list = gr.DataFrame(
+            headers=[
+                "id",
+                "status",
+                "files",
+                "progress",
+            ],
+            column_widths=["0%", "15%", "10%", "75%"],
+            interactive=False,
+            wrap=False,
+        )
+
+        with gr.Row():
+            self.selected_job_id = gr.State(value=None)
+            self.job_refresh_button = gr.Button("Refresh")
+            self.job_follow_button = gr.Button(
+                "Show progress",
+                visible=False,
+            )
+            self.job_cancel_button = gr.Button(
+                "Cancel",
+                variant="stop",
+                visible=False,
+            )
+
     def on_building_ui(self):
         """Build the UI of the app"""
         with gr.Row():
@@ -339,6 +375,10 @@ class FileIndexPage(BasePage):
                 with gr.Tab("Groups"):
                     self.render_group_list()
 
+                if self._index.job_queue is not None:
+                    with gr.Tab("Jobs"):
+                        self.render_job_list()
+
     def on_subscribe_public_events(self):
         """Subscribe to the declared public event of the app"""
         if KH_DEMO_MODE:
@@ -399,13 +439,14 @@ class FileIndexPage(BasePage):
 
             Index = self._index._resources["Index"]
             with Session(engine) as session:
-                matches = session.execute(
-                    select(Index).where(
-                        Index.source_id == file_id,
-                        Index.relation_type == "document",
+                doc_ids = list(
+                    session.scalars(
+                        select(Index.target_id).where(
+                            Index.source_id == file_id,
+                            Index.relation_type == "document",
+                        )
                     )
                 )
-                doc_ids = [doc.target_id for (doc,) in matches]
                 docs = self._index._docstore.get(doc_ids)
                 docs = sorted(
                     docs, key=lambda x: x.metadata.get("page_label", float("inf"))
@@ -423,7 +464,8 @@ class FileIndexPage(BasePage):
                         content = Render.table(doc.text)
                     elif doc_type == "image":
                         content = Render.image(
-                            url=doc.metadata.get("image_origin", ""), text=doc.text
+                            url=resolve_blob_uri(doc.metadata.get("image_origin", "")),
+                            text=doc.text,
                         )
 
                     header_prefix = f"[{idx+1}/{len(docs)}]"
@@ -456,23 +498,33 @@ class FileIndexPage(BasePage):
                 file_name = source[0].name
                 session.delete(source[0])
 
-            vs_ids, ds_ids = [], []
+            Index = self._index._resources["Index"]
+            vs_ids, ds_ids, keys = [], [], []
             index = session.execute(
-                select(self._index._resources["Index"]).where(
-                    self._index._resources["Index"].source_id == file_id
+                select(Index.relation_type, Index.target_id).where(
+                    Index.source_id == file_id
                 )
             ).all()
-            for each in index:
-                if each[0].relation_type == "vector":
-                    vs_ids.append(each[0].target_id)
-                elif each[0].relation_type == "document":
-                    ds_ids.append(each[0].target_id)
-                session.delete(each[0])
+            for relation_type, target_id in index:
+                if relation_type == "vector":
+                    vs_ids.append(target_id)
+                elif relation_type == "document":
+                    ds_ids.append(target_id)
+                elif relation_type == "blob":
+                    keys.append(target_id)
+            session.execute(delete(Index).where(Index.source_id == file_id))
+            # the chunks shared with files of the same content are kept
+            vs_ids = filter_unreferenced(session, Index, vs_ids)
+            ds_ids = filter_unreferenced(session, Index, ds_ids)
+            keys = filter_unreferenced_blobs(session, keys)
             session.commit()
+        chunk_scope_cache.invalidate(Index.__tablename__, file_id)
 
         if vs_ids:
             self._index._vs.delete(vs_ids)
-        self._index._docstore.delete(ds_ids)
+        if ds_ids:
+            self._index._docstore.delete(ds_ids)
+        blob_store.delete(keys)
 
         gr.Info(f"File {file_name} has been deleted")
 
@@ -1036,6 +1088,64 @@ class FileIndexPage(BasePage):
             onGroupDeleted = onGroupDeleted.then(**event)
             onGroupSaved = onGroupSaved.then(**event)
 
+        if self._index.job_queue is not None:
+            self.on_register_job_events()
+
+    def on_register_job_events(self):
+        """Register the events of the background ingestion jobs"""
+        self.job_refresh_button.click(
+            fn=self.list_jobs,
+            inputs=[self._app.user_id],
+            outputs=[self.job_list],
+            show_progress="hidden",
+        )
+
+        self.job_list.select(
+            fn=self.interact_job_list,
+            inputs=[self.job_list],
+            outputs=[
+                self.selected_job_id,
+                self.job_follow_button,
+                self.job_cancel_button,
+            ],
+            show_progress="hidden",
+        )
+
+        self.job_cancel_button.click(
+            fn=self.cancel_job,
+            inputs=[self.selected_job_id],
+        ).then(
+            fn=self.list_jobs,
+            inputs=[self._app.user_id],
+            outputs=[self.job_list],
+        )
+
+        # e.g. after reconnecting, the job kept running in the background
+        onFollowed = (
+            self.job_follow_button.click(
+                fn=lambda: gr.update(visible=True),
+                outputs=[self.upload_progress_panel],
+            )
+            .then(
+                fn=self._follow_ingestion_job,
+                inputs=[self.selected_job_id],
+                outputs=[self.upload_result, self.upload_info],
+                concurrency_limit=20,
+            )
+            .then(
+                fn=self.list_jobs,
+                inputs=[self._app.user_id],
+                outputs=[self.job_list],
+            )
+            .then(
+                fn=self.list_file,
+                inputs=[self._app.user_id, self.filter],
+                outputs=[self.file_list_state, self.file_list],
+            )
+        )
+        for event in self._app.get_event(f"onFileIndex{self._index.id}Changed"):
+            onFollowed = onFollowed.then(**event)
+
     def _on_app_created(self):
         """Called when the app is created"""
         if KH_DEMO_MODE:
@@ -1055,6 +1165,13 @@ class FileIndexPage(BasePage):
             outputs=[self.group_files],
         )
 
+        if self._index.job_queue is not None:
+            self._app.app.load(
+                self.list_jobs,
+                inputs=[self._app.user_id],
+                outputs=[self.job_list],
+            )
+
     def _may_extract_zip(self, files, zip_dir: str):
         """Handle zip files"""
         zip_files = [file for file in files if file.endswith(".zip")]
@@ -1117,6 +1234,12 @@ class FileIndexPage(BasePage):
 
         gr.Info(f"Start indexing {len(files)} files...")
 
+        job_queue = getattr(self._index, "job_queue", None)
+        if job_queue is not None:
+            job_id = job_queue.submit(files, reindex, settings, user_id)
+            results = yield from self._follow_ingestion_job(job_id)
+            return results
+
         # get the pipeline
         indexing_pipeline = self._index.get_indexing_pipeline(settings, user_id)
 
@@ -1155,6 +1278,49 @@ class FileIndexPage(BasePage):
 
         return results
 
+    def _follow_ingestion_job(
+        self, job_id: str
+    ) -> Generator[tuple[str, str], None, list]:
+        """Report the progress of a background ingestion job until it finishes
+
+        The job keeps running if the user leaves the page.
+        """
+        job_queue = self._index.job_queue
+        last_output = None
+        while True:
+            job = job_queue.status(job_id)
+            outputs, debugs = [], [f"Job {job_id}: {job['status']}"]
+            for idx, file in enumerate(job["files"]):
+                if file["status"] == "completed":
+                    outputs.append(f"\u2705 | {file['name']}")
+                elif file["status"] == "failed":
+                    outputs.append(f"\u274c | {file['name']}: {file['message']}")
+                progress = f"Indexing [{idx + 1}/{len(job['files'])}]: {file['name']}"
+                progress += f" - {file['status']} ({file['stage']}"
+                if file["n_chunks"]:
+                    progress += f", embedded {file['n_embedded']}/{file['n_chunks']}"
+                debugs.append(progress + ")")
+
+            output = "\n".join(outputs), "\n".join(debugs)
+            if output != last_output:
+                yield output
+                last_output = output
+            if job["status"] in ("completed", "failed", "cancelled"):
+                break
+            time.sleep(1)
+
+        n_successes = len([_ for _ in job["files"] if _["status"] == "completed"])
+        if n_successes:
+            gr.Info(f"Successfully index {n_successes} files")
+        n_errors = len([_ for _ in job["files"] if _["status"] == "failed"])
+        if n_errors:
+            gr.Warning(f"Have errors for {n_errors} files")
+
+        return [
+            file["file_id"] if file["status"] == "completed" else None
+            for file in job["files"]
+        ]
+
     def index_fn_file_with_default_loaders(
         self, files, reindex: bool, settings, user_id
     ) -> list["str"]:
@@ -1399,6 +1565,49 @@ class FileIndexPage(BasePage):
 
         return results, file_list
 
+    def list_jobs(self, user_id):
+        """List the latest ingestion jobs of the user"""
+        jobs = []
+        if user_id is not None:
+            jobs = self._index.job_queue.list_jobs(user_id)
+
+        results = [
+            {
+                "id": job["id"],
+                "status": job["status"],
+                "files": "{}/{}".format(
+                    len([_ for _ in job["files"] if _["status"] == "completed"]),
+                    len(job["files"]),
+                ),
+                "progress": ", ".join(
+                    f"{file['name']} ({file['status']})" for file in job["files"]
+                ),
+            }
+            for job in jobs
+        ]
+        if not results:
+            results = [{"id": "-", "status": "-", "files": "-", "progress": "-"}]
+
+        return pd.DataFrame.from_records(results)
+
+    def interact_job_list(self, list_jobs, ev: gr.SelectData):
+        if not ev.selected or list_jobs["id"][ev.index[0]] == "-":
+            return None, gr.update(visible=False), gr.update(visible=False)
+
+        status = list_jobs["status"][ev.index[0]]
+        return (
+            list_jobs["id"][ev.index[0]],
+            gr.update(visible=True),
+            gr.update(visible=status in ("pending", "running")),
+        )
+
+    def cancel_job(self, job_id):
+        if not job_id:
+            raise gr.Error("No job is selected")
+
+        self._index.job_queue.cancel(job_id)
+        gr.Info("The files not being indexed yet have been cancelled")
+
     def list_file_names(self, file_list_state):
         if file_list_state:
             file_names = [(item["name"], item["id"]) for item in file_list_state]
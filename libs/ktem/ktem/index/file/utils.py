@@ -1,6 +1,8 @@
 import os
+import re
 
 import requests
+from sqlalchemy import column, inspect, select, table
 
 # regex patterns for Arxiv URL
 ARXIV_URL_PATTERNS = [
@@ -10,6 +12,9 @@ ARXIV_URL_PATTERNS = [
 
 ILLEGAL_NAME_CHARS = ["\\", "/", ":", "*", "?", '"', "<", ">", "|"]
 
+# the Index tables of the file indices
+INDEX_TABLE_PATTERN = re.compile(r"index__\d+__index")
+
 
 def clean_name(name):
     for char in ILLEGAL_NAME_CHARS:
@@ -56,3 +61,45 @@ def download_arxiv_pdf(url, output_path):
             f.write(response.content)
 
     return output_file_path
+
+
+def filter_unreferenced(session, Index, target_ids: list[str]) -> list[str]:
+    """Keep the chunk ids that no file refers to in the Index table anymore
+
+    Files with the same content share their chunks, which must only be deleted
+    from the stores with the last of these files.
+    """
+    referenced = set()
+    for start_idx in range(0, len(target_ids), 500):
+        referenced.update(
+            session.scalars(
+                select(Index.target_id).where(
+                    Index.target_id.in_(target_ids[start_idx : start_idx + 500])
+                )
+            )
+        )
+    return [target_id for target_id in target_ids if target_id not in referenced]
+
+
+def filter_unreferenced_blobs(session, keys: list[str]) -> list[str]:
+    """Keep the blob keys that no file refers to in any Index table anymore
+
+    The blob store is shared by all the file indices, so a blob can only be
+    deleted once none of their files refers to it.
+    """
+    index_tables = [
+        table(name, column("target_id"))
+        for name in inspect(session.get_bind()).get_table_names()
+        if INDEX_TABLE_PATTERN.fullmatch(name)
+    ]
+    referenced = set()
+    for index_table in index_tables:
+        for start_idx in range(0, len(keys), 500):
+            referenced.update(
+                session.scalars(
+                    select(index_table.c.target_id).where(
+                        index_table.c.target_id.in_(keys[start_idx : start_idx + 500])
+                    )
+                )
+            )
+    return [key for key in keys if key not in referenced]
@@ -4,6 +4,7 @@ import markdown
 from fast_langdetect import detect
 
 from kotaemon.base import RetrievedDocument
+from kotaemon.storages import resolve_blob_uri
 
 BASE_PATH = os.environ.get("GR_FILE_ROOT_PATH", "")
 
@@ -145,7 +146,9 @@ class Render:
     ) -> str:
         header = f"<i>{get_header(doc)}</i>"
         if doc.metadata.get("type", "") == "image":
-            doc_content = Render.image(url=doc.metadata["image_origin"], text=doc.text)
+            doc_content = Render.image(
+                url=resolve_blob_uri(doc.metadata["image_origin"]), text=doc.text
+            )
         elif doc.metadata.get("type", "") == "table_raw":
             doc_content = Render.table_preserve_linebreaks(doc.text)
         else:
@@ -212,7 +215,7 @@ class Render:
         text = doc.text if not override_text else override_text
         if doc.metadata.get("type", "") == "image":
             rendered_doc_content = Render.image(
-                url=doc.metadata["image_origin"],
+                url=resolve_blob_uri(doc.metadata["image_origin"]),
                 text=text,
             )
         elif doc.metadata.get("type", "") == "table_raw":
@@ -0,0 +1,136 @@
+"""Benchmark the lookups on the per-index `Index` table, with and without indexes
+
+The table relates each file (source_id) to its chunks in the docstore and the
+vector store (target_id). The benchmark measures the queries issued on every chat
+turn (chunks of the selected files) and on file deletion.
+
+Usage:
+    python scripts/benchmarks/bench_index_table.py --rows 1000000 10000000
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from sqlalchemy import Column, Index, Integer, String, create_engine, select
+from sqlalchemy.orm import Session, declarative_base
+
+
+def make_table(with_indexes: bool):
+    Base = declarative_base()
+    table_args = (
+        (
+            Index("ix_source_relation", "source_id", "relation_type", "target_id"),
+            Index("ix_target", "target_id"),
+        )
+        if with_indexes
+        else ()
+    )
+    return type(
+        "IndexTable",
+        (Base,),
+        {
+            "__tablename__": "index__1__index",
+            "__table_args__": table_args,
+            "id": Column(Integer, primary_key=True, autoincrement=True),
+            "source_id": Column(String),
+            "target_id": Column(String),
+            "relation_type": Column(String),
+            "user": Column(String, default=""),
+        },
+    )
+
+
+def populate(engine, table, n_rows: int, chunks_per_file: int) -> list[str]:
+    """Insert n_rows relations, half of them "document" and half "vector" """
+    n_files = max(1, n_rows // (2 * chunks_per_file))
+    file_ids = [str(uuid.uuid4()) for _ in range(n_files)]
+    batch = []
+    with engine.begin() as conn:
+        for file_id in file_ids:
+            for _ in range(chunks_per_file):
+                chunk_id = str(uuid.uuid4())
+                batch.append(
+                    {
+                        "source_id": file_id,
+                        "target_id": chunk_id,
+                        "relation_type": "document",
+                    }
+                )
+                batch.append(
+                    {
+                        "source_id": file_id,
+                        "target_id": chunk_id,
+                        "relation_type": "vector",
+                    }
+                )
+            if len(batch) >= 100_000:
+                conn.execute(table.__table__.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.__table__.insert(), batch)
+    return file_ids
+
+
+def measure(fn, repeat: int) -> float:
+    """Median duration of fn in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def run(n_rows: int, chunks_per_file: int, selected_files: int, repeat: int):
+    for with_indexes in (False, True):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine(f"sqlite:///{Path(tmp_dir) / 'sql.db'}")
+            table = make_table(with_indexes)
+            table.metadata.create_all(engine)
+            file_ids = populate(engine, table, n_rows, chunks_per_file)
+
+            with Session(engine) as session:
+
+                def chat_lookup():
+                    doc_ids = random.sample(
+                        file_ids, min(selected_files, len(file_ids))
+                    )
+                    session.scalars(
+                        select(table.target_id).where(
+                            table.relation_type == "document",
+                            table.source_id.in_(doc_ids),
+                        )
+                    ).all()
+
+                def delete_lookup():
+                    session.execute(
+                        select(table.relation_type, table.target_id).where(
+                            table.source_id == random.choice(file_ids)
+                        )
+                    ).all()
+
+                chat_ms = measure(chat_lookup, repeat)
+                delete_ms = measure(delete_lookup, repeat)
+            engine.dispose()
+
+        print(
+            f"rows={n_rows:>10,} indexes={str(with_indexes):<5} "
+            f"chat lookup ({selected_files} files)={chat_ms:9.2f} ms  "
+            f"file lookup={delete_ms:9.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000])
+    parser.add_argument("--chunks-per-file", type=int, default=200)
+    parser.add_argument("--selected-files", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        run(n_rows, args.chunks_per_file, args.selected_files, args.repeat)
@@ -0,0 +1,142 @@
+"""Benchmark the merging of OCR and PDF text boxes, pairwise vs spatially indexed
+
+The OCR reader merges the text boxes found by OCR with those of the PDF text
+layer, and assigns them to table cells, by comparing overlapping boxes. The
+benchmark generates synthetic dense pages (a grid of words, half of it in a table)
+and compares the pairwise comparisons with the grid index of `BoxIndex`.
+
+Usage:
+    python scripts/benchmarks/bench_pdf_ocr_merge.py --words 500 2000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from kotaemon.loaders.utils.box import bbox_to_points, get_rect_iou
+from kotaemon.loaders.utils.pdf_ocr import (
+    IOU_THRES,
+    merge_ocr_and_pdf_texts,
+    merge_table_cell_and_ocr,
+)
+
+
+def make_item(x1: float, y1: float, x2: float, y2: float, **kwargs) -> dict:
+    bbox = [int(x1), int(y1), int(x2), int(y2)]
+    return {"text": "word", "bbox": bbox, "location": bbox_to_points(bbox), **kwargs}
+
+
+def make_page(n_words: int, seed: int = 0):
+    """A page of n_words PDF words on a grid, most of them also found by OCR, and a
+    table whose cells cover the bottom half of the page"""
+    rng = random.Random(seed)
+    n_cols = 10
+    n_rows = max(2, n_words // n_cols)
+    word_w, word_h = 60, 12
+
+    pdf_list, ocr_list = [], []
+    for row in range(n_rows):
+        for col in range(n_cols):
+            x1, y1 = col * (word_w + 10), row * (word_h + 4)
+            pdf_list.append(make_item(x1, y1, x1 + word_w, y1 + word_h))
+            if rng.random() < 0.9:
+                dx, dy = rng.uniform(-4, 4), rng.uniform(-2, 2)
+                ocr_list.append(
+                    make_item(x1 + dx, y1 + dy, x1 + dx + word_w, y1 + dy + word_h)
+                )
+            else:
+                # words missing from the text layer, e.g. in images
+                ocr_list.append(make_item(x1 + 5, y1 + word_h + 1, x1 + 40, y1 + 15))
+
+    table_top = (n_rows // 2) * (word_h + 4)
+    table_list = [
+        make_item(0, table_top, n_cols * (word_w + 10), n_rows * (word_h + 4))
+    ]
+    table_list[0]["type"] = "table"
+    for row in range(n_rows // 2, n_rows):
+        for col in range(0, n_cols, 2):
+            x1, y1 = col * (word_w + 10), row * (word_h + 4)
+            table_list.append(make_item(x1, y1, x1 + 2 * (word_w + 10), y1 + 16))
+            table_list[-1]["type"] = "cell"
+
+    return table_list, ocr_list, pdf_list
+
+
+def pairwise_merge_ocr_and_pdf_texts(ocr_list, pdf_text_list):
+    """The pairwise comparisons of `merge_ocr_and_pdf_texts`, as a reference"""
+    not_matched_ocr = []
+    for ocr_item in ocr_list:
+        if not any(
+            get_rect_iou(ocr_item["location"], pdf_item["location"], iou_type=1)
+            > IOU_THRES
+            for pdf_item in pdf_text_list
+        ):
+            not_matched_ocr.append(ocr_item)
+    return pdf_text_list + not_matched_ocr
+
+
+def pairwise_cell_matches(table_list, items):
+    """The pairwise comparisons of `merge_table_cell_and_ocr`, as a reference"""
+    cells = [item for item in table_list if item["type"] == "cell"]
+    tables = [item for item in table_list if item["type"] == "table"]
+    matches = []
+    for table in tables:
+        for cell in cells:
+            if get_rect_iou(table["location"], cell["location"], iou_type=1) > 0.5:
+                matches.append(
+                    [
+                        item
+                        for item in items
+                        if get_rect_iou(item["location"], cell["location"], iou_type=1)
+                        > IOU_THRES
+                    ]
+                )
+    return matches
+
+
+def measure(fn, repeat: int) -> float:
+    """Median duration of fn in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def run(n_words: int, repeat: int):
+    table_list, ocr_list, pdf_list = make_page(n_words)
+
+    expected = pairwise_merge_ocr_and_pdf_texts(ocr_list, pdf_list)
+    assert merge_ocr_and_pdf_texts(ocr_list, pdf_list) == expected
+
+    pairwise_ms = measure(
+        lambda: (
+            pairwise_merge_ocr_and_pdf_texts(ocr_list, pdf_list),
+            pairwise_cell_matches(table_list, pdf_list),
+        ),
+        repeat,
+    )
+    indexed_ms = measure(
+        lambda: (
+            merge_ocr_and_pdf_texts(ocr_list, pdf_list),
+            merge_table_cell_and_ocr(table_list, ocr_list, pdf_list),
+        ),
+        repeat,
+    )
+    print(
+        f"words={len(pdf_list):>6,} ocr={len(ocr_list):>6,} "
+        f"cells={len(table_list) - 1:>5,}  "
+        f"pairwise={pairwise_ms:10.2f} ms  indexed={indexed_ms:9.2f} ms  "
+        f"speedup={pairwise_ms / indexed_ms:6.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--words", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for n_words in args.words:
+        run(n_words, args.repeat)
@@ -0,0 +1,119 @@
+"""Benchmark the HNSW index of NumpyVectorStore against its exact search
+
+The benchmark stores synthetic clustered embeddings once with the exact search,
+then builds the HNSW graph over the same collection for each value of M, and
+queries it with each value of ef. It reports the build time, the recall@k of the
+exact top k and the median query latency. Requires `hnswlib`.
+
+Usage:
+    python scripts/benchmarks/bench_vector_hnsw.py --rows 300000 --dim 768
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from kotaemon.storages import NumpyVectorStore
+
+
+def make_embeddings(n_rows: int, dim: int, n_clusters: int, seed: int = 0):
+    """Embeddings gathered around random topics, as text embeddings usually are"""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    assignments = rng.integers(0, n_clusters, n_rows)
+    noise = rng.standard_normal((n_rows, dim)).astype(np.float32)
+    return centroids[assignments] + noise
+
+
+def query_all(store: NumpyVectorStore, queries: np.ndarray, top_k: int):
+    """Return the ids found for each query, and the median latency in ms"""
+    results = []
+    durations = []
+    for query in queries:
+        start_time = time.perf_counter()
+        results.append(store.query(query.tolist(), top_k=top_k)[2])
+        durations.append((time.perf_counter() - start_time) * 1000)
+    return results, statistics.median(durations)
+
+
+def run(
+    n_rows: int,
+    dim: int,
+    n_queries: int,
+    top_k: int,
+    ms: list[int],
+    efs: list[int],
+    ef_construction: int,
+    batch_size: int,
+):
+    n_clusters = max(1, n_rows // 1000)
+    embeddings = make_embeddings(n_rows, dim, n_clusters=n_clusters)
+    queries = make_embeddings(n_queries, dim, n_clusters=n_clusters, seed=1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exact = NumpyVectorStore(path=tmp_dir, collection_name="bench")
+        for start in range(0, n_rows, batch_size):
+            batch = embeddings[start : start + batch_size]
+            exact.add(
+                embeddings=batch.tolist(),
+                ids=[str(i) for i in range(start, start + len(batch))],
+            )
+        truth, latency = query_all(exact, queries, top_k)
+        print(
+            f"rows={n_rows:,} dim={dim} exact          "
+            f"recall@{top_k}=1.000 latency={latency:8.2f} ms"
+        )
+
+        for m in ms:
+            # the graph is rebuilt from the stored rows when its file is missing
+            Path(tmp_dir, "bench", "hnsw.bin").unlink(missing_ok=True)
+            start_time = time.perf_counter()
+            store = NumpyVectorStore(
+                path=tmp_dir,
+                collection_name="bench",
+                index="hnsw",
+                hnsw_m=m,
+                hnsw_ef_construction=ef_construction,
+            )
+            build_s = time.perf_counter() - start_time
+            print(f"rows={n_rows:,} dim={dim} M={m:<3} build={build_s:8.1f} s")
+
+            for ef in efs:
+                store._hnsw_ef = ef
+                results, latency = query_all(store, queries, top_k)
+                recall = statistics.mean(
+                    len(set(expected).intersection(found)) / top_k
+                    for expected, found in zip(truth, results)
+                )
+                print(
+                    f"rows={n_rows:,} dim={dim} M={m:<3} ef={ef:<5} "
+                    f"recall@{top_k}={recall:.3f} latency={latency:8.2f} ms"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[300_000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--m", type=int, nargs="+", default=[16, 32])
+    parser.add_argument("--ef", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        run(
+            n_rows,
+            args.dim,
+            args.queries,
+            args.top_k,
+            args.m,
+            args.ef,
+            args.ef_construction,
+            args.batch_size,
+        )
@@ -0,0 +1,106 @@
+"""Benchmark the recall and latency of the quantized NumpyVectorStore
+
+The quantized store scans int8 or binary codes instead of the full-precision
+vectors, then rescores the `rescore_multiplier * top_k` best rows exactly. The
+benchmark indexes synthetic clustered embeddings once, and compares each mode and
+multiplier with the exact search on the same collection: recall@k of the exact
+top k, median query latency, and size of the scanned matrix.
+
+Usage:
+    python scripts/benchmarks/bench_vector_quantization.py --rows 100000 --dim 1536
+"""
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from kotaemon.storages import NumpyVectorStore
+
+
+def make_embeddings(n_rows: int, dim: int, n_clusters: int, seed: int = 0):
+    """Embeddings gathered around random topics, as text embeddings usually are"""
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    assignments = rng.integers(0, n_clusters, n_rows)
+    noise = rng.standard_normal((n_rows, dim)).astype(np.float32)
+    return centroids[assignments] + noise
+
+
+def run(
+    n_rows: int,
+    dim: int,
+    n_queries: int,
+    top_k: int,
+    multipliers: list[int],
+    batch_size: int,
+):
+    n_clusters = max(1, n_rows // 1000)
+    embeddings = make_embeddings(n_rows, dim, n_clusters=n_clusters)
+    queries = make_embeddings(n_queries, dim, n_clusters=n_clusters, seed=1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exact = NumpyVectorStore(path=tmp_dir, collection_name="bench")
+        for start in range(0, n_rows, batch_size):
+            batch = embeddings[start : start + batch_size]
+            exact.add(
+                embeddings=batch.tolist(),
+                ids=[str(i) for i in range(start, start + len(batch))],
+            )
+
+        truth = []
+        durations = []
+        for query in queries:
+            start_time = time.perf_counter()
+            truth.append(set(exact.query(query.tolist(), top_k=top_k)[2]))
+            durations.append((time.perf_counter() - start_time) * 1000)
+        print(
+            f"rows={n_rows:,} dim={dim} mode=exact       recall@{top_k}=1.000 "
+            f"latency={statistics.median(durations):8.2f} ms  "
+            f"scanned={n_rows * dim * 4 / 2**20:9.1f} MiB"
+        )
+
+        for quantization in ("int8", "binary"):
+            for multiplier in multipliers:
+                store = NumpyVectorStore(
+                    path=tmp_dir,
+                    collection_name="bench",
+                    quantization=quantization,
+                    rescore_multiplier=multiplier,
+                )
+                recalls = []
+                durations = []
+                for query, expected in zip(queries, truth):
+                    start_time = time.perf_counter()
+                    found = store.query(query.tolist(), top_k=top_k)[2]
+                    durations.append((time.perf_counter() - start_time) * 1000)
+                    recalls.append(len(expected.intersection(found)) / top_k)
+                assert store._codes is not None
+                print(
+                    f"rows={n_rows:,} dim={dim} mode={quantization:<6} "
+                    f"x{multiplier:<3} recall@{top_k}={statistics.mean(recalls):.3f} "
+                    f"latency={statistics.median(durations):8.2f} ms  "
+                    f"scanned={store._codes.nbytes / 2**20:9.1f} MiB"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--multipliers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    args = parser.parse_args()
+
+    for n_rows in args.rows:
+        run(
+            n_rows,
+            args.dim,
+            args.queries,
+            args.top_k,
+            args.multipliers,
+            args.batch_size,
+        )